@@ -0,0 +1,105 @@
+import asyncio
+
+from order import Order, OrderStatus
+from store import Store
+from worker import Courier
+from clock import EventType, WallClock
+import clock
+
+
+class LoopScheduler:
+    __slots__ = ['_clock',
+                 '_loop']
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, wall_clock: WallClock = None):
+        self._clock = wall_clock if wall_clock is not None else WallClock()
+        self._loop = loop
+
+    @property
+    def clock(self):
+        return self._clock
+
+    def schedule(self, moment: float, event_type: EventType, callback, *args) -> None:
+        self._loop.call_later(max(0.0, moment - self._clock.now()), self._fire, moment, callback, args)
+
+    def schedule_after(self, delay: float, event_type: EventType, callback, *args) -> None:
+        self.schedule(self._clock.now() + delay, event_type, callback, *args)
+
+    def _fire(self, moment: float, callback, args: tuple) -> None:
+        # loop timers run on the monotonic clock and may fire a bit before the wall clock reaches the moment
+        delay = moment - self._clock.now()
+        if delay > 0:
+            self._loop.call_later(delay, self._fire, moment, callback, args)
+        else:
+            callback(*args)
+
+
+def use_event_loop(loop: asyncio.AbstractEventLoop = None) -> LoopScheduler:
+    # assembly and delivery timers become loop callbacks, nothing blocks the loop
+    scheduler = LoopScheduler(loop if loop is not None else asyncio.get_running_loop())
+    clock.set_clock(scheduler.clock, scheduler)
+    return scheduler
+
+
+def _delivered(order: Order) -> bool:
+    return order.order_status == OrderStatus.COMPLETE
+
+
+class AsyncStore:
+    __slots__ = ['_store']
+
+    def __init__(self, store: Store):
+        self._store = store
+
+    @property
+    def store(self) -> Store:
+        return self._store
+
+    async def take_order(self, client_id: int, x: int, y: int, items: dict) -> int:
+        return self._store.take_order(client_id, x, y, items)
+
+    async def take_orders(self, batch: list) -> list:
+        return self._store.take_orders(batch)
+
+    async def process_order(self, order_id: int) -> Order:
+        # resolves once the courier has handed the order over
+        order = self._store.get_order(order_id)
+        if order is None:
+            return None
+        if _delivered(order):
+            return order
+
+        delivered = asyncio.get_running_loop().create_future()
+        self._store.add_delivery_callback(order_id,
+                                          lambda order: delivered.done() or delivered.set_result(order))
+        self._store.process_order(order_id)
+        return await delivered
+
+    async def deliver(self, client_id: int, x: int, y: int, items: dict) -> Order:
+        return await self.process_order(await self.take_order(client_id, x, y, items))
+
+
+class AsyncCourier:
+    __slots__ = ['_courier']
+
+    def __init__(self, courier: Courier):
+        self._courier = courier
+
+    @property
+    def courier(self) -> Courier:
+        return self._courier
+
+    async def get_order(self, order: Order, store: Store) -> float:
+        # awaits the trip to the client instead of sleeping in the courier
+        work_time = self._courier.get_order(order, store)
+        if work_time:
+            await asyncio.sleep(max(0.0, order.estimated_delivery_time - clock.now()))
+        return work_time
+
+    async def pass_order(self, order_id: int) -> Order:
+        order = next((order for order in self._courier.route if order.order_id == order_id), None)
+        if order is None:
+            return None
+
+        await asyncio.sleep(max(0.0, order.estimated_delivery_time - clock.now()))
+        return self._courier.pass_order(order_id) if self._courier.able_to_pass(order_id) else None
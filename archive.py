@@ -0,0 +1,200 @@
+from bisect import bisect_right
+from collections import deque
+from dataclasses import dataclass
+
+import heapq
+import os
+import struct
+
+from order import Order, OrderStatus
+
+SEGMENT_SIZE = 4096  # orders per archive segment, segments are evicted whole
+MAX_ORDERS = 16 * SEGMENT_SIZE  # archived orders a store keeps unless told otherwise
+SPILL_RANGES = 8  # order id ranges kept in memory per spilled segment, split at its widest gaps
+
+RECORD = struct.Struct('<qqqqddddBH')  # order, client, storekeeper, courier, x, y, created, estimated, status, items
+RECORD_ITEM = struct.Struct('<Iq')  # item name index, amount
+SPILL_ENTRY = struct.Struct('<qQ')  # order id, offset of its record in the spill file
+
+
+@dataclass
+class Retention:
+    max_orders: int = MAX_ORDERS  # archived orders kept, oldest segments go first, None keeps everything
+    max_age: float = None  # clock seconds an archived order is kept after it was finished
+    spill_path: str = None  # evicted segments are appended here and stay readable, otherwise they are dropped;
+    # the file may be shared by several archives or left from an earlier run, each archive finds only its own
+
+
+class Segment:
+    __slots__ = ['data',
+                 'offsets',
+                 'finished']
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = dict()  # order_id - offset of its record in data
+        self.finished = 0.0  # latest finish time in the segment
+
+
+class Archive:
+    # finished orders packed into byte segments, an order costs its record and one index entry
+    __slots__ = ['_retention',
+                 '_segment_size',
+                 '_segments',
+                 '_count',
+                 '_names',
+                 '_name_index',
+                 '_spilled',
+                 '_spilled_count']
+
+    def __init__(self, retention: Retention = None, segment_size: int = SEGMENT_SIZE):
+        self._retention = retention if retention is not None else Retention()
+        self._segment_size = max(1, segment_size)
+        self._segments = deque([Segment()])
+        self._count = 0
+        self._names = []  # index - item name
+        self._name_index = dict()  # item name - index
+        # (path, offset of the index, entries, range lows, range highs, range starts) per spilled segment; the
+        # index of a segment is written after its records sorted by order id and split into a few id ranges, an
+        # id outside all of them is answered without reading the file
+        self._spilled = []
+        self._spilled_count = 0
+
+    def __len__(self) -> int:
+        return self._count + self._spilled_count
+
+    def __contains__(self, order_id: int) -> bool:
+        return (any(order_id in segment.offsets for segment in self._segments) or
+                self._spilled_offset(order_id) is not None)
+
+    @property
+    def retention(self) -> Retention:
+        return self._retention
+
+    def set_retention(self, retention: Retention) -> None:
+        self._retention = retention
+
+    def _name(self, name: str) -> int:
+        index = self._name_index.get(name)
+        if index is None:
+            index = self._name_index[name] = len(self._names)
+            self._names.append(name)
+        return index
+
+    def _pack(self, order: Order) -> bytes:
+        return RECORD.pack(order.order_id, order.client_id or 0, order.storekeeper_id or 0, order.courier_id or 0,
+                           order.x, order.y, order.creation_time, order.estimated_delivery_time,
+                           order.order_status.value, len(order.items)) + \
+            b''.join(RECORD_ITEM.pack(self._name(name), amount) for [name, amount] in order.items.items())
+
+    def _unpack(self, data, offset: int) -> Order:
+        [order_id, client_id, storekeeper_id, courier_id, x, y, created, estimated, status, count] = \
+            RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        items = dict()
+        for _ in range(count):
+            [name, amount] = RECORD_ITEM.unpack_from(data, offset)
+            items[self._names[name]] = amount
+            offset += RECORD_ITEM.size
+
+        return Order(_client_id=client_id,
+                     _order_id=order_id,
+                     _order_status=OrderStatus(status),
+                     _creation_time=created,
+                     _estimated_delivery_time=estimated,
+                     _x=x,
+                     _y=y,
+                     _items=items,
+                     _storekeeper_id=storekeeper_id or '',
+                     _courier_id=courier_id or '')
+
+    def add(self, order: Order, finished: float) -> list:
+        segment = self._segments[-1]
+        segment.offsets[order.order_id] = len(segment.data)
+        segment.data += self._pack(order)
+        segment.finished = max(segment.finished, finished)
+        self._count += 1
+
+        if len(segment.offsets) >= self._segment_size:
+            self._segments.append(Segment())
+        return self.evict(finished)
+
+    def evict(self, now: float) -> list:
+        # only full segments are evicted, the one being filled always stays;
+        # returns (order_id, client_id, storekeeper_id, courier_id, creation_time, status) of the evicted orders
+        retention = self._retention
+        evicted = []
+        while len(self._segments) > 1:
+            oldest = self._segments[0]
+            too_many = retention.max_orders is not None and self._count - len(oldest.offsets) >= retention.max_orders
+            too_old = retention.max_age is not None and oldest.finished < now - retention.max_age
+            if not (too_many or too_old):
+                break
+
+            self._segments.popleft()
+            self._count -= len(oldest.offsets)
+            for offset in oldest.offsets.values():
+                [order_id, client_id, storekeeper_id, courier_id, _, _, created, _, status, _] = \
+                    RECORD.unpack_from(oldest.data, offset)
+                evicted.append((order_id, client_id, storekeeper_id, courier_id, created, OrderStatus(status)))
+            if retention.spill_path is not None:
+                self._spill(oldest)
+        return evicted
+
+    def _spill(self, segment: Segment) -> None:
+        path = self._retention.spill_path
+        with open(path, 'ab') as file:
+            start = file.seek(0, os.SEEK_END)  # whatever is in the file already stays before this segment
+            file.write(segment.data)
+            entries = sorted(segment.offsets.items())
+            file.write(b''.join(SPILL_ENTRY.pack(order_id, start + offset) for [order_id, offset] in entries))
+
+        # ids of a segment share a finish window, not a creation one, so a few slow orders stretch its range
+        order_ids = [order_id for [order_id, _] in entries]
+        cuts = heapq.nlargest(SPILL_RANGES - 1, range(1, len(order_ids)),
+                              key=lambda cut: order_ids[cut] - order_ids[cut - 1])
+        starts = [0] + sorted(cut for cut in cuts if order_ids[cut] - order_ids[cut - 1] > 1)
+        ends = starts[1:] + [len(order_ids)]
+        self._spilled.append((path, start + len(segment.data), len(entries),
+                              tuple(order_ids[first] for first in starts),
+                              tuple(order_ids[end - 1] for end in ends),
+                              tuple(starts)))
+        self._spilled_count += len(entries)
+
+    def _spilled_offset(self, order_id: int):
+        # (path, offset of the record) or None, binary searched in the on-disk index of the one id range that
+        # covers it in each segment, a read of one entry per step
+        for [path, index, count, lows, highs, starts] in reversed(self._spilled):
+            at = bisect_right(lows, order_id) - 1
+            if at < 0 or order_id > highs[at] or not os.path.exists(path):
+                continue
+
+            [low, high] = [starts[at], starts[at + 1] if at + 1 < len(starts) else count]
+            with open(path, 'rb') as file:
+                while low < high:
+                    middle = (low + high) // 2
+                    file.seek(index + middle * SPILL_ENTRY.size)
+                    [each, offset] = SPILL_ENTRY.unpack(file.read(SPILL_ENTRY.size))
+                    if each == order_id:
+                        return path, offset
+                    if each < order_id:
+                        low = middle + 1
+                    else:
+                        high = middle
+        return None
+
+    def get(self, order_id: int) -> Order:
+        for segment in reversed(self._segments):  # recent orders are asked for most
+            offset = segment.offsets.get(order_id)
+            if offset is not None:
+                return self._unpack(segment.data, offset)
+
+        spilled = self._spilled_offset(order_id)
+        if spilled is None:
+            return None
+        [path, offset] = spilled
+        with open(path, 'rb') as file:
+            file.seek(offset)
+            header = file.read(RECORD.size)
+            count = RECORD.unpack(header)[-1]
+            return self._unpack(header + file.read(count * RECORD_ITEM.size), 0)
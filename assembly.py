@@ -0,0 +1,33 @@
+from math import ceil
+
+MIN_TASK = 50  # units a picking task should have at least, smaller orders stay with one storekeeper
+
+
+def pickers(units: int, free: int, min_task: int = MIN_TASK) -> int:
+    # storekeepers worth putting on an order of this many units
+    if min_task is None or min_task <= 0:
+        return 1
+    return max(1, min(free, units // min_task))
+
+
+def split(items: dict, pickers: int) -> list:
+    # item name - amount for each picker; units of an item can be picked by anyone, so filling pickers in turn
+    # up to an equal share (mcnaughton's wrap-around rule) gives the shortest makespan, and an item is split
+    # between two pickers at most
+    total = sum(items.values())
+    if pickers <= 1 or total <= 1:
+        return [dict(items)]
+
+    share = ceil(total / pickers)
+    tasks = [dict()]
+    room = share
+    for [name, amount] in items.items():
+        while amount > 0:
+            if room == 0:
+                tasks.append(dict())
+                room = share
+            taken = min(amount, room)
+            tasks[-1][name] = tasks[-1].get(name, 0) + taken
+            amount -= taken
+            room -= taken
+    return tasks
@@ -0,0 +1,94 @@
+import enum
+import heapq
+import itertools
+
+COMPACT_MIN = 64  # stale heap entries tolerated before a heap is rebuilt whatever its size
+
+
+class Stage(enum.Enum):
+    STOCK = 1  # no provider could cover the shortfall
+    STOREKEEPER = 2  # no storekeeper is free
+    ASSEMBLY = 3  # assembly timer has not fired yet
+    COURIER = 4  # no courier is free
+
+
+class Backlog:
+    __slots__ = ['_queues',
+                 '_entries',
+                 '_counts',
+                 '_stale',
+                 '_sequence']
+
+    def __init__(self):
+        self._queues = {stage: [] for stage in Stage}  # stage - heap of (ready_time, sequence, order_id)
+        self._entries = dict()  # order_id - (stage, sequence) of the live entry
+        self._counts = {stage: 0 for stage in Stage}
+        self._stale = {stage: 0 for stage in Stage}  # stage - entries left in its heap by discard
+        self._sequence = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, order_id: int) -> bool:
+        return order_id in self._entries
+
+    def add(self, order_id: int, stage: Stage, ready_time: float) -> None:
+        self.discard(order_id)  # an older entry is dropped lazily from its heap
+        sequence = next(self._sequence)
+        self._entries[order_id] = (stage, sequence)
+        self._counts[stage] += 1
+        heapq.heappush(self._queues[stage], (ready_time, sequence, order_id))
+
+    def discard(self, order_id: int) -> None:
+        entry = self._entries.pop(order_id, None)
+        if entry is not None:
+            self._counts[entry[0]] -= 1
+            self._stale[entry[0]] += 1
+            if self._stale[entry[0]] > max(COMPACT_MIN, self._counts[entry[0]]):
+                self._compact(entry[0])
+
+    def _live(self, stage: Stage) -> list:
+        return [entry for entry in self._queues[stage] if self._entries.get(entry[2]) == (stage, entry[1])]
+
+    def _compact(self, stage: Stage) -> None:
+        # stale entries outnumber live ones, so the rebuild costs no more than popping them would
+        queue = self._live(stage)
+        heapq.heapify(queue)
+        self._queues[stage] = queue
+        self._stale[stage] = 0
+
+    def stage_of(self, order_id: int) -> Stage:
+        entry = self._entries.get(order_id)
+        return entry[0] if entry is not None else None
+
+    def count(self, stage: Stage) -> int:
+        return self._counts[stage]
+
+    def _top(self, stage: Stage):
+        queue = self._queues[stage]
+        while queue:
+            ready_time, sequence, order_id = queue[0]
+            if self._entries.get(order_id) == (stage, sequence):
+                return queue[0]
+            heapq.heappop(queue)
+            self._stale[stage] -= 1
+
+        return None
+
+    def next_ready_time(self, stage: Stage) -> float:
+        top = self._top(stage)
+        return top[0] if top is not None else float('inf')
+
+    def pop(self, stage: Stage) -> int:
+        top = self._top(stage)
+        if top is None:
+            return None
+
+        heapq.heappop(self._queues[stage])
+        del self._entries[top[2]]
+        self._counts[stage] -= 1
+        return top[2]
+
+    def orders(self, stage: Stage) -> list:
+        # live orders by ready time, sorts the heap - take it once per pass, not once per order handled
+        return [order_id for [_, _, order_id] in sorted(self._live(stage))]
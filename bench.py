@@ -0,0 +1,269 @@
+from dataclasses import dataclass, asdict, replace
+from collections import defaultdict
+
+import argparse
+import json
+import random
+import resource
+import sys
+import time
+import tracemalloc
+import uuid
+
+from client import Client
+from order import Item, OrderStatus
+from provider import Provider
+from registry import StoreRegistry
+from store import Store
+from worker import Courier, Storekeeper
+import clock
+import hooks
+import log
+import metrics
+
+
+@dataclass
+class Scenario:
+    seed: int = 1
+    stores: int = 4
+    providers: int = 3
+    couriers: int = 3  # per store
+    storekeepers: int = 2  # per store
+    skus: int = 200
+    clients: int = 500
+    rate: float = 20.0  # orders per simulated second, arrivals are a poisson stream
+    duration: float = 60.0  # simulated seconds of arrivals
+    drain: float = 600.0  # simulated seconds after the last arrival for the backlog to clear
+    items_per_order: int = 3
+    max_amount: int = 3
+    stock: int = 500  # initial amount of every sku a provider carries
+    coverage: float = 0.5  # share of the catalogue each provider carries, besides its own slice
+    restock_every: float = 10.0  # providers top up every sku this often, 0 to never restock
+    restock_amount: int = 100
+    area: float = 100.0  # stores and clients are spread over an area x area square
+    route_size: int = 4
+    replenish_every: float = 0.0  # stores top up ahead of demand this often, 0 to source per order only
+
+
+SCENARIOS = {'small': Scenario(),
+             'medium': Scenario(stores=16, providers=8, couriers=4, storekeepers=3, skus=2000, clients=5000, rate=100),
+             'large': Scenario(stores=64, providers=24, couriers=6, storekeepers=4, skus=20000, clients=50000,
+                               rate=400, area=400)}
+
+STAGES = [('sourcing', OrderStatus.NEW, OrderStatus.READY_TO_ASSEMBLE),
+          ('assembly', OrderStatus.READY_TO_ASSEMBLE, OrderStatus.ASSEMBLE),
+          ('courier wait', OrderStatus.ASSEMBLE, OrderStatus.DELIVER),
+          ('delivery', OrderStatus.DELIVER, OrderStatus.COMPLETE),
+          ('total', OrderStatus.NEW, OrderStatus.COMPLETE)]
+
+PERCENTILES = [50, 90, 99, 100]
+
+
+class StageRecorder(hooks.Hook):
+    # keeps when each order first reached each status
+    __slots__ = ['_times',
+                 '_bound']
+
+    def __init__(self):
+        self._times = defaultdict(dict)  # order_id - {status - simulated time}
+        self._bound = {hooks.Point.ORDER_CREATED: self._order_created,
+                       hooks.Point.STATUS_CHANGED: self._status_changed}
+
+    def points(self) -> dict:
+        return self._bound
+
+    def _order_created(self, store, order) -> None:
+        self._times[order.order_id][OrderStatus.NEW] = order.creation_time
+
+    def _status_changed(self, order, previous) -> None:
+        self._times[order.order_id].setdefault(order.order_status, clock.now())
+
+    def latencies(self) -> dict:
+        result = dict()
+        for [stage, start, finish] in STAGES:
+            result[stage] = sorted(times[finish] - times[start] for times in self._times.values()
+                                   if start in times and finish in times)
+        return result
+
+    def last_completion(self) -> float:
+        return max((times[OrderStatus.COMPLETE] for times in self._times.values()
+                    if OrderStatus.COMPLETE in times), default=0.0)
+
+
+def percentile(values: list, rank: float) -> float:
+    # nearest rank on a sorted list
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(rank / 100 * len(values))) - 1))]
+
+
+class World:
+    __slots__ = ['scenario',
+                 'random',
+                 'items',
+                 'providers',
+                 'carried',
+                 'stores',
+                 'registry',
+                 'clients']
+
+    def __init__(self, scenario: Scenario):
+        # ids come from the seeded generator too, so two runs of a scenario build the same world
+        self.scenario = scenario
+        self.random = random.Random(scenario.seed)
+        self.registry = StoreRegistry()
+
+        self.items = [Item(_name='sku{0}'.format(index),
+                           _price=self.random.randint(1, 100),
+                           _at_store_id=self._uuid(),
+                           _at_provider_id=self._uuid(),
+                           _provider_id=None) for index in range(scenario.skus)]
+
+        self.providers = []
+        self.carried = dict()  # provider_id - items the provider carries
+        for index in range(scenario.providers):
+            provider = Provider(self._uuid())
+            self.carried[provider.provider_id] = [item for [sku, item] in enumerate(self.items)  # every sku is carried
+                                                  if sku % scenario.providers == index or
+                                                  self.random.random() < scenario.coverage]
+            for item in self.carried[provider.provider_id]:
+                provider.add_item(item, scenario.stock)
+            self.providers.append(provider)
+
+        self.stores = []
+        for _ in range(scenario.stores):
+            store = Store(self._uuid(), self.random.uniform(0, scenario.area), self.random.uniform(0, scenario.area))
+            store.set_route_batching(scenario.route_size)
+            if scenario.replenish_every > 0:
+                store.set_replenishment(interval=scenario.replenish_every)
+            for provider in self.providers:
+                store.add_provider(provider)
+            for item in self.items:
+                store.add_category(item)
+            for _ in range(scenario.couriers):
+                Courier(self._uuid()).get_shift(scenario.duration + scenario.drain, store)
+            for _ in range(scenario.storekeepers):
+                Storekeeper(self._uuid()).get_shift(scenario.duration + scenario.drain, store)
+            self.registry.add_store(store)
+            self.stores.append(store)
+
+        self.clients = [Client(self._uuid(), self.random.uniform(0, scenario.area),
+                               self.random.uniform(0, scenario.area)) for _ in range(scenario.clients)]
+
+    def _uuid(self) -> uuid.UUID:
+        return uuid.UUID(int=self.random.getrandbits(128), version=4)
+
+    def order(self) -> dict:
+        skus = self.random.sample(self.items, min(self.scenario.items_per_order, len(self.items)))
+        return {item.name: self.random.randint(1, self.scenario.max_amount) for item in skus}
+
+
+def run(scenario: Scenario, trace_memory: bool = False, metrics_path: str = None) -> dict:
+    # the clock and log levels are swapped for the run only, whoever calls it gets theirs back
+    [previous_clock, previous_scheduler, levels] = [clock.get_clock(), clock.get_scheduler(), log.get_levels()]
+    log.set_level(log.Level.ERROR)
+    scheduler = clock.use_simulation()
+    recorder = StageRecorder().install()
+    if metrics_path is not None:
+        metrics.configure()
+    if trace_memory:
+        tracemalloc.start()
+
+    try:
+        started = time.perf_counter()
+        world = World(scenario)
+        built = time.perf_counter()
+
+        placed = []
+
+        def place(client: Client, items: dict) -> None:
+            order_id = client.make_order(items, registry=world.registry)
+            if order_id is not None:
+                placed.append(order_id)
+
+        moment = 0.0
+        while True:
+            moment += world.random.expovariate(scenario.rate)
+            if moment > scenario.duration:
+                break
+            scheduler.schedule(moment, clock.EventType.ORDER_PLACED, place,
+                               world.random.choice(world.clients), world.order())
+
+        if scenario.restock_every > 0:
+            moment = scenario.restock_every
+            while moment <= scenario.duration:
+                for provider in world.providers:
+                    scheduler.schedule(moment, clock.EventType.ORDER_PLACED, _restock, provider,
+                                       world.carried[provider.provider_id], scenario.restock_amount)
+                moment += scenario.restock_every
+
+        events = scheduler.run(until=scenario.duration + scenario.drain)
+        finished = time.perf_counter()
+    finally:
+        recorder.uninstall()
+        clock.set_clock(previous_clock, previous_scheduler)
+        log.set_levels(levels)
+        if metrics_path is not None:
+            metrics.get_metrics().write(metrics_path, 'json' if metrics_path.endswith('.json') else 'prometheus')
+            metrics.disable()
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    latencies = recorder.latencies()
+    delivered = len(latencies['total'])
+    return {'scenario': asdict(scenario),
+            'orders': len(placed),
+            'delivered': delivered,
+            'events': events,
+            'build seconds': built - started,
+            'run seconds': finished - built,
+            'orders per second': delivered / (finished - built) if finished > built else None,
+            'simulated seconds': recorder.last_completion(),
+            'latency': {stage: {'p{0}'.format(rank): percentile(values, rank) for rank in PERCENTILES}
+                        for [stage, values] in latencies.items()},
+            'peak memory mb': (peak if trace_memory else _max_rss()) / 2 ** 20}
+
+
+def _restock(provider: Provider, items: list, amount: int) -> None:
+    for item in items:
+        provider.add_item(item, amount)
+
+
+def _max_rss() -> int:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024  # bytes on macos, kilobytes elsewhere
+
+
+def report(result: dict) -> str:
+    lines = ['orders: {0}, delivered: {1}, events: {2}'.format(result['orders'], result['delivered'],
+                                                               result['events']),
+             'build: {0:.3f}s, run: {1:.3f}s, {2:.0f} orders/s, simulated: {3:.1f}s'.format(
+                 result['build seconds'], result['run seconds'], result['orders per second'] or 0,
+                 result['simulated seconds']),
+             'peak memory: {0:.1f} MB'.format(result['peak memory mb']),
+             '{0:<14}'.format('stage') + ''.join('{0:>10}'.format('p{0}'.format(rank)) for rank in PERCENTILES)]
+    for [stage, values] in result['latency'].items():
+        lines.append('{0:<14}'.format(stage) + ''.join(
+            '{0:>10}'.format('-' if value is None else '{0:.3f}'.format(value)) for value in values.values()))
+    return '\n'.join(lines)
+
+
+def main(argv: list = None) -> None:
+    parser = argparse.ArgumentParser(description='synthetic load for the order pipeline')
+    parser.add_argument('scenario', nargs='?', default='small', choices=sorted(SCENARIOS))
+    for [field, default] in asdict(Scenario()).items():
+        parser.add_argument('--' + field.replace('_', '-'), type=type(default), default=None)
+    parser.add_argument('--trace-memory', action='store_true', help='peak python heap instead of max rss, slower')
+    parser.add_argument('--json', action='store_true', help='print the result as json')
+    parser.add_argument('--metrics', help='write the store metrics here, json if the name ends with .json')
+    arguments = parser.parse_args(argv)
+
+    overrides = {field: getattr(arguments, field) for field in asdict(Scenario())
+                 if getattr(arguments, field) is not None}
+    result = run(replace(SCENARIOS[arguments.scenario], **overrides), arguments.trace_memory, arguments.metrics)
+    print(json.dumps(result, indent=2) if arguments.json else report(result))
+
+
+if __name__ == '__main__':
+    main()
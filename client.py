@@ -2,6 +2,10 @@ import uuid
 
 from worker import Courier
 from store import Store
+from registry import StoreRegistry
+from orderbook import LIVE_STATUSES
+import ids
+import log
 
 
 class Client:
@@ -12,13 +16,13 @@ class Client:
                  '_y']
 
     def __init__(self, client_id: uuid, x: int, y: int):
-        self._client_id = client_id
+        self._client_id = ids.intern(client_id)
         self._x = x
         self._y = y
         self._sent_orders_id = set()
         self._received_orders = dict()  # order_id - order
 
-        print('client: {0} registered'.format(client_id))
+        log.info('client', 'client: {0} registered', self._client_id)
 
     @property
     def x(self) -> int:
@@ -28,26 +32,46 @@ class Client:
     def y(self) -> int:
         return self._y
 
-    def make_order(self, items: dict, store: Store) -> uuid:
-        print('client: {0} made order in store: {1}'.format(self._client_id, store.store_id))
+    def make_order(self, items: dict, store: Store = None, registry: StoreRegistry = None,
+                   prefer_stock: bool = False) -> int:
+        # without a store the order goes to the nearest one selling the items; prefer_stock first looks for the
+        # nearest one that has them all in stock, a second walk over the grid that reads every candidate's stock
+        if store is None:
+            stores = ((prefer_stock and registry.nearest(self._x, self._y, 1, items, in_stock=True)) or
+                      registry.nearest(self._x, self._y, 1, items))
+            if not stores:
+                log.warning('client', 'client: {0} found no store selling: {1}', self._client_id, list(items))
+                return None
+            store = stores[0]
+
+        log.info('client', 'client: {0} made order in store: {1}', self._client_id, store.store_id)
         order_id = store.take_order(self._client_id, self._x, self._y, items)
         self._sent_orders_id.add(order_id)
         return order_id
 
-    def take_order(self, order_id: uuid, courier: Courier) -> bool:
+    def make_orders(self, items_list: list, store: Store) -> list:
+        log.info('client', 'client: {0} made {1} orders in store: {2}',
+                 self._client_id, len(items_list), store.store_id)
+        order_ids = store.take_orders([(self._client_id, self._x, self._y, items) for items in items_list])
+        self._sent_orders_id.update(order_ids)
+        return order_ids
+
+    def open_orders(self, registry: StoreRegistry) -> list:
+        return registry.query(LIVE_STATUSES, client_id=self._client_id)
+
+    def take_order(self, order_id: int, courier: Courier) -> bool:
+        order_id = ids.find(order_id)
         if order_id in self._sent_orders_id and courier.able_to_pass(order_id):
             self._sent_orders_id.remove(order_id)
-            self._received_orders[order_id] = courier.pass_order()
+            self._received_orders[order_id] = courier.pass_order(order_id)
 
-            print('client: {0} took order: {1} from courier: {2}'.format(self._client_id,
-                                                                         order_id,
-                                                                         courier.worker_id))
+            log.info('client', 'client: {0} took order: {1} from courier: {2}',
+                     self._client_id, order_id, courier.worker_id)
 
             return True
 
         else:
-            print('client: {0} didnt take order: {1} from courier: {2}'.format(self._client_id,
-                                                                               order_id,
-                                                                               courier.worker_id))
+            log.warning('client', 'client: {0} didnt take order: {1} from courier: {2}',
+                        self._client_id, order_id, courier.worker_id)
 
             return False
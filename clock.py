@@ -0,0 +1,131 @@
+import enum
+import heapq
+import itertools
+import time
+
+
+class WallClock:
+    __slots__ = []
+
+    def now(self) -> float:
+        return time.time()
+
+    def sleep(self, delay: float) -> None:
+        if delay > 0:
+            time.sleep(delay)
+
+
+class SimulatedClock:
+    __slots__ = ['_now']
+
+    def __init__(self, start: float = 0.0):
+        self._now = start
+
+    def now(self) -> float:
+        return self._now
+
+    def sleep(self, delay: float) -> None:
+        if delay > 0:
+            self._now += delay  # virtual time passes instantly
+
+    def advance_to(self, moment: float) -> None:
+        if moment > self._now:
+            self._now = moment
+
+
+class EventType(enum.Enum):
+    ORDER_PLACED = 1
+    ASSEMBLY_FINISHED = 2
+    COURIER_ARRIVED = 3
+    WORKER_FREE = 4
+    SHIFT_ENDED = 5
+    REPLENISH = 6
+
+
+class Scheduler:
+    __slots__ = ['_clock',
+                 '_events',
+                 '_sequence',
+                 '_processed']
+
+    def __init__(self, clock):
+        self._clock = clock
+        self._events = []  # heap of (time, sequence, event type, callback, args)
+        self._sequence = itertools.count()  # keeps events with equal time in insertion order
+        self._processed = 0
+
+    @property
+    def clock(self):
+        return self._clock
+
+    @property
+    def processed(self) -> int:
+        return self._processed
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+    def schedule(self, moment: float, event_type: EventType, callback, *args) -> None:
+        heapq.heappush(self._events, (moment, next(self._sequence), event_type, callback, args))
+
+    def schedule_after(self, delay: float, event_type: EventType, callback, *args) -> None:
+        self.schedule(self._clock.now() + delay, event_type, callback, *args)
+
+    def next_event_time(self) -> float:
+        return self._events[0][0] if self._events else float('inf')
+
+    def step(self) -> bool:
+        if not self._events:
+            return False
+
+        moment, _, event_type, callback, args = heapq.heappop(self._events)
+        self._clock.sleep(moment - self._clock.now())
+        callback(*args)
+        self._processed += 1
+        return True
+
+    def run(self, until: float = None) -> int:
+        processed = self._processed
+        while self._events and (until is None or self._events[0][0] <= until):
+            self.step()
+
+        if until is not None:
+            self._clock.sleep(until - self._clock.now())
+
+        return self._processed - processed
+
+
+_clock = WallClock()
+_scheduler = None  # no scheduler - workers block on the clock as before
+
+
+def now() -> float:
+    return _clock.now()
+
+
+def sleep(delay: float) -> None:
+    _clock.sleep(delay)
+
+
+def get_clock():
+    return _clock
+
+
+def get_scheduler():
+    return _scheduler
+
+
+def set_clock(clock, scheduler: Scheduler = None) -> None:
+    global _clock, _scheduler
+    _clock = clock
+    _scheduler = scheduler
+
+
+def use_simulation(start: float = 0.0) -> Scheduler:
+    simulated_clock = SimulatedClock(start)
+    set_clock(simulated_clock, Scheduler(simulated_clock))
+    return _scheduler
+
+
+def use_wall_clock() -> None:
+    set_clock(WallClock())
@@ -0,0 +1,189 @@
+from collections import defaultdict
+from contextlib import nullcontext
+
+import heapq
+import itertools
+import threading
+
+from backlog import Stage
+from worker import Worker, Courier
+import clock
+import log
+
+
+class Dispatcher:
+    # hands workers with shifts at several stores to whichever of those stores has the most orders waiting for
+    # them; a store only sees the shared workers lent to it, so a worker busy at one store is never counted free
+    # at another. free shared workers are queued per store and stage, so a store looks at its own queue only
+    __slots__ = ['_stores',
+                 '_stores_of',
+                 '_backlogs',
+                 '_free',
+                 '_idle',
+                 '_lent',
+                 '_pending',
+                 '_location',
+                 '_sequence',
+                 '_lock']
+
+    def __init__(self, thread_safe: bool = False):
+        self._stores = dict()  # store_id - store
+        self._stores_of = defaultdict(set)  # worker_id - store ids it holds shifts at
+        self._backlogs = defaultdict(lambda: {Stage.STOREKEEPER: 0, Stage.COURIER: 0})  # store_id - last reported
+        self._free = defaultdict(list)  # (store_id, stage) - heap of (work_finish_time, sequence, worker_id)
+        self._idle = dict()  # worker_id - (worker, sequence of its live queue entries), shared workers not lent out
+        self._lent = defaultdict(list)  # store_id - workers lent while the store drains its backlog
+        self._pending = set()  # worker ids with a hand-over event scheduled
+        self._location = dict()  # worker_id - store_id it last worked for
+        self._sequence = itertools.count()
+        self._lock = threading.RLock() if thread_safe else nullcontext()
+
+    def __len__(self) -> int:
+        return sum(len(store_ids) > 1 for store_ids in self._stores_of.values())
+
+    @staticmethod
+    def _stage(worker: Worker) -> Stage:
+        return Stage.COURIER if isinstance(worker, Courier) else Stage.STOREKEEPER
+
+    def shares(self, worker_id: int) -> bool:
+        return len(self._stores_of.get(worker_id, ())) > 1
+
+    def location(self, worker_id: int) -> int:
+        return self._location.get(worker_id)
+
+    def backlog(self, store_id: int, stage: Stage) -> int:
+        return self._backlogs[store_id][stage] if store_id in self._backlogs else 0
+
+    def add_store(self, store) -> None:
+        with self._lock:
+            self._stores[store.store_id] = store
+
+    def add_worker(self, worker: Worker, store) -> bool:
+        # returns whether the worker is shared, a shared worker is kept out of the pools of its stores
+        with self._lock:
+            self._stores[store.store_id] = store
+            store_ids = self._stores_of[worker.worker_id]
+            became_shared = len(store_ids) == 1 and store.store_id not in store_ids
+            store_ids.add(store.store_id)
+            if not became_shared:
+                if len(store_ids) > 1 and worker.worker_id in self._idle:  # a new shift at a store already known
+                    self._queue(worker)
+                return len(store_ids) > 1
+            stores = [self._stores[store_id] for store_id in store_ids]
+            self._location.setdefault(worker.worker_id, next(iter(store_ids - {store.store_id})))
+
+        for each in stores:  # no dispatcher lock is held while a store lock is taken
+            each.withdraw(worker)
+        log.info('dispatch', 'worker: {0} is shared between {1} stores', worker.worker_id, len(stores))
+        self.release(worker, None)
+        return True
+
+    def _queue(self, worker: Worker) -> None:
+        sequence = next(self._sequence)
+        self._idle[worker.worker_id] = (worker, sequence)
+        stage = self._stage(worker)
+        for store_id in self._stores_of[worker.worker_id]:
+            heapq.heappush(self._free[store_id, stage], (worker.work_finish_time, sequence, worker.worker_id))
+
+    def release(self, worker: Worker, store) -> None:
+        # the worker is done being assigned by store, it comes back here and is handed out again once free
+        with self._lock:
+            if store is not None:
+                self._location[worker.worker_id] = store.store_id
+            self._queue(worker)
+        self._schedule(worker, worker.work_finish_time)
+
+    def _schedule(self, worker: Worker, moment: float) -> None:
+        scheduler = clock.get_scheduler()
+        if scheduler is None or worker.worker_id in self._pending:
+            return
+        self._pending.add(worker.worker_id)
+        scheduler.schedule(max(moment, clock.now()), clock.EventType.WORKER_FREE, self._freed, worker)
+
+    @staticmethod
+    def _ready(worker: Worker, now: float) -> bool:
+        return worker.order is None and worker.work_finish_time <= now
+
+    def _best(self, worker: Worker, now: float):
+        # store with the most orders waiting for this kind of worker among those it has a shift at,
+        # ties go to where the worker already is
+        stage = self._stage(worker)
+        location = self._location.get(worker.worker_id)
+        [best, most] = [None, 0]
+        for store_id in self._stores_of[worker.worker_id]:
+            if worker.shift_finish_time(store_id) < now:
+                continue
+            count = self._backlogs[store_id][stage]
+            if count > most or (count == most and count and store_id == location):
+                [best, most] = [store_id, count]
+        return best
+
+    def _freed(self, worker: Worker) -> None:
+        now = clock.now()
+        with self._lock:
+            self._pending.discard(worker.worker_id)
+            if worker.worker_id not in self._idle or not self._ready(worker, now):
+                return  # lent out since, or its finish event has not fired yet - the store reports it then
+            best = self._best(worker, now)
+            if best is None:
+                return
+            del self._idle[worker.worker_id]
+            self._location[worker.worker_id] = best
+            store = self._stores[best]
+
+        log.debug('dispatch', 'worker: {0} sent to store: {1}', worker.worker_id, best)
+        if not store.borrow(worker):
+            with self._lock:
+                self._queue(worker)
+
+    def report(self, store, storekeepers: int, couriers: int) -> bool:
+        # store finished draining with this many orders waiting per stage; workers lent during the drain and
+        # left idle are taken back, free shared workers this store is the best place for are lent to it.
+        # returns whether any were lent, the store drains again then
+        now = clock.now()
+        with self._lock:
+            backlogs = self._backlogs[store.store_id]
+            backlogs[Stage.STOREKEEPER] = storekeepers
+            backlogs[Stage.COURIER] = couriers
+
+            returned = set()
+            for worker in self._lent.pop(store.store_id, ()):
+                if store.withdraw(worker):
+                    returned.add(worker.worker_id)
+                    self._queue(worker)
+
+            lent = False
+            for [stage, count] in [[Stage.STOREKEEPER, storekeepers], [Stage.COURIER, couriers]]:
+                queue = self._free[store.store_id, stage]
+                skipped = []
+                while count and queue:
+                    [work_finish_time, sequence, worker_id] = queue[0]
+                    entry = self._idle.get(worker_id)
+                    if entry is None or entry[1] != sequence:
+                        heapq.heappop(queue)
+                        continue
+                    worker = entry[0]
+                    if worker.shift_finish_time(store.store_id) < now:
+                        heapq.heappop(queue)
+                        continue
+                    if not self._ready(worker, now):
+                        break
+
+                    heapq.heappop(queue)
+                    best = self._best(worker, now)
+                    if best != store.store_id or worker_id in returned:
+                        skipped.append((work_finish_time, sequence, worker_id))
+                        if best is not None and best != store.store_id:
+                            self._schedule(worker, now)  # hand it over to the busier store from the event loop
+                        continue
+
+                    del self._idle[worker_id]
+                    self._location[worker_id] = store.store_id
+                    self._lent[store.store_id].append(worker)
+                    store.lend(worker)
+                    lent = True
+                    count -= 1
+
+                for entry in skipped:
+                    heapq.heappush(queue, entry)
+            return lent
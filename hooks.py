@@ -0,0 +1,209 @@
+from collections import defaultdict
+from time import perf_counter
+
+import cProfile
+import enum
+import pstats
+import threading
+
+from metrics import Histogram, STAGE_OF_STATUS, QUANTILES
+
+
+class Point(enum.Enum):
+    ORDER_CREATED = 1  # callback(store, order), the order is in the store but not processed yet
+    STATUS_CHANGED = 2  # callback(order, previous status)
+    WORKER_ASSIGNED = 3  # callback(store, order, worker_id, courier), once per worker put on the order
+    PROVIDER_REQUEST = 4  # callback(provider, request, call) -> call(request), wraps Provider.process_request
+    # and Provider.commit, request is at_store_id - amount
+
+
+# what call sites read, None while nothing is registered - a call site tests the name and calls it directly,
+# so an unhooked point costs one global lookup. several callbacks are folded into one function on register
+order_created = None
+status_changed = None
+worker_assigned = None
+provider_request = None
+
+_NAMES = {Point.ORDER_CREATED: 'order_created',
+          Point.STATUS_CHANGED: 'status_changed',
+          Point.WORKER_ASSIGNED: 'worker_assigned',
+          Point.PROVIDER_REQUEST: 'provider_request'}
+
+_callbacks = defaultdict(list)  # point - callbacks in registration order
+_lock = threading.Lock()
+
+
+def _fan_out(callbacks: tuple):
+    def fire(*args) -> None:
+        for callback in callbacks:
+            callback(*args)
+    return fire
+
+
+def _nest(outer, inner):
+    # around hooks wrap each other, the first one registered is outermost
+    def wrapped(provider, request, call):
+        return outer(provider, request, lambda each: inner(provider, each, call))
+    return wrapped
+
+
+def _bind(point: Point) -> None:
+    callbacks = _callbacks.get(point)
+    if not callbacks:
+        bound = None
+    elif len(callbacks) == 1:
+        bound = callbacks[0]
+    elif point == Point.PROVIDER_REQUEST:
+        bound = callbacks[-1]
+        for callback in reversed(callbacks[:-1]):
+            bound = _nest(callback, bound)
+    else:
+        bound = _fan_out(tuple(callbacks))
+    globals()[_NAMES[point]] = bound
+
+
+def register(point: Point, callback):
+    # returns the callback, which is what unregister takes
+    with _lock:
+        _callbacks[point].append(callback)
+        _bind(point)
+    return callback
+
+
+def unregister(point: Point, callback) -> None:
+    with _lock:
+        if callback in _callbacks[point]:
+            _callbacks[point].remove(callback)
+            _bind(point)
+
+
+def clear() -> None:
+    with _lock:
+        _callbacks.clear()
+        for point in Point:
+            _bind(point)
+
+
+class Hook:
+    # a set of callbacks registered and unregistered together
+    __slots__ = []
+
+    def points(self) -> dict:
+        return dict()  # point - callback
+
+    def install(self):
+        for [point, callback] in self.points().items():
+            register(point, callback)
+        return self
+
+    def uninstall(self) -> None:
+        for [point, callback] in self.points().items():
+            unregister(point, callback)
+
+    def __enter__(self):
+        return self.install()
+
+    def __exit__(self, *_) -> None:
+        self.uninstall()
+
+
+class ProfileSampler(Hook):
+    # runs cProfile for `window` wall seconds out of every `every`, so the overhead stays near window / every
+    # however long the run; hook calls are the ticks that switch it on and off, stats of all windows add up in
+    # one profile. cProfile follows the thread that enabled it, so windows cover the thread orders are processed on
+    __slots__ = ['_window',
+                 '_every',
+                 '_profile',
+                 '_running',
+                 '_switch_at',
+                 '_bound']
+
+    def __init__(self, window: float = 0.01, every: float = 1.0):
+        self._window = window
+        self._every = max(every, window)
+        self._profile = cProfile.Profile()
+        self._running = False
+        self._switch_at = perf_counter()  # when the profiler is turned on or off next
+        self._bound = {Point.ORDER_CREATED: self._tick,
+                       Point.STATUS_CHANGED: self._tick,
+                       Point.WORKER_ASSIGNED: self._tick}
+
+    def points(self) -> dict:
+        return self._bound
+
+    def _tick(self, *_) -> None:
+        now = perf_counter()
+        if now < self._switch_at:
+            return
+
+        if self._running:
+            self._profile.disable()
+            self._running = False
+            self._switch_at = now + self._every - self._window
+        else:
+            try:
+                self._profile.enable()
+            except ValueError:  # another profiler is active - this window is skipped
+                self._switch_at = now + self._every
+                return
+            self._running = True
+            self._switch_at = now + self._window
+
+    def uninstall(self) -> None:
+        super().uninstall()
+        if self._running:
+            self._profile.disable()
+        self._running = False
+
+    def stats(self, sort: str = 'cumulative') -> pstats.Stats:
+        return pstats.Stats(self._profile).sort_stats(sort)
+
+    def dump(self, path: str) -> None:
+        self._profile.dump_stats(path)
+
+
+class StageTimer(Hook):
+    # wall time orders spend in each stage, as opposed to the clock time metrics report; in a simulation this
+    # is what processing a stage actually costs. provider requests are timed as a stage of their own.
+    # histograms are kept in microseconds, metrics' buckets start at a thousandth of a unit
+    __slots__ = ['_entered',
+                 '_stages',
+                 '_bound']
+
+    def __init__(self):
+        self._entered = dict()  # order_id - perf_counter at its last status change
+        self._stages = defaultdict(Histogram)  # stage - wall microseconds
+        self._bound = {Point.ORDER_CREATED: self._order_created,
+                       Point.STATUS_CHANGED: self._status_changed,
+                       Point.PROVIDER_REQUEST: self._provider_request}
+
+    def points(self) -> dict:
+        return self._bound
+
+    def _order_created(self, store, order) -> None:
+        self._entered[order.order_id] = perf_counter()
+
+    def _status_changed(self, order, previous) -> None:
+        entered = self._entered.get(order.order_id)
+        if entered is None:  # created before the timer was installed
+            return
+        now = perf_counter()
+        self._stages[STAGE_OF_STATUS.get(previous.name, previous.name.lower())].record((now - entered) * 1e6)
+        if order.order_status.name in STAGE_OF_STATUS:
+            self._entered[order.order_id] = now
+        else:
+            del self._entered[order.order_id]
+
+    def _provider_request(self, provider, request, call):
+        started = perf_counter()
+        try:
+            return call(request)
+        finally:
+            self._stages['provider_request'].record((perf_counter() - started) * 1e6)
+
+    def report(self) -> dict:
+        # stage - count, total and quantiles of wall microseconds
+        return {stage: dict(count=histogram.count, total=histogram.sum, max=histogram.max,
+                            **{'p{0:g}'.format(quantile * 100): histogram.quantile(quantile)
+                               for quantile in QUANTILES})
+                for [stage, histogram] in self._stages.items()}
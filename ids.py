@@ -0,0 +1,71 @@
+import itertools
+import uuid
+
+
+class IdRegistry:
+    # entities are keyed by small int handles inside, uuids only exist for ids that crossed the api
+    __slots__ = ['_handles',
+                 '_uuids',
+                 '_counter']
+
+    def __init__(self):
+        self._handles = dict()  # uuid - handle
+        self._uuids = dict()  # handle - uuid, only for handles that were given out as uuids
+        self._counter = itertools.count(1)  # next() is atomic, so threads never share a handle
+
+    def __len__(self) -> int:
+        return len(self._uuids)
+
+    def new(self) -> int:
+        return next(self._counter)
+
+    def intern(self, key) -> int:
+        # uuids get one handle for good, handles and None pass through
+        if key is None or isinstance(key, int):
+            return key
+
+        handle = self._handles.get(key)
+        if handle is None:
+            handle = self._handles.setdefault(key, next(self._counter))
+            self._uuids.setdefault(handle, key)
+        return handle
+
+    def find(self, key) -> int:
+        # like intern, but unknown uuids stay unknown
+        if key is None or isinstance(key, int):
+            return key
+        return self._handles.get(key)
+
+    def uuid_of(self, handle: int) -> uuid.UUID:
+        # the uuid a handle came from or was given out as, None if it never had one
+        return self._uuids.get(handle)
+
+    def external(self, handle: int) -> uuid.UUID:
+        external = self._uuids.get(handle)
+        if external is None:
+            external = self._uuids.setdefault(handle, uuid.uuid1())
+            self._handles.setdefault(external, handle)
+        return external
+
+
+_registry = IdRegistry()
+
+
+def get_registry() -> IdRegistry:
+    return _registry
+
+
+def new() -> int:
+    return _registry.new()
+
+
+def intern(key) -> int:
+    return _registry.intern(key)
+
+
+def find(key) -> int:
+    return _registry.find(key)
+
+
+def external(handle: int) -> uuid.UUID:
+    return _registry.external(handle)
@@ -0,0 +1,180 @@
+from array import array
+
+import threading
+
+try:
+    import numpy
+except ImportError:  # plain array vectors hold the same data, checks just loop in python
+    numpy = None
+
+CAPACITY = 64  # initial vector length, doubled whenever it fills up
+
+
+class SkuIndex:
+    # key - position, the same in every inventory built on the index, so a catalogue many stores or providers
+    # hold is indexed once instead of once per holder
+    __slots__ = ['_positions',
+                 '_keys',
+                 '_lock']
+
+    def __init__(self):
+        self._positions = dict()  # key - position
+        self._keys = []  # position - key
+        self._lock = threading.Lock()  # holders of one index lock their own inventories, not each other's
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def find(self, key) -> int:
+        return self._positions.get(key)
+
+    def key(self, position: int):
+        return self._keys[position]
+
+    def position(self, key) -> int:
+        position = self._positions.get(key)
+        if position is None:
+            with self._lock:
+                position = self._positions.get(key)
+                if position is None:
+                    position = len(self._keys)
+                    self._keys.append(key)  # before the position is published, so key() never misses it
+                    self._positions[key] = position
+        return position
+
+
+class Inventory:
+    # item amounts in one dense vector at the positions of a sku index, plus a flag per position for the keys
+    # this inventory holds. a held sku costs 9 bytes next to the shared index entry; the vectors span the
+    # index up to the highest position held, so inventories sharing an index should hold most of its keys
+    __slots__ = ['_skus',
+                 '_amounts',
+                 '_known',
+                 '_size']
+
+    def __init__(self, skus: SkuIndex = None, capacity: int = CAPACITY):
+        self._skus = skus if skus is not None else SkuIndex()
+        if numpy is not None:
+            self._amounts = numpy.zeros(capacity, dtype=numpy.int64)
+            self._known = numpy.zeros(capacity, dtype=numpy.bool_)
+        else:
+            self._amounts = array('q')
+            self._known = bytearray()
+        self._size = 0  # keys held
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __contains__(self, key) -> bool:
+        position = self._skus.find(key)
+        return position is not None and position < len(self._known) and bool(self._known[position])
+
+    def __getitem__(self, key) -> int:
+        # positions this inventory does not hold are zero
+        position = self._skus.find(key)
+        return int(self._amounts[position]) if position is not None and position < len(self._amounts) else 0
+
+    def __setitem__(self, key, amount: int) -> None:
+        position = self.position(key)  # may grow the vector, so it goes before the lookup
+        self._amounts[position] = amount
+
+    def get(self, key, default: int = None) -> int:
+        return self[key] if key in self else default
+
+    def _held_positions(self) -> list:
+        if numpy is not None:
+            return numpy.flatnonzero(self._known).tolist()
+        return [position for [position, known] in enumerate(self._known) if known]
+
+    def keys(self) -> list:
+        return [self._skus.key(position) for position in self._held_positions()]
+
+    def values(self) -> list:
+        return [int(self._amounts[position]) for position in self._held_positions()]
+
+    def items(self) -> list:
+        return [(self._skus.key(position), int(self._amounts[position])) for position in self._held_positions()]
+
+    @property
+    def nbytes(self) -> int:
+        if numpy is not None:
+            return self._amounts.nbytes + self._known.nbytes
+        return self._amounts.itemsize * len(self._amounts) + len(self._known)
+
+    def _grow(self, position: int) -> None:
+        if numpy is not None:
+            extra = max(position + 1, 2 * len(self._amounts)) - len(self._amounts)
+            self._amounts = numpy.concatenate((self._amounts, numpy.zeros(extra, dtype=numpy.int64)))
+            self._known = numpy.concatenate((self._known, numpy.zeros(extra, dtype=numpy.bool_)))
+        else:
+            extra = position + 1 - len(self._amounts)
+            self._amounts.frombytes(bytes(self._amounts.itemsize * extra))
+            self._known.extend(bytes(extra))
+
+    def position(self, key) -> int:
+        # takes the key into this inventory, may grow the vectors
+        position = self._skus.position(key)
+        if position >= len(self._amounts):
+            self._grow(position)
+        if not self._known[position]:
+            self._known[position] = 1
+            self._size += 1
+        return position
+
+    def _gather(self, keys) -> tuple:
+        # positions within the vectors and where they sit in the request, the rest hold nothing;
+        # one index lookup per key, the comparisons after it run over whole vectors
+        positions = []
+        found = []
+        length = len(self._amounts)
+        for [offset, key] in enumerate(keys):
+            position = self._skus.find(key)
+            if position is not None and position < length:
+                positions.append(position)
+                found.append(offset)
+        return positions, found
+
+    def _have(self, keys: list):
+        # amounts held for keys, as a vector when numpy is there
+        [positions, found] = self._gather(keys)
+        if numpy is not None:
+            have = numpy.zeros(len(keys), dtype=numpy.int64)
+            have[found] = self._amounts[positions]
+            return have
+
+        have = [0] * len(keys)
+        for [offset, position] in zip(found, positions):
+            have[offset] = self._amounts[position]
+        return have
+
+    def amounts(self, keys: list) -> list:
+        have = self._have(keys)
+        return have.tolist() if numpy is not None else have
+
+    def covers(self, keys: list, amounts: list) -> bool:
+        if numpy is not None:
+            return bool((self._have(keys) >= numpy.asarray(amounts, dtype=numpy.int64)).all())
+        return all(have >= need for [have, need] in zip(self._have(keys), amounts))
+
+    def shortfall(self, keys: list, amounts: list) -> dict:
+        # key - amount missing to cover the request
+        if numpy is not None:
+            missing = numpy.asarray(amounts, dtype=numpy.int64) - self._have(keys)
+            return {keys[offset]: int(missing[offset]) for offset in numpy.flatnonzero(missing > 0).tolist()}
+        return {key: need - have for [key, need, have] in zip(keys, amounts, self._have(keys)) if need > have}
+
+    def add(self, keys: list, amounts: list) -> None:
+        positions = [self.position(key) for key in keys]
+        if numpy is not None:
+            numpy.add.at(self._amounts, positions, numpy.asarray(amounts, dtype=numpy.int64))
+        else:
+            for [position, amount] in zip(positions, amounts):
+                self._amounts[position] += amount
+
+    def take(self, keys: list, amounts: list) -> bool:
+        # all or nothing - amounts are taken only when every key covers its share
+        if not self.covers(keys, amounts):
+            return False
+
+        self.add(keys, [-amount for amount in amounts])
+        return True
@@ -0,0 +1,336 @@
+from contextlib import contextmanager
+
+import atexit
+import enum
+import os
+import pickle
+import struct
+import threading
+import zlib
+
+import ids
+
+BATCH_SIZE = 512  # records written and fsynced together
+SNAPSHOT_EVERY = 200000  # records between automatic snapshots, the log is cut after each one
+
+MAGIC = b'TSWL'
+
+
+class Record(enum.IntEnum):
+    NAME = 1
+    ORDER = 2
+    STATUS = 3
+    WORKER = 4
+    STOCK = 5
+    BALANCE = 6
+
+
+HEADER = struct.Struct('<4sQ')  # magic, generation
+RECORD = struct.Struct('<BH')  # record type, payload length
+NAME = struct.Struct('<q16s')  # handle, uuid bytes
+ORDER = struct.Struct('<qqqdddH')  # order, store, client, x, y, creation time, number of items
+ORDER_ITEM = struct.Struct('<qH')  # amount, name length, the name follows
+STATUS = struct.Struct('<qB')  # order, status
+WORKER = struct.Struct('<qqB')  # order, worker or 0, 1 for a courier and 0 for a storekeeper
+STOCK = struct.Struct('<qqq')  # store or provider, item, amount change
+BALANCE = struct.Struct('<qd')  # worker, balance
+
+
+def snapshot_path(path: str) -> str:
+    return path + '.snapshot'
+
+
+def read_generation(path: str) -> int:
+    try:
+        with open(path, 'rb') as file:
+            header = file.read(HEADER.size)
+    except FileNotFoundError:
+        return 0
+    if len(header) < HEADER.size or header[:4] != MAGIC:
+        return 0
+    return HEADER.unpack(header)[1]
+
+
+def read_snapshot(path: str) -> dict:
+    try:
+        with open(snapshot_path(path), 'rb') as file:
+            return pickle.loads(zlib.decompress(file.read()))
+    except FileNotFoundError:
+        return None
+
+
+class Journal:
+    # append only binary log of order transitions, stock and balance changes
+    __slots__ = ['_path',
+                 '_file',
+                 '_generation',
+                 '_buffer',
+                 '_pending',
+                 '_batch_size',
+                 '_snapshot_every',
+                 '_since_snapshot',
+                 '_operations',
+                 '_snapshot_due',
+                 '_names',
+                 '_stores',
+                 '_providers',
+                 '_workers',
+                 '_lock']
+
+    def __init__(self, path: str, stores=(), providers=(), workers=(),
+                 batch_size: int = BATCH_SIZE, snapshot_every: int = SNAPSHOT_EVERY):
+        self._path = path
+        self._file = None
+        self._buffer = bytearray()
+        self._pending = 0  # records in the buffer
+        self._batch_size = max(1, batch_size)
+        self._snapshot_every = snapshot_every
+        self._since_snapshot = 0
+        self._operations = 0  # changes being made and journaled, a snapshot waits for all of them
+        self._snapshot_due = False
+        self._names = dict()  # handle - uuid, None for handles that never had one
+        self._stores = list(stores)
+        self._providers = list(providers)
+        self._workers = list(workers)
+        self._lock = threading.Lock()
+
+        # whatever is on disk already is part of the state we were given, so it is folded into a snapshot
+        snapshot = read_snapshot(path)
+        self._generation = max(snapshot['generation'] if snapshot is not None else 0, read_generation(path))
+        with self._lock:
+            self._snapshot()
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def _name(self, handle) -> int:
+        if not handle:
+            return 0
+        if handle not in self._names:
+            self._names[handle] = ids.get_registry().uuid_of(handle)
+            if self._names[handle] is not None:
+                self._append(Record.NAME, NAME.pack(handle, self._names[handle].bytes))
+        return handle
+
+    def _append(self, record: Record, payload: bytes) -> None:
+        self._buffer += RECORD.pack(record, len(payload))
+        self._buffer += payload
+        self._pending += 1
+        if self._pending >= self._batch_size:
+            self._flush()
+
+    def _write(self) -> None:
+        if self._buffer:
+            self._file.write(self._buffer)
+            self._file.flush()
+            os.fsync(self._file.fileno())  # one fsync for the whole batch
+            self._since_snapshot += self._pending
+            self._buffer = bytearray()
+            self._pending = 0
+
+    def _flush(self) -> None:
+        self._write()
+        if self._snapshot_every and self._since_snapshot >= self._snapshot_every:
+            if self._operations:  # state is ahead of the log until the operation journals the rest
+                self._snapshot_due = True
+            else:
+                self._snapshot()
+
+    def begin(self) -> None:
+        # a change to several keys that is journaled one record per key after it was made
+        with self._lock:
+            self._operations += 1
+
+    def end(self) -> None:
+        with self._lock:
+            self._operations -= 1
+            if not self._operations and self._snapshot_due:
+                self._snapshot()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    def order_created(self, store_id: int, order) -> None:
+        items = b''.join(ORDER_ITEM.pack(amount, len(name.encode())) + name.encode()
+                         for [name, amount] in order.items.items())
+        with self._lock:
+            payload = ORDER.pack(order.order_id, self._name(store_id), self._name(order.client_id),
+                                 order.x, order.y, order.creation_time, len(order.items)) + items
+            self._append(Record.ORDER, payload)
+            self._append(Record.STATUS, STATUS.pack(order.order_id, order.order_status.value))
+
+    def status_changed(self, order_id: int, status) -> None:
+        with self._lock:
+            self._append(Record.STATUS, STATUS.pack(order_id, status.value))
+
+    def worker_assigned(self, order_id: int, worker_id: int, courier: bool) -> None:
+        with self._lock:
+            self._append(Record.WORKER, WORKER.pack(order_id, self._name(worker_id), courier))
+
+    def stock_changed(self, owner_id: int, key: int, amount: int) -> None:
+        with self._lock:
+            self._append(Record.STOCK, STOCK.pack(self._name(owner_id), self._name(key), amount))
+
+    def balance_changed(self, worker_id: int, balance: float) -> None:
+        with self._lock:
+            self._append(Record.BALANCE, BALANCE.pack(self._name(worker_id), balance))
+
+    def track(self, stores=(), providers=(), workers=()) -> None:
+        with self._lock:
+            self._stores.extend(stores)
+            self._providers.extend(providers)
+            self._workers.extend(workers)
+
+    def snapshot(self) -> None:
+        # waits for operations in flight, so no change is in the state and again in the log after it
+        with self._lock:
+            if self._operations:
+                self._snapshot_due = True
+            else:
+                self._snapshot()
+
+    def _state(self) -> dict:
+        names = dict()
+        registry = ids.get_registry()
+
+        def name(handle) -> int:
+            if handle and handle not in names:
+                names[handle] = registry.uuid_of(handle)
+            return handle or 0
+
+        stores = dict()
+        for store in self._stores:
+            orders = [(order.order_id, name(order.client_id), order.x, order.y, order.creation_time,
+                       order.estimated_delivery_time, order.order_status.value, dict(order.items),
+                       name(order.storekeeper_id), name(order.courier_id)) for order in store.orders()]
+            stores[name(store.store_id)] = ([(name(key), amount) for [key, amount] in store.items_amount.items()],
+                                            orders)
+
+        providers = {name(provider.provider_id): [(name(key), amount)
+                                                  for [key, amount] in provider.items_amount.items()]
+                     for provider in self._providers}
+        workers = {name(worker.worker_id): worker.balance for worker in self._workers}
+
+        return {'generation': self._generation,
+                'names': {handle: external.bytes for [handle, external] in names.items() if external is not None},
+                'stores': stores,
+                'providers': providers,
+                'workers': workers}
+
+    def _snapshot(self) -> None:
+        # the snapshot covers every log up to its generation, the log after it starts a new one
+        if self._file is not None:
+            self._write()
+
+        temporary = snapshot_path(self._path) + '.tmp'
+        with open(temporary, 'wb') as file:
+            file.write(zlib.compress(pickle.dumps(self._state(), pickle.HIGHEST_PROTOCOL)))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, snapshot_path(self._path))
+
+        if self._file is not None:
+            self._file.close()
+        self._generation += 1
+        self._file = open(self._path, 'wb')
+        self._file.write(HEADER.pack(MAGIC, self._generation))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+        self._names = dict()  # handles are named again the first time the new log mentions them
+        self._since_snapshot = 0
+        self._snapshot_due = False
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is None:
+                return
+            self._write()
+            self._file.close()
+            self._file = None
+
+
+_journal = None
+
+
+def get_journal() -> Journal:
+    return _journal
+
+
+def configure(path: str, stores=(), providers=(), workers=(),
+              batch_size: int = BATCH_SIZE, snapshot_every: int = SNAPSHOT_EVERY) -> Journal:
+    # recover the state first - opening a journal snapshots what it is given and starts a fresh log
+    global _journal
+    close()
+    _journal = Journal(path, stores, providers, workers, batch_size, snapshot_every)
+    atexit.register(_journal.close)
+    return _journal
+
+
+def set_journal(sink) -> Journal:
+    # anything with the Journal hook methods can listen in, returns the one it replaced
+    global _journal
+    [previous, _journal] = [_journal, sink]
+    return previous
+
+
+def close() -> None:
+    global _journal
+    if _journal is not None:
+        _journal.close()
+        atexit.unregister(_journal.close)
+        _journal = None
+
+
+@contextmanager
+def paused():
+    # replayed changes must not be written again
+    global _journal
+    [journal, _journal] = [_journal, None]
+    try:
+        yield
+    finally:
+        _journal = journal
+
+
+def begin() -> Journal:
+    # returns the journal to end the operation on, the hook slot may be swapped meanwhile
+    if _journal is not None:
+        _journal.begin()
+    return _journal
+
+
+def end(sink) -> None:
+    if sink is not None:
+        sink.end()
+
+
+def order_created(store_id: int, order) -> None:
+    if _journal is not None:
+        _journal.order_created(store_id, order)
+
+
+def status_changed(order_id: int, status) -> None:
+    if _journal is not None:
+        _journal.status_changed(order_id, status)
+
+
+def worker_assigned(order_id: int, worker_id: int, courier: bool) -> None:
+    if _journal is not None:
+        _journal.worker_assigned(order_id, worker_id, courier)
+
+
+def stock_changed(owner_id: int, key: int, amount: int) -> None:
+    if _journal is not None and amount:
+        _journal.stock_changed(owner_id, key, amount)
+
+
+def balance_changed(worker_id: int, balance: float) -> None:
+    if _journal is not None:
+        _journal.balance_changed(worker_id, balance)
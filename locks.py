@@ -0,0 +1,49 @@
+from contextlib import contextmanager, nullcontext
+
+import threading
+
+STRIPES = 64  # locks per striped lock, items hash onto them
+
+
+class StripedLock:
+    __slots__ = ['_locks']
+
+    def __init__(self, stripes: int = STRIPES):
+        self._locks = [threading.Lock() for _ in range(stripes)]
+
+    def lock(self, key):
+        return self._locks[hash(key) % len(self._locks)]
+
+    @contextmanager
+    def locked(self, keys):
+        # stripes are always taken in index order, so two multi-item calls cant deadlock
+        locks = [self._locks[index] for index in sorted({hash(key) % len(self._locks) for key in keys})]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def locked_all(self):
+        # every stripe at once, for changes that touch more than one key like growing a vector
+        return self.locked(range(len(self._locks)))
+
+
+class NoLock:
+    __slots__ = []
+
+    _NULL = nullcontext()
+
+    def lock(self, key):
+        return NoLock._NULL
+
+    def locked(self, keys):
+        return NoLock._NULL
+
+    def locked_all(self):
+        return NoLock._NULL
+
+
+NO_LOCK = NoLock()
@@ -0,0 +1,220 @@
+from collections import deque
+
+import atexit
+import enum
+import queue
+import sys
+import threading
+
+import clock
+
+
+class Level(enum.IntEnum):
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
+    OFF = 100
+
+
+class Event:
+    __slots__ = ['time',
+                 'level',
+                 'module',
+                 'message',
+                 'args']
+
+    def __init__(self, time: float, level: Level, module: str, message: str, args: tuple):
+        self.time = time
+        self.level = level
+        self.module = module
+        self.message = message  # str.format template, formatted only when written
+        self.args = args
+
+    def format(self) -> str:
+        return self.message.format(*self.args) if self.args else self.message
+
+
+class StreamSink:
+    __slots__ = ['_stream']
+
+    def __init__(self, stream=None):
+        self._stream = stream
+
+    def write(self, events: list) -> None:
+        stream = self._stream or sys.stdout  # resolved late so redirected stdout is respected
+        stream.write(''.join(event.format() + '\n' for event in events))
+        stream.flush()
+
+
+class FileSink:
+    __slots__ = ['_file']
+
+    def __init__(self, path: str):
+        self._file = open(path, 'a')
+
+    def write(self, events: list) -> None:
+        self._file.write(''.join('{0:.6f} {1} {2}: {3}\n'.format(event.time,
+                                                                 event.level.name,
+                                                                 event.module,
+                                                                 event.format()) for event in events))
+        self._file.flush()
+
+
+class RingBufferSink:
+    __slots__ = ['_events']
+
+    def __init__(self, capacity: int = 10000):
+        self._events = deque(maxlen=capacity)  # raw events, formatted on read
+
+    def write(self, events: list) -> None:
+        self._events.extend(events)
+
+    @property
+    def events(self) -> list:
+        return list(self._events)
+
+    def lines(self) -> list:
+        return [event.format() for event in self._events]
+
+    def clear(self) -> None:
+        self._events.clear()
+
+
+class EventLog:
+    __slots__ = ['_default_level',
+                 '_levels',
+                 '_sink',
+                 '_queue',
+                 '_writer',
+                 '_batch_size']
+
+    _STOP = object()
+
+    def __init__(self, sink=None, level: Level = Level.INFO):
+        self._default_level = level
+        self._levels = dict()  # module - level
+        self._sink = sink if sink is not None else StreamSink()
+        self._queue = None  # set while the background writer is running
+        self._writer = None
+        self._batch_size = 0
+
+    @property
+    def sink(self):
+        return self._sink
+
+    def set_level(self, level: Level, module: str = None) -> None:
+        if module is None:
+            self._default_level = level
+            self._levels.clear()
+        else:
+            self._levels[module] = level
+
+    def levels(self) -> dict:
+        # module - level, None for the default level; set_levels takes it back
+        return {None: self._default_level, **self._levels}
+
+    def set_levels(self, levels: dict) -> None:
+        self._default_level = levels[None]
+        self._levels = {module: level for [module, level] in levels.items() if module is not None}
+
+    def enabled(self, module: str, level: Level) -> bool:
+        return level >= self._levels.get(module, self._default_level)
+
+    def write(self, level: Level, module: str, message: str, args: tuple) -> None:
+        if level < self._levels.get(module, self._default_level):
+            return
+
+        event = Event(clock.now(), level, module, message, args)
+        if self._queue is not None:
+            self._queue.put(event)
+        else:
+            self._sink.write([event])
+
+    def start(self, batch_size: int = 512) -> None:
+        if self._writer is not None:
+            return
+
+        self._batch_size = batch_size
+        self._queue = queue.SimpleQueue()
+        self._writer = threading.Thread(target=self._run, name='event-log-writer', daemon=True)
+        self._writer.start()
+
+    def stop(self) -> None:
+        if self._writer is None:
+            return
+
+        self._queue.put(EventLog._STOP)
+        self._writer.join()
+        self._writer = None
+        self._queue = None
+
+    def _run(self) -> None:
+        events_queue = self._queue
+        running = True
+        while running:
+            batch = []
+            event = events_queue.get()
+            while True:
+                if event is EventLog._STOP:
+                    running = False
+                    break
+                batch.append(event)
+                if len(batch) >= self._batch_size:
+                    break
+                try:
+                    event = events_queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            if batch:
+                self._sink.write(batch)
+
+
+_log = EventLog()
+atexit.register(lambda: _log.stop())
+
+
+def get_log() -> EventLog:
+    return _log
+
+
+def configure(sink=None, level: Level = None, background: bool = False, batch_size: int = 512) -> EventLog:
+    global _log
+    _log.stop()
+    _log = EventLog(sink, level if level is not None else Level.INFO)
+    if background:
+        _log.start(batch_size)
+    return _log
+
+
+def set_level(level: Level, module: str = None) -> None:
+    _log.set_level(level, module)
+
+
+def get_levels() -> dict:
+    return _log.levels()
+
+
+def set_levels(levels: dict) -> None:
+    _log.set_levels(levels)
+
+
+def enabled(module: str, level: Level) -> bool:
+    return _log.enabled(module, level)
+
+
+def debug(module: str, message: str, *args) -> None:
+    _log.write(Level.DEBUG, module, message, args)
+
+
+def info(module: str, message: str, *args) -> None:
+    _log.write(Level.INFO, module, message, args)
+
+
+def warning(module: str, message: str, *args) -> None:
+    _log.write(Level.WARNING, module, message, args)
+
+
+def error(module: str, message: str, *args) -> None:
+    _log.write(Level.ERROR, module, message, args)
@@ -6,6 +6,9 @@ from provider import Provider
 from worker import Courier, Storekeeper
 from store import Store
 from client import Client
+import log
+
+log.set_level(log.Level.DEBUG)  # show every step of the demo
 
 items = {'pen': Item(_name='pen',
                      _price=12,
@@ -0,0 +1,292 @@
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from math import frexp
+
+import json
+import os
+import threading
+
+from backlog import Stage
+import clock
+
+LOWEST = 1e-3  # smallest latency told apart from zero, in clock seconds
+SUB_BUCKETS = 16  # linear buckets per power of two, values are kept within 1/16 of their size
+QUANTILES = [0.5, 0.9, 0.99, 0.999]
+
+STAGE_OF_STATUS = {'NEW': 'sourcing',
+                   'READY_TO_ASSEMBLE': 'assembly',
+                   'ASSEMBLE': 'courier_wait',
+                   'DELIVER': 'delivery'}  # time spent in a status is charged to its stage, order.py imports us
+
+
+class Histogram:
+    # hdr style: log linear buckets, a record is two float ops and a dict increment
+    __slots__ = ['_counts',
+                 '_count',
+                 '_sum',
+                 '_max']
+
+    def __init__(self):
+        self._counts = defaultdict(int)  # bucket - count
+        self._count = 0
+        self._sum = 0.0
+        self._max = 0.0
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    @property
+    def sum(self) -> float:
+        return self._sum
+
+    @property
+    def max(self) -> float:
+        return self._max
+
+    @staticmethod
+    def _bucket(value: float) -> int:
+        if value < LOWEST:
+            return 0
+        [mantissa, exponent] = frexp(value / LOWEST)  # mantissa in [0.5, 1)
+        return 1 + (exponent - 1) * SUB_BUCKETS + int((2 * mantissa - 1) * SUB_BUCKETS)
+
+    @staticmethod
+    def _upper(bucket: int) -> float:
+        if bucket == 0:
+            return LOWEST
+        [exponent, sub_bucket] = divmod(bucket - 1, SUB_BUCKETS)
+        return LOWEST * 2 ** exponent * (1 + (sub_bucket + 1) / SUB_BUCKETS)
+
+    def record(self, value: float) -> None:
+        self._counts[self._bucket(value)] += 1
+        self._count += 1
+        self._sum += value
+        if value > self._max:
+            self._max = value
+
+    def quantile(self, quantile: float) -> float:
+        if not self._count:
+            return 0.0
+        rank = quantile * self._count
+        seen = 0
+        for bucket in sorted(self._counts):
+            seen += self._counts[bucket]
+            if seen >= rank:
+                return min(self._upper(bucket), self._max)
+        return self._max
+
+
+class Metrics:
+    # counters, latency histograms and worker gauges per store, fed by hooks in the order pipeline
+    __slots__ = ['_counters',
+                 '_histograms',
+                 '_orders',
+                 '_workers',
+                 '_busy',
+                 '_lock',
+                 '_server']
+
+    def __init__(self):
+        self._counters = defaultdict(int)  # (name, labels) - value
+        self._histograms = defaultdict(Histogram)  # (store_id, stage) - latencies
+        self._orders = dict()  # order_id - [store_id, status, entered at, created at], in flight only
+        self._workers = dict()  # (store_id, worker_id) - (kind, joined at)
+        self._busy = defaultdict(float)  # (store_id, worker_id) - seconds of work handed out
+        self._lock = threading.Lock()  # hooks may come from several store threads
+        self._server = None
+
+    def order_created(self, store_id: int, order) -> None:
+        with self._lock:
+            self._orders[order.order_id] = [store_id, order.order_status.name, order.creation_time, order.creation_time]
+            self._counters[('orders_created_total', (('store', store_id),))] += 1
+
+    def status_changed(self, order_id: int, status) -> None:
+        with self._lock:
+            state = self._orders.get(order_id)
+            if state is None:
+                return
+
+            [store_id, previous, entered, created] = state
+            status = status.name
+            if status == previous:
+                return
+
+            now = clock.now()
+            if previous in STAGE_OF_STATUS:
+                self._histograms[(store_id, STAGE_OF_STATUS[previous])].record(now - entered)
+            self._counters[('transitions_total', (('store', store_id), ('status', status.lower())))] += 1
+
+            if status == 'COMPLETE':
+                self._histograms[(store_id, 'total')].record(now - created)
+                del self._orders[order_id]
+            else:
+                state[1] = status
+                state[2] = now
+
+    def stalled(self, store_id: int, stage: Stage) -> None:
+        with self._lock:
+            self._counters[('stalls_total', (('store', store_id), ('stage', stage.name.lower())))] += 1
+
+    def worker_added(self, store_id: int, worker_id: int, kind: str) -> None:
+        with self._lock:
+            self._workers.setdefault((store_id, worker_id), (kind, clock.now()))
+
+    def worker_busy(self, store_id: int, worker_id: int, seconds: float) -> None:
+        with self._lock:
+            self._busy[(store_id, worker_id)] += seconds
+
+    def _gauges(self) -> list:
+        # (name, labels, value), worked out when exported so the hot path only counts
+        now = clock.now()
+        workers = defaultdict(int)
+        elapsed = defaultdict(float)
+        busy = defaultdict(float)
+        for [[store_id, worker_id], [kind, joined]] in self._workers.items():
+            workers[(store_id, kind)] += 1
+            elapsed[(store_id, kind)] += max(0.0, now - joined)
+            busy[(store_id, kind)] += min(self._busy[(store_id, worker_id)], max(0.0, now - joined))
+
+        gauges = []
+        for [store_id, kind] in sorted(workers):
+            labels = (('store', store_id), ('kind', kind))
+            gauges.append(('workers', labels, workers[(store_id, kind)]))
+            gauges.append(('worker_busy_seconds', labels, busy[(store_id, kind)]))
+            gauges.append(('worker_utilisation', labels, busy[(store_id, kind)] / elapsed[(store_id, kind)]
+                           if elapsed[(store_id, kind)] else 0.0))
+
+        in_flight = defaultdict(int)
+        for [store_id, status, _, _] in self._orders.values():
+            in_flight[(store_id, status.lower())] += 1
+        for [[store_id, status], count] in sorted(in_flight.items()):
+            gauges.append(('orders_in_flight', (('store', store_id), ('status', status)), count))
+        return gauges
+
+    def json(self) -> dict:
+        with self._lock:
+            return {'time': clock.now(),
+                    'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                                 for [[name, labels], value] in sorted(self._counters.items())],
+                    'gauges': [{'name': name, 'labels': dict(labels), 'value': value}
+                               for [name, labels, value] in self._gauges()],
+                    'latency': [{'labels': {'store': store_id, 'stage': stage}, 'count': histogram.count,
+                                 'sum': histogram.sum, 'max': histogram.max,
+                                 'quantiles': {str(quantile): histogram.quantile(quantile) for quantile in QUANTILES}}
+                                for [[store_id, stage], histogram] in sorted(self._histograms.items())]}
+
+    def prometheus(self) -> str:
+        with self._lock:
+            lines = []
+            names = set()
+
+            def labels_text(labels) -> str:
+                return ','.join('{0}="{1}"'.format(key, value) for [key, value] in labels)
+
+            for [[name, labels], value] in sorted(self._counters.items()):
+                if name not in names:
+                    names.add(name)
+                    lines.append('# TYPE transport_{0} counter'.format(name))
+                lines.append('transport_{0}{{{1}}} {2}'.format(name, labels_text(labels), value))
+
+            for [name, labels, value] in sorted(self._gauges(), key=lambda gauge: gauge[0]):  # one block per name
+                if name not in names:
+                    names.add(name)
+                    lines.append('# TYPE transport_{0} gauge'.format(name))
+                lines.append('transport_{0}{{{1}}} {2}'.format(name, labels_text(labels), value))
+
+            if self._histograms:
+                lines.append('# TYPE transport_stage_latency_seconds summary')
+            for [[store_id, stage], histogram] in sorted(self._histograms.items()):
+                labels = labels_text((('store', store_id), ('stage', stage)))
+                for quantile in QUANTILES:
+                    lines.append('transport_stage_latency_seconds{{{0},quantile="{1}"}} {2}'.format(
+                        labels, quantile, histogram.quantile(quantile)))
+                lines.append('transport_stage_latency_seconds_sum{{{0}}} {1}'.format(labels, histogram.sum))
+                lines.append('transport_stage_latency_seconds_count{{{0}}} {1}'.format(labels, histogram.count))
+
+            return '\n'.join(lines) + '\n'
+
+    def write(self, path: str, fmt: str = 'prometheus') -> None:
+        # written aside and moved in place, so a reader never sees half a file
+        text = self.prometheus() if fmt == 'prometheus' else json.dumps(self.json(), indent=2)
+        with open(path + '.tmp', 'w') as file:
+            file.write(text)
+        os.replace(path + '.tmp', path)
+
+    def serve(self, port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+        # /metrics in prometheus text, /metrics.json as json
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    [body, content_type] = [metrics.prometheus(), 'text/plain; version=0.0.4']
+                elif self.path == '/metrics.json':
+                    [body, content_type] = [json.dumps(metrics.json()), 'application/json']
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.end_headers()
+                self.wfile.write(body.encode())
+
+            def log_message(self, message_format, *args):
+                pass
+
+        self.stop()
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+_metrics = None
+
+
+def get_metrics() -> Metrics:
+    return _metrics
+
+
+def configure() -> Metrics:
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
+
+
+def disable() -> None:
+    global _metrics
+    if _metrics is not None:
+        _metrics.stop()
+    _metrics = None
+
+
+def order_created(store_id: int, order) -> None:
+    if _metrics is not None:
+        _metrics.order_created(store_id, order)
+
+
+def status_changed(order_id: int, status) -> None:
+    if _metrics is not None:
+        _metrics.status_changed(order_id, status)
+
+
+def stalled(store_id: int, stage: Stage) -> None:
+    if _metrics is not None:
+        _metrics.stalled(store_id, stage)
+
+
+def worker_added(store_id: int, worker_id: int, kind: str) -> None:
+    if _metrics is not None:
+        _metrics.worker_added(store_id, worker_id, kind)
+
+
+def worker_busy(store_id: int, worker_id: int, seconds: float) -> None:
+    if _metrics is not None:
+        _metrics.worker_busy(store_id, worker_id, seconds)
@@ -1,9 +1,14 @@
 from dataclasses import dataclass
 
 import enum
-import time
 import uuid
 
+import clock
+import ids
+import journal
+import hooks
+import metrics
+
 
 @dataclass
 class Item:
@@ -19,6 +24,12 @@ class Item:
     _at_provider_id: uuid
     _provider_id: uuid
 
+    def __post_init__(self):
+        # callers hand in uuids, stores and providers key their tables by the interned handles
+        self._at_store_id = ids.intern(self._at_store_id)
+        self._at_provider_id = ids.intern(self._at_provider_id)
+        self._provider_id = ids.intern(self._provider_id)
+
     @property
     def name(self) -> str:
         return self._name
@@ -28,15 +39,15 @@ class Item:
         return self._price
 
     @property
-    def at_provider_id(self) -> uuid:
+    def at_provider_id(self) -> int:
         return self._at_provider_id
 
     @property
-    def at_store_id(self) -> uuid:
+    def at_store_id(self) -> int:
         return self._at_store_id
 
     @property
-    def provider_id(self) -> uuid:
+    def provider_id(self) -> int:
         return self._provider_id
 
 
@@ -59,25 +70,29 @@ class Order:
                  '_y',
                  '_items',
                  '_storekeeper_id',
-                 '_courier_id']
+                 '_courier_id',
+                 '_book']
 
-    _client_id: uuid
-    _order_id: uuid
+    _client_id: int
+    _order_id: int
     _order_status: OrderStatus
     _creation_time: float
     _estimated_delivery_time: float
     _x: int
     _y: int
     _items: dict
-    _storekeeper_id: uuid
-    _courier_id: uuid
+    _storekeeper_id: int
+    _courier_id: int
+
+    def __post_init__(self):
+        self._book = None  # the order book of the store holding the order, told about every transition
 
     @property
-    def client_id(self) -> uuid:
+    def client_id(self) -> int:
         return self._client_id
 
     @property
-    def order_id(self) -> uuid:
+    def order_id(self) -> int:
         return self._order_id
 
     @property
@@ -105,32 +120,54 @@ class Order:
         return self._items
 
     @property
-    def storekeeper_id(self) -> uuid:
+    def storekeeper_id(self) -> int:
         return self._storekeeper_id
 
     @property
-    def courier_id(self) -> uuid:
+    def courier_id(self) -> int:
         return self._courier_id
 
     @order_status.setter
     def order_status(self, value: OrderStatus):
-        self._order_status = value
+        [previous, self._order_status] = [self._order_status, value]
+        journal.status_changed(self._order_id, value)
+        metrics.status_changed(self._order_id, value)
+        if self._book is not None:
+            self._book.status_changed(self, previous)
+        if hooks.status_changed is not None:
+            hooks.status_changed(self, previous)
+
+    @property
+    def book(self):
+        return self._book
+
+    @book.setter
+    def book(self, value) -> None:
+        self._book = value
 
     @creation_time.setter
     def creation_time(self, value: float) -> None:
-        self._creation_time = value
+        [previous, self._creation_time] = [self._creation_time, value]
+        if self._book is not None:
+            self._book.time_changed(self, previous)
 
     @estimated_delivery_time.setter
     def estimated_delivery_time(self, value: float) -> None:
         self._estimated_delivery_time = value
 
     @storekeeper_id.setter
-    def storekeeper_id(self, value: uuid) -> None:
-        self._storekeeper_id = value
+    def storekeeper_id(self, value: int) -> None:
+        [previous, self._storekeeper_id] = [self._storekeeper_id, value]
+        journal.worker_assigned(self._order_id, value, False)
+        if self._book is not None:
+            self._book.worker_changed(self, previous, False)
 
     @courier_id.setter
-    def courier_id(self, value: uuid) -> None:
-        self._courier_id = value
+    def courier_id(self, value: int) -> None:
+        [previous, self._courier_id] = [self._courier_id, value]
+        journal.worker_assigned(self._order_id, value, True)
+        if self._book is not None:
+            self._book.worker_changed(self, previous, True)
 
     def __getitem__(self, item_id: str) -> int:
         if item_id in self._items:
@@ -142,4 +179,4 @@ class Order:
         self._items[item_id] = amount
 
     def check_time(self) -> bool:
-        return self._estimated_delivery_time <= time.time()
+        return self._estimated_delivery_time <= clock.now()
@@ -0,0 +1,190 @@
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+
+from archive import Archive, Retention
+from order import Order, OrderStatus
+import clock
+
+LIVE_STATUSES = [OrderStatus.NEW, OrderStatus.READY_TO_ASSEMBLE, OrderStatus.ASSEMBLE, OrderStatus.DELIVER]
+
+
+class OrderBook:
+    # live orders of one store by id, finished orders are moved to the archive;
+    # secondary indexes cover live orders and the archived ones still held in memory
+    __slots__ = ['_orders',
+                 '_archive',
+                 '_by_status',
+                 '_by_client',
+                 '_by_storekeeper',
+                 '_by_courier',
+                 '_created',
+                 '_times',
+                 '_time_ids',
+                 '_stale']
+
+    def __init__(self, retention: Retention = None):
+        self._orders = dict()  # order_id - order, live only
+        self._archive = Archive(retention)
+        self._by_status = defaultdict(set)  # status - order ids
+        self._by_client = defaultdict(set)  # client_id - order ids
+        self._by_storekeeper = defaultdict(set)  # storekeeper_id - order ids
+        self._by_courier = defaultdict(set)  # courier_id - order ids
+        self._created = dict()  # order_id - creation time, every indexed order
+        self._times = []  # creation times, sorted
+        self._time_ids = []  # order ids alongside _times, entries of dropped or moved orders are left stale
+        self._stale = 0
+
+    def __len__(self) -> int:
+        return len(self._orders)
+
+    def __contains__(self, order_id: int) -> bool:
+        return order_id in self._orders
+
+    def __getitem__(self, order_id: int) -> Order:
+        return self._orders[order_id]
+
+    def get(self, order_id: int) -> Order:
+        return self._orders.get(order_id)
+
+    def keys(self):
+        return self._orders.keys()
+
+    def values(self):
+        return self._orders.values()
+
+    @property
+    def archive(self) -> Archive:
+        return self._archive
+
+    def set_retention(self, retention: Retention) -> None:
+        self._archive.set_retention(retention)
+        self._dropped(self._archive.evict(clock.now()))
+
+    def find(self, order_id: int) -> Order:
+        # live or archived, archived orders come back as detached copies
+        order = self._orders.get(order_id)
+        return order if order is not None else self._archive.get(order_id)
+
+    def with_status(self, status: OrderStatus) -> set:
+        return self._by_status.get(status, set())
+
+    def clients(self) -> list:
+        # clients with indexed orders
+        return list(self._by_client)
+
+    def add(self, order: Order) -> None:
+        self._orders[order.order_id] = order
+        order.book = self
+        self._index(order.order_id, order.client_id, order.storekeeper_id, order.courier_id,
+                    order.creation_time, order.order_status)
+        if order.order_status not in LIVE_STATUSES:
+            self._finish(order)
+
+    def status_changed(self, order: Order, previous: OrderStatus) -> None:
+        self._move(self._by_status, order.order_id, previous, order.order_status)
+        if order.order_status not in LIVE_STATUSES:
+            self._finish(order)
+
+    def worker_changed(self, order: Order, previous: int, courier: bool) -> None:
+        if courier:
+            self._move(self._by_courier, order.order_id, previous, order.courier_id)
+        else:
+            self._move(self._by_storekeeper, order.order_id, previous, order.storekeeper_id)
+
+    def time_changed(self, order: Order, previous: float) -> None:
+        self._stale += 1
+        self._add_time(order.order_id, order.creation_time)
+
+    def _finish(self, order: Order) -> None:
+        del self._orders[order.order_id]
+        order.book = None
+        self._dropped(self._archive.add(order, clock.now()))
+
+    @staticmethod
+    def _move(index: dict, order_id: int, previous, value) -> None:
+        if previous:
+            index[previous].discard(order_id)
+            if not index[previous]:
+                del index[previous]
+        if value:
+            index[value].add(order_id)
+
+    def _index(self, order_id: int, client_id: int, storekeeper_id: int, courier_id: int, creation_time: float,
+               status: OrderStatus) -> None:
+        self._move(self._by_status, order_id, None, status)
+        self._move(self._by_client, order_id, None, client_id)
+        self._move(self._by_storekeeper, order_id, None, storekeeper_id)
+        self._move(self._by_courier, order_id, None, courier_id)
+        self._add_time(order_id, creation_time)
+
+    def _add_time(self, order_id: int, creation_time: float) -> None:
+        self._created[order_id] = creation_time
+        if not self._times or creation_time >= self._times[-1]:  # orders mostly come in clock order
+            self._times.append(creation_time)
+            self._time_ids.append(order_id)
+        else:
+            position = bisect_right(self._times, creation_time)
+            self._times.insert(position, creation_time)
+            self._time_ids.insert(position, order_id)
+
+    def _dropped(self, evicted: list) -> None:
+        for [order_id, client_id, storekeeper_id, courier_id, _, status] in evicted:
+            self._move(self._by_status, order_id, status, None)
+            self._move(self._by_client, order_id, client_id, None)
+            self._move(self._by_storekeeper, order_id, storekeeper_id, None)
+            self._move(self._by_courier, order_id, courier_id, None)
+            del self._created[order_id]
+            self._stale += 1
+
+        if self._stale > len(self._times) // 2:  # stale time entries are swept once they are half the index
+            kept = [[time, order_id] for [time, order_id] in zip(self._times, self._time_ids)
+                    if self._created.get(order_id) == time]
+            self._times = [time for [time, _] in kept]
+            self._time_ids = [order_id for [_, order_id] in kept]
+            self._stale = 0
+
+    @staticmethod
+    def _matches(order_id: int, candidates: list, statuses: list) -> bool:
+        return (all(order_id in candidate for candidate in candidates) and
+                (statuses is None or any(order_id in each for each in statuses)))
+
+    def query(self, status=None, client_id: int = None, storekeeper_id: int = None, courier_id: int = None,
+              since: float = None, until: float = None) -> list:
+        # orders matching every given filter, oldest first; status is one status or a collection of them,
+        # the window is since <= creation time < until. the smallest index is walked and the others are probed,
+        # so the cost follows the narrowest filter rather than the number of orders. the status sets are never
+        # merged, an order is probed against each of them
+        candidates = []
+        for [index, key] in [[self._by_client, client_id],
+                             [self._by_storekeeper, storekeeper_id],
+                             [self._by_courier, courier_id]]:
+            if key is not None:
+                candidates.append(index.get(key, set()))
+
+        statuses = None  # sets an order has to be in one of
+        in_status = float('inf')
+        if status is not None:
+            statuses = [self._by_status[each] for each in ([status] if isinstance(status, OrderStatus) else status)
+                        if each in self._by_status]
+            in_status = sum(len(each) for each in statuses)
+
+        start = 0 if since is None else bisect_left(self._times, since)
+        finish = len(self._times) if until is None else bisect_left(self._times, until)
+        candidates.sort(key=len)
+        smallest = len(candidates[0]) if candidates else float('inf')
+
+        if finish - start <= min(smallest, in_status):  # the time window is the narrowest
+            result = [order_id for [time, order_id] in zip(self._times[start:finish], self._time_ids[start:finish])
+                      if self._created.get(order_id) == time and self._matches(order_id, candidates, statuses)]
+        else:
+            if in_status < smallest:  # the statuses asked for are the smallest index
+                [walked, others, statuses] = [[order_id for each in statuses for order_id in each], candidates, None]
+            else:
+                [walked, others] = [candidates[0], candidates[1:]]
+            result = sorted((order_id for order_id in walked
+                             if (since is None or self._created[order_id] >= since) and
+                             (until is None or self._created[order_id] < until) and
+                             self._matches(order_id, others, statuses)),
+                            key=lambda order_id: (self._created[order_id], order_id))
+
+        return [self.find(order_id) for order_id in result]
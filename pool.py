@@ -0,0 +1,66 @@
+import heapq
+import itertools
+
+from worker import Worker
+
+
+class WorkerPool:
+    __slots__ = ['_store_id',
+                 '_workers',
+                 '_queue',
+                 '_sequence']
+
+    def __init__(self, store_id: int):
+        self._store_id = store_id
+        self._workers = dict()  # worker_id - worker, only workers with a live queue entry
+        self._queue = []  # heap of (work_finish_time, sequence, worker_id)
+        self._sequence = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._workers)
+
+    def __contains__(self, worker_id: int) -> bool:
+        return worker_id in self._workers
+
+    def add(self, worker: Worker) -> None:
+        if worker.worker_id not in self._workers:
+            self.release(worker)
+
+    def release(self, worker: Worker) -> None:
+        self._workers[worker.worker_id] = worker
+        heapq.heappush(self._queue, (worker.work_finish_time, next(self._sequence), worker.worker_id))
+
+    def discard(self, worker_id: int) -> None:
+        self._workers.pop(worker_id, None)  # queue entry is dropped lazily
+
+    def _top(self, now: float):
+        while self._queue:
+            work_finish_time, _, worker_id = self._queue[0]
+            worker = self._workers.get(worker_id)
+
+            if worker is None:
+                heapq.heappop(self._queue)
+            elif worker.shift_finish_time(self._store_id) < now:
+                heapq.heappop(self._queue)
+                del self._workers[worker_id]
+            elif work_finish_time != worker.work_finish_time:  # worker took an order at another store
+                heapq.heapreplace(self._queue, (worker.work_finish_time, next(self._sequence), worker_id))
+            else:
+                return worker
+
+        return None
+
+    def acquire(self, now: float):
+        worker = self._top(now)
+        if worker is None or self.next_free_time(now) > now:
+            return None
+
+        heapq.heappop(self._queue)
+        del self._workers[worker.worker_id]
+        return worker
+
+    def next_free_time(self, now: float) -> float:
+        worker = self._top(now)
+        if worker is None or worker.order is not None:  # its finish event has not fired yet, it wakes the store
+            return float('inf')
+        return worker.work_finish_time
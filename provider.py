@@ -1,80 +1,301 @@
-from collections import defaultdict
+from collections import defaultdict, deque
+from contextlib import nullcontext
+from inventory import Inventory, SkuIndex
 from order import Item
+from locks import StripedLock, NO_LOCK
 
+import heapq
+import itertools
+import threading
 import uuid
 
+import clock
+import hooks
+import ids
+import journal
+import log
+
+HOLD_TTL = 30.0  # clock seconds a reservation is kept before its stock is reclaimed
+CHANGE_LOG = 4096  # recent stock changes kept for caches to catch up on, a cache further behind reads everything
+SKUS = SkuIndex()  # at_provider_id positions, shared by the stock and hold inventories of every provider
+
+
+class Hold:
+    # stock set aside for one store until it commits or the hold expires
+    __slots__ = ['hold_id',
+                 'provider',
+                 'request',
+                 'keys',
+                 'expires']
+
+    def __init__(self, hold_id: int, provider, request: dict, keys: list, expires: float):
+        self.hold_id = hold_id
+        self.provider = provider
+        self.request = request  # at_store_id - amount
+        self.keys = keys  # at_provider_ids in request order
+        self.expires = expires
+
 
 class Provider:
     __slots__ = ['_provider_id',
                  '_items_at_provider_id',
                  '_items_unique',
-                 '_items_amount']
+                 '_items_amount',
+                 '_stores',
+                 '_locks',
+                 '_held',
+                 '_versions',
+                 '_holds',
+                 '_expiry',
+                 '_hold_ids',
+                 '_holds_lock',
+                 '_change_log',
+                 '_last_change',
+                 '_changes_lock']
 
-    def __init__(self, provider_id: uuid):
-        self._provider_id = provider_id
+    def __init__(self, provider_id: uuid, thread_safe: bool = False):
+        self._provider_id = ids.intern(provider_id)
 
-        self._items_at_provider_id = defaultdict(uuid.UUID)  # at_store_id - at_provider_id
+        self._items_at_provider_id = dict()  # at_store_id - at_provider_id
         self._items_unique = defaultdict(Item)  # at_provider_id - item
-        self._items_amount = defaultdict(int)  # at_provider_id - item amount
+        self._items_amount = Inventory(SKUS)  # at_provider_id - item amount, kept in one dense vector
+        self._stores = dict()  # store_id - store, notified when stocks are added
+        self._locks = StripedLock() if thread_safe else NO_LOCK  # per item stripes, stores share providers
+        self._held = Inventory(SKUS)  # at_provider_id - amount reserved by holds, free stock is amount minus held
+        self._versions = dict()  # at_provider_id - bumped on every change of its amount or held amount
+        self._holds = dict()  # hold_id - active hold
+        self._expiry = []  # heap of (expires, hold_id), may keep holds that are already gone
+        self._hold_ids = itertools.count(1)
+        self._holds_lock = threading.Lock() if thread_safe else nullcontext()
+        self._change_log = deque(maxlen=CHANGE_LOG)  # (change number, at_provider_id), oldest first
+        self._last_change = 0
+        self._changes_lock = threading.Lock() if thread_safe else nullcontext()
 
-        print('provider {0} registered'.format(provider_id))
+        log.info('provider', 'provider {0} registered', self._provider_id)
 
     @property
-    def provider_id(self) -> uuid:
+    def provider_id(self) -> int:
         return self._provider_id
 
+    @property
+    def items_amount(self) -> Inventory:
+        return self._items_amount
+
+    def add_store(self, store) -> None:
+        self._stores[store.store_id] = store
+
     def add_item(self, item: Item, amount: int) -> None:
         if item.at_provider_id not in self._items_unique:
-            self._items_at_provider_id[item.at_store_id] = item.at_provider_id
+            with self._locks.locked_all():  # a new item may grow the amounts vector under other items
+                if item.at_provider_id not in self._items_unique:
+                    self._items_amount.position(item.at_provider_id)
+                    self._held.position(item.at_provider_id)
+                    self._versions[item.at_provider_id] = 0
+                    self._items_unique[item.at_provider_id] = item
+                    self._items_at_provider_id[item.at_store_id] = item.at_provider_id
 
-            self._items_unique[item.at_provider_id] = item
-            self._items_amount[item.at_provider_id] = amount
-        else:
+        with self._locks.lock(item.at_provider_id):
             self._items_amount[item.at_provider_id] += amount
+            self._changed(item.at_provider_id)
+            journal.stock_changed(self._provider_id, item.at_provider_id, amount)
 
-        print('item: {0}, amount: {1} added to provider: {2}'.format(item.name, amount, self.provider_id))
+        log.debug('provider', 'item: {0}, amount: {1} added to provider: {2}', item.name, amount, self.provider_id)
 
-    def _send_item(self, at_provider_id: uuid, amount: int) -> int:
+        for store in self._stores.values():
+            store.provider_updated(self, item.at_store_id)
+
+    def _send_item(self, at_provider_id: int, amount: int) -> int:
         if at_provider_id in self._items_amount:
-            send_amount = min(amount, self._items_amount[at_provider_id])
-            self._items_amount[at_provider_id] -= send_amount
+            with self._locks.lock(at_provider_id):  # check and decrement at once, held stock is never sent
+                send_amount = max(0, min(amount, self._items_amount[at_provider_id] - self._held[at_provider_id]))
+                self._items_amount[at_provider_id] -= send_amount
+                self._changed(at_provider_id)
+                journal.stock_changed(self._provider_id, at_provider_id, -send_amount)
 
-            print('item: {0}, amount: {1} sent by provider: {2}'.format(
-                self._items_unique[at_provider_id].name,
-                send_amount,
-                self.provider_id))
+            log.debug('provider', 'item: {0}, amount: {1} sent by provider: {2}',
+                      self._items_unique[at_provider_id].name, send_amount, self.provider_id)
 
             return send_amount
         else:
 
-            print('item: {0}, amount: {1} sent by provider: {2}'.format(
-                self._items_unique[at_provider_id].name,
-                0,
-                self.provider_id))
+            log.debug('provider', 'item: {0}, amount: {1} sent by provider: {2}',
+                      self._items_unique[at_provider_id].name, 0, self.provider_id)
 
             return 0
 
+    def at_store_ids(self) -> list:
+        return list(self._items_at_provider_id.keys())
+
+    def price(self, at_store_id: int) -> int:
+        return self._items_unique[self._items_at_provider_id[at_store_id]].price
+
+    def available(self, at_store_id: int) -> int:
+        # free stock, what holds set aside is not counted
+        return self.read(at_store_id)[0]
+
+    def read(self, at_store_id: int) -> tuple:
+        # (free amount, version), the version goes back with a reservation made on this reading
+        return self.read_all([at_store_id])[0]
+
+    def read_all(self, at_store_ids: list) -> list:
+        self._reclaim(clock.now())
+        result = []
+        for at_store_id in at_store_ids:
+            at_provider_id = self._items_at_provider_id.get(at_store_id)
+            if at_provider_id is None:
+                result.append((0, 0))
+            else:
+                result.append((self._items_amount.get(at_provider_id, 0) - self._held.get(at_provider_id, 0),
+                               self._versions.get(at_provider_id, 0)))
+        return result
+
+    def _changed(self, at_provider_id: int) -> None:
+        # every change of an amount or a held amount goes through here
+        self._versions[at_provider_id] += 1
+        with self._changes_lock:
+            self._last_change += 1
+            self._change_log.append((self._last_change, at_provider_id))
+
+    def changes(self, since: int, limit: int = CHANGE_LOG) -> tuple:
+        # (change number to ask from next time, at_store_ids changed after since), None instead of the ids
+        # when the log no longer reaches back that far or more than limit changes were made since
+        self._reclaim(clock.now())
+        with self._changes_lock:
+            if since >= self._last_change:
+                return self._last_change, []
+            if (self._last_change - since > limit or
+                    not self._change_log or self._change_log[0][0] > since + 1):
+                return self._last_change, None
+
+            changed = set()
+            for [number, at_provider_id] in reversed(self._change_log):
+                if number <= since:
+                    break
+                changed.add(at_provider_id)
+            return self._last_change, [self._items_unique[at_provider_id].at_store_id for at_provider_id in changed]
+
+    def _free(self, at_provider_ids: list) -> list:
+        return [int(amount) - int(held) for [amount, held]
+                in zip(self._items_amount.amounts(at_provider_ids), self._held.amounts(at_provider_ids))]
+
     def is_possible_to_process_request(self, request: dict) -> bool:
-        for [at_store_id, amount] in request.items():
-            at_provider_id = self._items_at_provider_id[at_store_id]
+        self._reclaim(clock.now())
+        at_provider_ids = [self._items_at_provider_id.get(at_store_id) for at_store_id in request]
 
-            if at_provider_id not in self._items_amount or amount > self._items_amount[at_provider_id]:
-                print('request cant be fully processed by provider {0}: not enough items'.format(self.provider_id))
+        if None in at_provider_ids or any(free < amount for [free, amount]
+                                          in zip(self._free(at_provider_ids), request.values())):
+            log.debug('provider', 'request cant be fully processed by provider {0}: not enough items',
+                      self.provider_id)
 
-                return False
+            return False
 
-        print('request can be fully processed by provider {0}'.format(self.provider_id))
+        log.debug('provider', 'request can be fully processed by provider {0}', self.provider_id)
 
         return True
 
+    def reserve(self, request: dict, versions: dict = None, ttl: float = HOLD_TTL) -> Hold:
+        # holds the whole request or nothing; with versions (at_store_id - version from read) the hold also fails
+        # when any item changed since it was read, so the caller plans again on fresh numbers
+        now = clock.now()
+        self._reclaim(now)
+        keys = [self._items_at_provider_id.get(at_store_id) for at_store_id in request]
+        if None in keys:
+            return None
+
+        with self._locks.locked(keys):  # only the stripes of these items, other stores keep working
+            if versions is not None and any(self._versions[at_provider_id] != versions.get(at_store_id)
+                                            for [at_store_id, at_provider_id] in zip(request, keys)):
+                log.debug('provider', 'hold refused by provider: {0}: stock changed since it was read',
+                          self._provider_id)
+                return None
+            if any(free < amount for [free, amount] in zip(self._free(keys), request.values())):
+                return None
+
+            self._held.add(keys, list(request.values()))
+            for at_provider_id in keys:
+                self._changed(at_provider_id)
+
+        hold = Hold(next(self._hold_ids), self, dict(request), keys, now + ttl)
+        with self._holds_lock:
+            self._holds[hold.hold_id] = hold
+            heapq.heappush(self._expiry, (hold.expires, hold.hold_id))
+        return hold
+
+    def commit(self, hold: Hold) -> dict:
+        # sends what the hold set aside, None when the hold expired or was released before
+        if hooks.provider_request is not None:  # stores source through holds, so this is their provider request
+            return hooks.provider_request(self, hold.request, lambda request: self._commit(hold))
+        return self._commit(hold)
+
+    def _commit(self, hold: Hold) -> dict:
+        with self._holds_lock:
+            if self._holds.get(hold.hold_id) is not hold:
+                return None
+            del self._holds[hold.hold_id]
+
+        if hold.expires < clock.now():
+            self._unhold(hold)
+            log.debug('provider', 'hold: {0} expired at provider: {1}', hold.hold_id, self._provider_id)
+            return None
+
+        amounts = list(hold.request.values())
+        with self._locks.locked(hold.keys):
+            for [at_provider_id, amount] in zip(hold.keys, amounts):  # a snapshot may be taken between two records
+                self._held[at_provider_id] -= amount
+                self._items_amount[at_provider_id] -= amount
+                self._changed(at_provider_id)
+                journal.stock_changed(self._provider_id, at_provider_id, -amount)
+
+        if log.enabled('provider', log.Level.DEBUG):
+            for [at_provider_id, amount] in zip(hold.keys, amounts):
+                log.debug('provider', 'item: {0}, amount: {1} sent by provider: {2}',
+                          self._items_unique[at_provider_id].name, amount, self.provider_id)
+        return dict(hold.request)
+
+    def release(self, hold: Hold) -> None:
+        with self._holds_lock:
+            if self._holds.get(hold.hold_id) is not hold:
+                return
+            del self._holds[hold.hold_id]
+        self._unhold(hold)
+
+    def _unhold(self, hold: Hold) -> None:
+        with self._locks.locked(hold.keys):
+            self._held.add(hold.keys, [-amount for amount in hold.request.values()])
+            for at_provider_id in hold.keys:
+                self._changed(at_provider_id)
+
+    def _reclaim(self, now: float) -> None:
+        # expired holds go back to free stock the next time anyone looks, no timer is needed
+        if not self._expiry or self._expiry[0][0] >= now:
+            return
+
+        expired = []
+        with self._holds_lock:
+            while self._expiry and self._expiry[0][0] < now:
+                hold = self._holds.pop(heapq.heappop(self._expiry)[1], None)
+                if hold is not None:
+                    expired.append(hold)
+        for hold in expired:
+            self._unhold(hold)
+            log.debug('provider', 'hold: {0} expired at provider: {1}', hold.hold_id, self._provider_id)
+
     def process_request(self, request: dict) -> dict:
+        if hooks.provider_request is not None:
+            return hooks.provider_request(self, request, self._process_request)
+        return self._process_request(request)
+
+    def _process_request(self, request: dict) -> dict:
         for [at_store_id, amount] in request.items():
             at_provider_id = self._items_at_provider_id[at_store_id]
             request[at_store_id] = self._send_item(at_provider_id, amount)
 
         return request
 
-    def show_items(self):
-        print('provider: {0} items:'.format(self._provider_id))
+    def show_items(self, level: log.Level = log.Level.INFO):
+        if not log.enabled('provider', level):  # skip walking the inventory when nobody reads it
+            return
+
+        log.get_log().write(level, 'provider', 'provider: {0} items:', (self._provider_id,))
         for [at_provider_id, amount] in self._items_amount.items():
-            print('{0}: {1}'.format(self._items_unique[at_provider_id].name, amount))
+            log.get_log().write(level, 'provider', '{0}: {1}', (self._items_unique[at_provider_id].name, amount))
@@ -0,0 +1,22 @@
+from dataclasses import dataclass
+
+REFRESH = 1.0  # clock seconds a load snapshot of a store is reused for by quotes
+SOURCING_TIME = 0.0  # providers answer at once when they have the stock
+
+
+@dataclass
+class Quote:
+    eta: float  # clock time the order would be handed over
+    sourcing: float  # seconds, each field is time spent in that part from now on
+    assembly: float  # waiting for a storekeeper and assembling
+    courier: float  # waiting for a courier
+    road: float  # leaving, driving and handing over
+
+
+@dataclass
+class Load:
+    # how busy a store is, worked out from its workers and backlog and reused for REFRESH seconds
+    taken: float
+    storekeepers: int
+    storekeeper_ready: float  # clock time a storekeeper could start on one more order
+    courier_ready: float  # clock time a courier could leave with one more order
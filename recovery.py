@@ -0,0 +1,163 @@
+import uuid
+
+from journal import Record
+from order import Order, OrderStatus
+import ids
+import journal
+import log
+
+
+class Replay:
+    # handles in the journal belong to the process that wrote it, they are mapped onto this one
+    __slots__ = ['_handles',
+                 '_stores',
+                 '_providers',
+                 '_workers',
+                 '_orders']
+
+    def __init__(self, stores=(), providers=(), workers=()):
+        self._handles = dict()  # handle in the journal - handle now
+        self._stores = {store.store_id: store for store in stores}
+        self._providers = {provider.provider_id: provider for provider in providers}
+        self._workers = {worker.worker_id: worker for worker in workers}
+        self._orders = dict()  # order_id now - order
+
+    @property
+    def orders(self) -> int:
+        return len(self._orders)
+
+    def _handle(self, handle: int):
+        return self._handles.get(handle, '') if handle else ''
+
+    def _owner(self, handle: int):
+        handle = self._handle(handle)
+        return self._stores.get(handle) or self._providers.get(handle)
+
+    def name(self, handle: int, external: bytes) -> None:
+        self._handles[handle] = ids.intern(uuid.UUID(bytes=external))
+
+    def order(self, store_id: int, order_id: int, client_id: int, x: float, y: float, creation_time: float,
+              estimated_delivery_time: float, status: int, items: dict,
+              storekeeper_id: int = 0, courier_id: int = 0) -> None:
+        store = self._stores.get(self._handle(store_id))
+        if store is None:
+            log.warning('recovery', 'order: {0} skipped: store: {1} is unknown', order_id, store_id)
+            return
+
+        order = Order(_client_id=self._handle(client_id),
+                      _order_id=ids.new(),
+                      _order_status=OrderStatus(status),
+                      _creation_time=creation_time,
+                      _estimated_delivery_time=estimated_delivery_time,
+                      _x=x,
+                      _y=y,
+                      _items=items,
+                      _storekeeper_id=self._handle(storekeeper_id),
+                      _courier_id=self._handle(courier_id))
+        self._handles[order_id] = order.order_id
+        self._orders[order.order_id] = order
+        store.restore_order(order)
+
+    def status(self, order_id: int, status: int) -> None:
+        order = self._orders.get(self._handle(order_id))
+        if order is not None:
+            order.order_status = OrderStatus(status)
+
+    def worker(self, order_id: int, worker_id: int, courier: bool) -> None:
+        order = self._orders.get(self._handle(order_id))
+        if order is not None and courier:
+            order.courier_id = self._handle(worker_id)
+        elif order is not None:
+            order.storekeeper_id = self._handle(worker_id)
+
+    def stock(self, owner_id: int, key: int, amount: int, absolute: bool = False) -> None:
+        owner = self._owner(owner_id)
+        key = self._handle(key)
+        if owner is None or not key:
+            return
+        if absolute:
+            owner.items_amount[key] = amount
+        else:
+            owner.items_amount.add([key], [amount])
+
+    def balance(self, worker_id: int, balance: float) -> None:
+        worker = self._workers.get(self._handle(worker_id))
+        if worker is not None:
+            worker.balance = balance
+
+    def snapshot(self, snapshot: dict) -> None:
+        for [handle, external] in snapshot['names'].items():
+            self.name(handle, external)
+
+        for [store_id, [items, orders]] in snapshot['stores'].items():
+            for [key, amount] in items:
+                self.stock(store_id, key, amount, absolute=True)
+            for order in orders:
+                self.order(store_id, *order)
+
+        for [provider_id, items] in snapshot['providers'].items():
+            for [key, amount] in items:
+                self.stock(provider_id, key, amount, absolute=True)
+
+        for [worker_id, balance] in snapshot['workers'].items():
+            self.balance(worker_id, balance)
+
+    def log(self, data: bytes) -> int:
+        # returns the number of records applied, a torn record at the end is dropped
+        view = memoryview(data)
+        offset = journal.HEADER.size
+        records = 0
+
+        while offset + journal.RECORD.size <= len(view):
+            [record, length] = journal.RECORD.unpack_from(view, offset)
+            offset += journal.RECORD.size
+            if offset + length > len(view):
+                break
+
+            if record == Record.NAME:
+                [handle, external] = journal.NAME.unpack_from(view, offset)
+                self.name(handle, external)
+            elif record == Record.ORDER:
+                [order_id, store_id, client_id, x, y, creation_time, count] = journal.ORDER.unpack_from(view, offset)
+                items = dict()
+                position = offset + journal.ORDER.size
+                for _ in range(count):
+                    [amount, name_length] = journal.ORDER_ITEM.unpack_from(view, position)
+                    position += journal.ORDER_ITEM.size
+                    items[bytes(view[position:position + name_length]).decode()] = amount
+                    position += name_length
+                self.order(store_id, order_id, client_id, x, y, creation_time, creation_time,
+                           OrderStatus.NEW.value, items)
+            elif record == Record.STATUS:
+                self.status(*journal.STATUS.unpack_from(view, offset))
+            elif record == Record.WORKER:
+                self.worker(*journal.WORKER.unpack_from(view, offset))
+            elif record == Record.STOCK:
+                self.stock(*journal.STOCK.unpack_from(view, offset))
+            elif record == Record.BALANCE:
+                self.balance(*journal.BALANCE.unpack_from(view, offset))
+
+            offset += length
+            records += 1
+
+        return records
+
+
+def recover(path: str, stores=(), providers=(), workers=()) -> int:
+    # stores, providers and workers must already be built with their old ids, categories and items;
+    # afterwards open the journal on them with journal.configure and call resume on every store
+    replay = Replay(stores, providers, workers)
+    snapshot = journal.read_snapshot(path)
+    records = 0
+
+    with journal.paused():
+        if snapshot is not None:
+            replay.snapshot(snapshot)
+
+        # a log the snapshot already covers was left behind by a crash right after the snapshot
+        if journal.read_generation(path) > (snapshot['generation'] if snapshot is not None else 0):
+            with open(path, 'rb') as file:
+                records = replay.log(file.read())
+
+    log.info('recovery', 'recovered {0} orders from snapshot and {1} journal records', replay.orders, records)
+    return records
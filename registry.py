@@ -0,0 +1,141 @@
+from collections import defaultdict
+from math import floor, hypot
+
+import heapq
+
+from store import Store
+import ids
+
+CELL_SIZE = 10.0  # grid cell side, in the same units as store coordinates
+
+
+class StoreRegistry:
+    __slots__ = ['_cell_size',
+                 '_cells',
+                 '_stores',
+                 '_cell_of_store',
+                 '_stores_of_client',
+                 '_bounds']
+
+    def __init__(self, cell_size: float = CELL_SIZE):
+        self._cell_size = cell_size
+        self._cells = defaultdict(list)  # (cell x, cell y) - stores in the cell
+        self._stores = dict()  # store_id - store
+        self._cell_of_store = dict()  # store_id - (cell x, cell y)
+        self._stores_of_client = defaultdict(dict)  # client_id - store ids it has orders at, as an ordered set
+        self._bounds = None  # (min cell x, min cell y, max cell x, max cell y), never shrinks
+
+    def __len__(self) -> int:
+        return len(self._stores)
+
+    def _cell(self, x: float, y: float) -> tuple:
+        return floor(x / self._cell_size), floor(y / self._cell_size)
+
+    def add_store(self, store: Store) -> None:
+        if store.store_id in self._stores:
+            return
+
+        cell = self._cell(store.x, store.y)
+        self._stores[store.store_id] = store
+        self._cell_of_store[store.store_id] = cell
+        self._cells[cell].append(store)
+        store.add_registry(self)
+        for client_id in store.clients():
+            self.client_ordered(client_id, store)
+
+        if self._bounds is None:
+            self._bounds = (cell[0], cell[1], cell[0], cell[1])
+        else:
+            self._bounds = (min(self._bounds[0], cell[0]), min(self._bounds[1], cell[1]),
+                            max(self._bounds[2], cell[0]), max(self._bounds[3], cell[1]))
+
+    def remove_store(self, store_id: int) -> None:
+        store_id = ids.find(store_id)
+        store = self._stores.pop(store_id, None)
+        if store is None:
+            return
+
+        cell = self._cell_of_store.pop(store_id)
+        self._cells[cell].remove(store)
+        if not self._cells[cell]:
+            del self._cells[cell]
+
+        store.remove_registry(self)
+        for client_id in store.clients():
+            stores = self._stores_of_client.get(client_id, {})
+            stores.pop(store_id, None)
+            if not stores:
+                self._stores_of_client.pop(client_id, None)
+
+    def client_ordered(self, client_id: int, store: Store) -> None:
+        # a client stays listed at a store once it ordered there, until the store leaves the registry
+        self._stores_of_client[client_id][store.store_id] = None
+
+    def get_store(self, store_id: int) -> Store:
+        return self._stores.get(ids.find(store_id))
+
+    def query(self, status=None, client_id: int = None, storekeeper_id: int = None, courier_id: int = None,
+              since: float = None, until: float = None) -> list:
+        # Store.query over every store, e.g. the open orders of a client wherever they were placed;
+        # given a client only the stores it ordered at are asked
+        if client_id is None:
+            stores = list(self._stores.values())
+        else:
+            stores = [self._stores[store_id] for store_id in self._stores_of_client.get(ids.find(client_id), ())
+                      if store_id in self._stores]
+        return [order for store in stores
+                for order in store.query(status, client_id, storekeeper_id, courier_id, since, until)]
+
+    def _ring(self, center: tuple, radius: int):
+        [cx, cy] = center
+        if radius == 0:
+            yield center
+            return
+
+        for dx in range(-radius, radius + 1):
+            yield cx + dx, cy - radius
+            yield cx + dx, cy + radius
+        for dy in range(-radius + 1, radius):
+            yield cx - radius, cy + dy
+            yield cx + radius, cy + dy
+
+    def nearest(self, x: float, y: float, k: int = 1, items: dict = None, in_stock: bool = False) -> list:
+        # expands square rings of cells around the query point, so only cells near the answer are visited. once
+        # more cells were walked than are occupied, the grid is sparse around the point and the occupied cells
+        # left are scanned instead, so a query never costs much more than a linear scan
+        if not self._cells:
+            return []
+
+        center = self._cell(x, y)
+        max_radius = max(center[0] - self._bounds[0], center[1] - self._bounds[1],
+                         self._bounds[2] - center[0], self._bounds[3] - center[1])
+        best = []  # heap of (-distance, sequence, store), holds the k closest stores seen so far
+        sequence = 0
+        walked = 0
+
+        for radius in range(max_radius + 1):
+            scan = walked > len(self._cells)
+            if scan:
+                cells = [cell for cell in self._cells
+                         if max(abs(cell[0] - center[0]), abs(cell[1] - center[1])) >= radius]
+            else:
+                cells = self._ring(center, radius)
+                walked += max(1, 8 * radius)
+
+            for cell in cells:
+                for store in self._cells.get(cell, ()):
+                    if items is not None and not (store.in_stock(items) if in_stock else store.sells(items)):
+                        continue
+
+                    distance = hypot(store.x - x, store.y - y)
+                    sequence += 1
+                    if len(best) < k:
+                        heapq.heappush(best, (-distance, sequence, store))
+                    elif distance < -best[0][0]:
+                        heapq.heapreplace(best, (-distance, sequence, store))
+
+            # every cell of the next ring is at least radius * cell_size away from the query point
+            if scan or len(best) == k and -best[0][0] <= radius * self._cell_size:
+                break
+
+        return [store for [_, _, store] in sorted(best, key=lambda entry: (-entry[0], entry[1]))]
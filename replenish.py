@@ -0,0 +1,112 @@
+from math import ceil, exp, log as ln
+
+import threading
+
+import clock
+import log
+
+HALF_LIFE = 60.0  # clock seconds after which an observed demand counts half
+LEAD_TIME = 10.0  # clock seconds of demand kept on hand, stock at or below this is topped up
+COVER = 60.0  # clock seconds of demand a top-up brings the stock up to, on top of the lead time
+INTERVAL = 5.0  # clock seconds between stock checks
+IDLE_RATE = 1e-3  # units per clock second below which a sku is forgotten
+
+
+class Replenisher:
+    # keeps stock of a store ahead of its demand, so orders find their items on hand instead of waiting on
+    # a provider; demand per sku is an exponentially weighted rate, checks run off the clock while there is demand
+    __slots__ = ['_store',
+                 '_rates',
+                 '_seen',
+                 '_decay',
+                 '_lead_time',
+                 '_cover',
+                 '_interval',
+                 '_armed',
+                 '_stopped',
+                 '_thread',
+                 '_wakeup',
+                 '_halt']
+
+    def __init__(self, store, half_life: float = HALF_LIFE, lead_time: float = LEAD_TIME, cover: float = COVER,
+                 interval: float = INTERVAL):
+        self._store = store
+        self._rates = dict()  # at_store_id - units per clock second as of its last sighting
+        self._seen = dict()  # at_store_id - when the rate was last brought up to date
+        self._decay = ln(2) / half_life
+        self._lead_time = lead_time
+        self._cover = cover
+        self._interval = interval
+        self._armed = False  # a check is scheduled
+        self._stopped = False
+        self._thread = None  # runs the checks when there is no scheduler, one for the life of the replenisher
+        self._wakeup = threading.Event()  # set while a check is due on the thread
+        self._halt = threading.Event()
+
+    def _rate(self, at_store_id: int, now: float) -> float:
+        return self._rates[at_store_id] * exp(-(now - self._seen[at_store_id]) * self._decay)
+
+    def rate(self, at_store_id: int) -> float:
+        return self._rate(at_store_id, clock.now()) if at_store_id in self._rates else 0.0
+
+    def observe(self, at_store_id: int, amount: int) -> None:
+        now = clock.now()
+        rate = self._rate(at_store_id, now) if at_store_id in self._rates else 0.0
+        self._rates[at_store_id] = rate + amount * self._decay  # an impulse integrates to amount over time
+        self._seen[at_store_id] = now
+        if not self._armed and not self._stopped:
+            self._arm()
+
+    def plan(self, stock) -> dict:
+        # at_store_id - amount to order, for skus at or below their reorder point
+        now = clock.now()
+        request = dict()
+        for at_store_id in list(self._rates):
+            rate = self._rate(at_store_id, now)
+            if rate < IDLE_RATE:
+                del self._rates[at_store_id]
+                del self._seen[at_store_id]
+                continue
+
+            have = stock[at_store_id]
+            if have <= rate * self._lead_time:
+                request[at_store_id] = ceil(rate * (self._lead_time + self._cover)) - have
+        return request
+
+    def _arm(self) -> None:
+        self._armed = True
+        scheduler = clock.get_scheduler()
+        if scheduler is not None:
+            scheduler.schedule_after(self._interval, clock.EventType.REPLENISH, self._check)
+        else:  # no scheduler - the checks run on a thread of their own, asleep while there is no demand
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True,
+                                                name='replenisher-{0}'.format(self._store.store_id))
+                self._thread.start()
+            self._wakeup.set()
+
+    def _run(self) -> None:
+        while True:
+            self._wakeup.wait()
+            if self._halt.wait(self._interval):
+                return
+            self._check()
+
+    def _check(self) -> None:
+        self._wakeup.clear()  # before disarming, demand seen in between is left in the rates and arms it below
+        self._armed = False
+        if self._stopped:
+            return
+
+        self._store.replenish()
+        if self._rates:  # no demand left - the next order arms it again, so a simulation can run dry
+            self._arm()
+
+    def stop(self) -> None:
+        self._stopped = True
+        self._halt.set()
+        self._wakeup.set()
+        self._thread = None
+        self._rates.clear()
+        self._seen.clear()
+        log.debug('replenish', 'replenisher of store: {0} stopped', self._store.store_id)
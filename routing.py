@@ -0,0 +1,50 @@
+from math import hypot
+
+from order import Order
+
+ROUTE_SIZE = 4  # most orders one courier takes on a trip
+ROUTE_RADIUS = 15  # orders farther than this from the first one are not batched with it
+
+
+def _distance(a: tuple, b: tuple) -> float:
+    return hypot(a[0] - b[0], a[1] - b[1])
+
+
+def route_length(x: float, y: float, orders: list) -> float:
+    points = [(x, y)] + [(order.x, order.y) for order in orders] + [(x, y)]
+    return sum(_distance(points[i], points[i + 1]) for i in range(len(points) - 1))
+
+
+def plan_route(x: float, y: float, orders: list) -> list:
+    # nearest neighbour tour from the store, then 2-opt until no reversal shortens it
+    left = list(orders)
+    route = []
+    position = (x, y)
+    while left:
+        nearest = min(left, key=lambda order: _distance(position, (order.x, order.y)))
+        left.remove(nearest)
+        route.append(nearest)
+        position = (nearest.x, nearest.y)
+
+    points = [(x, y)] + [(order.x, order.y) for order in route] + [(x, y)]
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, len(points) - 2):
+            for j in range(i + 1, len(points) - 1):
+                before = _distance(points[i - 1], points[i]) + _distance(points[j], points[j + 1])
+                after = _distance(points[i - 1], points[j]) + _distance(points[i], points[j + 1])
+                if after < before - 1e-9:
+                    points[i:j + 1] = reversed(points[i:j + 1])
+                    route[i - 1:j] = reversed(route[i - 1:j])
+                    improved = True
+
+    return route
+
+
+def group_nearby(seed: Order, candidates: list, limit: int = ROUTE_SIZE, radius: float = ROUTE_RADIUS) -> list:
+    # seed first, then the closest candidates within radius of it
+    nearby = [(_distance((seed.x, seed.y), (order.x, order.y)), index, order)
+              for [index, order] in enumerate(candidates) if order is not seed]
+    nearby = sorted(entry for entry in nearby if entry[0] <= radius)
+    return [seed] + [order for [_, _, order] in nearby[:limit - 1]]
@@ -0,0 +1,445 @@
+from concurrent.futures import Future
+from multiprocessing.connection import Connection
+
+import asyncio
+import itertools
+import multiprocessing
+import threading
+import uuid
+import zlib
+
+from aio import AsyncStore, use_event_loop
+from order import Order
+from provider import Hold, Provider
+import ids
+import log
+
+# Stores are spread over worker processes, each running its stores on an event loop. The router in the parent
+# forwards store calls by store id. Providers stay in the parent, because stores in different shards share
+# them. Shards reach them over a provider pipe with the read / reserve / commit / release protocol, and
+# holds keep one shard from draining what another already planned on. Stock updates go back to every shard
+# on an event pipe. Handles are local to a process, so everything that crosses a pipe is a uuid.
+#
+# A provider call blocks its shard's loop for the whole round trip, and the parent answers all shards from
+# threads of one process, under one GIL. Provider work of every shard is serialised there, so shards scale
+# store work, while sourcing scales only as far as a shard's cached reads save it round trips.
+
+ORDER_HANDLE_BITS = 64  # low bits of an order uuid a shard hands out, the rest is random per shard
+
+
+def shard_of(store_id: uuid.UUID, shards: int) -> int:
+    # stable across processes and runs, unlike hash()
+    return zlib.crc32(store_id.bytes) % shards
+
+
+class RemoteProvider:
+    # stands in for a Provider of the parent process inside a shard, with the interface stores and sourcing use
+    __slots__ = ['_provider_id',
+                 '_external',
+                 '_link',
+                 '_prices',
+                 '_stores']
+
+    def __init__(self, external: uuid.UUID, link):
+        self._provider_id = ids.intern(external)
+        self._external = external
+        self._link = link
+        self._prices = dict()  # at_store_id - price
+        self._stores = dict()  # store_id - store, notified when the parent reports new stock
+        for [at_store_id, price] in link.call('catalog', external).items():
+            self._prices[ids.intern(at_store_id)] = price
+
+    @property
+    def provider_id(self) -> int:
+        return self._provider_id
+
+    def add_store(self, store) -> None:
+        self._stores[store.store_id] = store
+
+    def updated(self, at_store_id: uuid.UUID, price: int) -> None:
+        at_store_id = ids.intern(at_store_id)
+        self._prices[at_store_id] = price
+        for store in self._stores.values():
+            store.provider_updated(self, at_store_id)
+
+    def at_store_ids(self) -> list:
+        return list(self._prices.keys())
+
+    def price(self, at_store_id: int) -> int:
+        return self._prices[at_store_id]
+
+    def read(self, at_store_id: int) -> tuple:
+        return self.read_all([at_store_id])[0]
+
+    def read_all(self, at_store_ids: list) -> list:
+        return self._link.call('read_all', self._external, [ids.external(key) for key in at_store_ids])
+
+    def available(self, at_store_id: int) -> int:
+        return self.read(at_store_id)[0]
+
+    def changes(self, since: int, limit: int = None) -> tuple:
+        [number, changed] = self._link.call('changes', self._external, since, limit)
+        return number, [ids.intern(at_store_id) for at_store_id in changed] if changed is not None else None
+
+    def _external_request(self, request: dict) -> dict:
+        return {ids.external(at_store_id): amount for [at_store_id, amount] in request.items()}
+
+    def _local_request(self, request: dict) -> dict:
+        return {ids.intern(at_store_id): amount for [at_store_id, amount] in request.items()}
+
+    def is_possible_to_process_request(self, request: dict) -> bool:
+        return self._link.call('is_possible_to_process_request', self._external, self._external_request(request))
+
+    def process_request(self, request: dict) -> dict:
+        request.update(self._local_request(self._link.call('process_request', self._external,
+                                                           self._external_request(request))))
+        return request
+
+    def reserve(self, request: dict, versions: dict = None, ttl: float = None) -> Hold:
+        reply = self._link.call('reserve', self._external, self._external_request(request),
+                                self._external_request(versions) if versions is not None else None, ttl)
+        if reply is None:
+            return None
+        [hold_id, expires] = reply
+        return Hold(hold_id, self, dict(request), None, expires)
+
+    def commit(self, hold: Hold) -> dict:
+        sent = self._link.call('commit', self._external, hold.hold_id)
+        return self._local_request(sent) if sent is not None else None
+
+    def release(self, hold: Hold) -> None:
+        self._link.call('release', self._external, hold.hold_id)
+
+
+class _Link:
+    # the shard end of its provider pipe, calls are made from the shard loop only and answered in order
+    __slots__ = ['_connection']
+
+    def __init__(self, connection: Connection):
+        self._connection = connection
+
+    def call(self, method: str, *args):
+        self._connection.send((method, args))
+        [ok, result] = self._connection.recv()
+        if not ok:
+            raise result
+        return result
+
+
+class _ShardSubscriber:
+    # registered with a parent provider like a store, forwards its stock updates to one shard
+    __slots__ = ['_store_id',
+                 '_connection',
+                 '_lock']
+
+    def __init__(self, connection: Connection):
+        self._store_id = ids.new()
+        self._connection = connection
+        self._lock = threading.Lock()  # add_item may be called from any thread of the parent
+
+    @property
+    def store_id(self) -> int:
+        return self._store_id
+
+    def provider_updated(self, provider: Provider, at_store_id: int) -> None:
+        with self._lock:
+            self._connection.send((ids.external(provider.provider_id), ids.external(at_store_id),
+                                   provider.price(at_store_id)))
+
+
+class ProviderHost:
+    # serves the parent's providers to the shards, one thread per shard; providers should be thread safe
+    __slots__ = ['_providers',
+                 '_holds',
+                 '_holds_lock']
+
+    def __init__(self, providers: list):
+        self._providers = {ids.external(provider.provider_id): provider for provider in providers}
+        self._holds = dict()  # (provider uuid, hold_id) - hold
+        self._holds_lock = threading.Lock()
+
+    def subscribe(self, connection: Connection) -> None:
+        subscriber = _ShardSubscriber(connection)
+        for provider in self._providers.values():
+            provider.add_store(subscriber)
+
+    def serve(self, connection: Connection) -> None:
+        while True:
+            try:
+                [method, args] = connection.recv()
+            except (EOFError, OSError):
+                return
+            try:
+                reply = (True, getattr(self, '_' + method)(*args))
+            except Exception as error:
+                reply = (False, error)
+            connection.send(reply)
+
+    @staticmethod
+    def _internal(request: dict) -> dict:
+        return {ids.find(at_store_id): amount for [at_store_id, amount] in request.items()}
+
+    @staticmethod
+    def _external(request: dict) -> dict:
+        return {ids.external(at_store_id): amount for [at_store_id, amount] in request.items()}
+
+    def _catalog(self, provider_id: uuid.UUID) -> dict:
+        provider = self._providers[provider_id]
+        return {ids.external(at_store_id): provider.price(at_store_id) for at_store_id in provider.at_store_ids()}
+
+    def _read_all(self, provider_id: uuid.UUID, at_store_ids: list) -> list:
+        return self._providers[provider_id].read_all([ids.find(key) for key in at_store_ids])
+
+    def _changes(self, provider_id: uuid.UUID, since: int, limit: int) -> tuple:
+        provider = self._providers[provider_id]
+        [number, changed] = provider.changes(since) if limit is None else provider.changes(since, limit)
+        return number, [ids.external(at_store_id) for at_store_id in changed] if changed is not None else None
+
+    def _is_possible_to_process_request(self, provider_id: uuid.UUID, request: dict) -> bool:
+        return self._providers[provider_id].is_possible_to_process_request(self._internal(request))
+
+    def _process_request(self, provider_id: uuid.UUID, request: dict) -> dict:
+        return self._external(self._providers[provider_id].process_request(self._internal(request)))
+
+    def _reserve(self, provider_id: uuid.UUID, request: dict, versions: dict, ttl: float) -> tuple:
+        provider = self._providers[provider_id]
+        arguments = [self._internal(request), self._internal(versions) if versions is not None else None]
+        hold = provider.reserve(*arguments) if ttl is None else provider.reserve(*arguments, ttl=ttl)
+        if hold is None:
+            return None
+        with self._holds_lock:
+            self._holds[(provider_id, hold.hold_id)] = hold
+        return hold.hold_id, hold.expires
+
+    def _commit(self, provider_id: uuid.UUID, hold_id: int) -> dict:
+        with self._holds_lock:
+            hold = self._holds.pop((provider_id, hold_id), None)
+        if hold is None:
+            return None
+        sent = self._providers[provider_id].commit(hold)
+        return self._external(sent) if sent is not None else None
+
+    def _release(self, provider_id: uuid.UUID, hold_id: int) -> None:
+        with self._holds_lock:
+            hold = self._holds.pop((provider_id, hold_id), None)
+        if hold is not None:
+            self._providers[provider_id].release(hold)
+
+
+class _Shard:
+    # the shard side: stores on an event loop, calls from the router and stock updates read off their pipes
+    __slots__ = ['_loop',
+                 '_calls',
+                 '_events',
+                 '_stores',
+                 '_providers',
+                 '_order_space',
+                 '_stopped']
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, calls: Connection, events: Connection, stores: list,
+                 remote: dict):
+        self._loop = loop
+        self._calls = calls
+        self._events = events
+        self._stores = {store.store_id: AsyncStore(store) for store in stores}
+        self._providers = remote  # provider uuid - remote provider
+        # order ids leave as uuids spelled from their handle, so handing one out registers nothing that would
+        # outlive the order; drawn here, not at import, as forked shards would share an import-time draw
+        self._order_space = uuid.uuid4().int >> ORDER_HANDLE_BITS << ORDER_HANDLE_BITS
+        self._stopped = self._loop.create_future()
+
+    def run(self) -> None:
+        self._loop.add_reader(self._calls.fileno(), self._on_call)
+        self._loop.add_reader(self._events.fileno(), self._on_event)
+        self._loop.run_until_complete(self._stopped)
+
+    def _store(self, store_id: uuid.UUID) -> AsyncStore:
+        store = self._stores.get(ids.find(store_id))
+        if store is None:
+            raise KeyError('store {0} is not in this shard'.format(store_id))
+        return store
+
+    def _external_order(self, order_id: int) -> uuid.UUID:
+        return uuid.UUID(int=self._order_space | order_id) if order_id is not None else None
+
+    def _local_order(self, order_id: uuid.UUID) -> int:
+        if order_id.int >> ORDER_HANDLE_BITS << ORDER_HANDLE_BITS == self._order_space:
+            return order_id.int & ((1 << ORDER_HANDLE_BITS) - 1)
+        return ids.find(order_id)
+
+    def _summary(self, order: Order) -> dict:
+        # workers are built from uuids, so theirs are already registered
+        return {'order_id': self._external_order(order.order_id),
+                'status': order.order_status,
+                'creation_time': order.creation_time,
+                'estimated_delivery_time': order.estimated_delivery_time,
+                'courier_id': ids.external(order.courier_id) if order.courier_id else None}
+
+    def _reply(self, call_id: int, ok: bool, result) -> None:
+        self._calls.send((call_id, ok, result))
+
+    def _on_event(self) -> None:
+        while self._events.poll():
+            try:
+                [provider_id, at_store_id, price] = self._events.recv()
+            except (EOFError, OSError):  # nothing left to send updates, e.g. the parent has no providers
+                self._loop.remove_reader(self._events.fileno())
+                return
+            provider = self._providers.get(provider_id)
+            if provider is not None:
+                provider.updated(at_store_id, price)
+
+    def _on_call(self) -> None:
+        while self._calls.poll():
+            [call_id, method, args] = self._calls.recv()
+            try:
+                if method == 'stop':
+                    self._reply(call_id, True, None)
+                    self._stopped.set_result(None)
+                    return
+                if method == 'process_order':
+                    self._loop.create_task(self._process_order(call_id, *args))
+                    continue
+                self._reply(call_id, True, getattr(self, '_' + method)(*args))
+            except Exception as error:
+                self._reply(call_id, False, error)
+
+    def _take_order(self, store_id: uuid.UUID, client_id: uuid.UUID, x: float, y: float, items: dict) -> uuid.UUID:
+        return self._external_order(self._store(store_id).store.take_order(client_id, x, y, items))
+
+    def _take_orders(self, store_id: uuid.UUID, batch: list) -> list:
+        return [self._external_order(order_id) for order_id in self._store(store_id).store.take_orders(batch)]
+
+    def _get_order(self, store_id: uuid.UUID, order_id: uuid.UUID) -> dict:
+        order = self._store(store_id).store.get_order(self._local_order(order_id))
+        return self._summary(order) if order is not None else None
+
+    async def _process_order(self, call_id: int, store_id: uuid.UUID, order_id: uuid.UUID) -> None:
+        try:
+            order = await self._store(store_id).process_order(self._local_order(order_id))
+            self._reply(call_id, True, self._summary(order) if order is not None else None)
+        except Exception as error:
+            self._reply(call_id, False, error)
+
+
+def _shard_main(index: int, build, store_ids: list, provider_ids: list,
+                calls: Connection, providers: Connection, events: Connection) -> None:
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    use_event_loop(loop)
+
+    link = _Link(providers)
+    remote = {provider_id: RemoteProvider(provider_id, link) for provider_id in provider_ids}
+    stores = build(index, store_ids, list(remote.values()))
+    log.info('shard', 'shard: {0} runs {1} stores', index, len(stores))
+    _Shard(loop, calls, events, stores, remote).run()
+
+
+class ShardRouter:
+    # build(shard index, store uuids, providers) runs in each shard and returns its stores, with their workers
+    # and categories, already on the given providers; it must be importable, shards are spawned
+    __slots__ = ['_shards',
+                 '_processes',
+                 '_calls',
+                 '_send_locks',
+                 '_pending',
+                 '_pending_lock',
+                 '_call_ids',
+                 '_host',
+                 '_threads']
+
+    def __init__(self, build, store_ids: list, providers: list, shards: int = None, context=None):
+        context = context if context is not None else multiprocessing.get_context('spawn')
+        self._shards = max(1, shards if shards is not None else multiprocessing.cpu_count())
+        self._host = ProviderHost(providers)
+        self._pending = dict()  # call_id - future
+        self._pending_lock = threading.Lock()
+        self._call_ids = itertools.count(1)
+        self._processes = []
+        self._calls = []
+        self._send_locks = []
+        self._threads = []
+
+        placement = [[] for _ in range(self._shards)]
+        for store_id in store_ids:
+            placement[shard_of(store_id, self._shards)].append(store_id)
+        provider_ids = [ids.external(provider.provider_id) for provider in providers]
+
+        for index in range(self._shards):
+            [calls, shard_calls] = context.Pipe()
+            [provider_calls, shard_providers] = context.Pipe()
+            [shard_events, events] = context.Pipe(duplex=False)
+            process = context.Process(target=_shard_main, name='shard-{0}'.format(index), daemon=True,
+                                      args=(index, build, placement[index], provider_ids,
+                                            shard_calls, shard_providers, shard_events))
+            process.start()
+            self._processes.append(process)
+            self._calls.append(calls)
+            self._send_locks.append(threading.Lock())
+            self._host.subscribe(events)
+            self._spawn(self._host.serve, provider_calls)
+            self._spawn(self._receive, calls)
+
+        log.info('shard', 'router started {0} shards for {1} stores', self._shards, len(store_ids))
+
+    def __len__(self) -> int:
+        return self._shards
+
+    def _spawn(self, target, *args) -> None:
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def _receive(self, connection: Connection) -> None:
+        while True:
+            try:
+                [call_id, ok, result] = connection.recv()
+            except (EOFError, OSError):
+                return
+            with self._pending_lock:
+                future = self._pending.pop(call_id, None)
+            if future is None:
+                continue
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+
+    def _call(self, shard: int, method: str, *args) -> Future:
+        future = Future()
+        call_id = next(self._call_ids)
+        with self._pending_lock:
+            self._pending[call_id] = future
+        with self._send_locks[shard]:
+            self._calls[shard].send((call_id, method, args))
+        return future
+
+    def shard_of(self, store_id: uuid.UUID) -> int:
+        return shard_of(store_id, self._shards)
+
+    def take_order(self, store_id: uuid.UUID, client_id: uuid.UUID, x: float, y: float, items: dict) -> uuid.UUID:
+        return self._call(self.shard_of(store_id), 'take_order', store_id, client_id, x, y, items).result()
+
+    def take_orders(self, store_id: uuid.UUID, batch: list) -> list:
+        return self._call(self.shard_of(store_id), 'take_orders', store_id, batch).result()
+
+    def get_order(self, store_id: uuid.UUID, order_id: uuid.UUID) -> dict:
+        return self._call(self.shard_of(store_id), 'get_order', store_id, order_id).result()
+
+    def process_order(self, store_id: uuid.UUID, order_id: uuid.UUID) -> Future:
+        # resolves with the order summary once the courier has handed it over, calls to many stores overlap
+        return self._call(self.shard_of(store_id), 'process_order', store_id, order_id)
+
+    def close(self) -> None:
+        for shard in range(self._shards):
+            if self._processes[shard].is_alive():
+                try:
+                    self._call(shard, 'stop').result(timeout=5)
+                except Exception as error:
+                    log.warning('shard', 'shard: {0} did not stop cleanly: {1}', shard, error)
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        for connection in self._calls:
+            connection.close()
@@ -0,0 +1,159 @@
+from collections import defaultdict
+
+
+from provider import Provider
+
+ROUND_TRIP_COST = 50  # price of one more provider request, in the same units as item prices
+ATTEMPTS = 3  # plans tried when providers keep changing under a store before it waits for the next update
+
+
+class Sourcing:
+    __slots__ = ['_providers',
+                 '_item_providers',
+                 '_cache',
+                 '_synced']
+
+    def __init__(self):
+        self._providers = dict()  # provider_id - provider
+        self._item_providers = defaultdict(list)  # at_store_id - providers that ever stocked the item
+        self._cache = defaultdict(dict)  # provider_id - {at_store_id - (available amount, version)} as last read
+        self._synced = dict()  # provider_id - provider change number the cache is current to
+
+    def add_provider(self, provider: Provider) -> None:
+        if provider.provider_id in self._providers:
+            return
+
+        self._providers[provider.provider_id] = provider
+        for at_store_id in provider.at_store_ids():
+            self._item_providers[at_store_id].append(provider)
+
+    def add_item(self, provider: Provider, at_store_id: int) -> None:
+        if provider.provider_id in self._providers and provider not in self._item_providers[at_store_id]:
+            self._item_providers[at_store_id].append(provider)
+
+    def _sync(self, provider: Provider) -> dict:
+        # drops the cached items the provider changed since the last sync, the rest stays good
+        cached = self._cache[provider.provider_id]
+        # walking more changes than there are cached items costs more than reading those items again
+        [number, changed] = provider.changes(self._synced.get(provider.provider_id, 0), len(cached))
+        self._synced[provider.provider_id] = number
+        if changed is None:
+            cached.clear()
+        else:
+            for at_store_id in changed:
+                cached.pop(at_store_id, None)
+        return cached
+
+    def available(self, at_store_id: int) -> int:
+        # what the providers had when last read, for estimates; an item never read is read now
+        total = 0
+        for provider in self._item_providers.get(at_store_id, ()):
+            reading = self._cache.get(provider.provider_id, {}).get(at_store_id)
+            total += reading[0] if reading is not None else provider.available(at_store_id)
+        return total
+
+    def forget(self, provider: Provider, at_store_ids) -> None:
+        # a refused hold means these readings are stale whatever the change log said
+        cached = self._cache[provider.provider_id]
+        for at_store_id in at_store_ids:
+            cached.pop(at_store_id, None)
+
+    def _candidates(self, request: dict) -> tuple:
+        # cached readings unless the provider changed them, one read per provider for the rest
+        asked = defaultdict(list)  # provider_id - at_store_ids it is asked about
+        for at_store_id in request:
+            for provider in self._item_providers.get(at_store_id, ()):
+                asked[provider.provider_id].append(at_store_id)
+
+        readings = dict()  # (provider_id, at_store_id) - (available amount, version it was read at)
+        for [provider_id, at_store_ids] in asked.items():
+            provider = self._providers[provider_id]
+            cached = self._sync(provider)
+            missing = [at_store_id for at_store_id in at_store_ids if at_store_id not in cached]
+            if missing:
+                for [at_store_id, reading] in zip(missing, provider.read_all(missing)):
+                    cached[at_store_id] = reading
+            for at_store_id in at_store_ids:
+                readings[(provider_id, at_store_id)] = cached[at_store_id]
+
+        candidates = {at_store_id: [(provider, readings[(provider.provider_id, at_store_id)][0])  # at_store_id -
+                                    for provider in self._item_providers.get(at_store_id, ())]  # [(provider, amount)]
+                      for at_store_id in request}
+        versions = {key: version for [key, [_, version]] in readings.items()}  # (provider_id, at_store_id) - version
+        return candidates, versions
+
+    def plan(self, request: dict, partial: bool = False) -> list:
+        # returns [(provider, provider request, versions)], or None when the request cant be covered and partial
+        # is off; versions (at_store_id - version) are what the plan was made on, for Provider.reserve
+        if not request:
+            return []
+
+        [candidates, versions] = self._candidates(request)
+        picked = self._pick(request, partial, candidates)
+        if picked is None:
+            return None
+        return [(provider, provider_request, {at_store_id: versions[(provider.provider_id, at_store_id)]
+                                              for at_store_id in provider_request})
+                for [provider, provider_request] in picked]
+
+    def _pick(self, request: dict, partial: bool, candidates: dict) -> list:
+        if not partial:
+            for [at_store_id, amount] in request.items():
+                if sum(available for [_, available] in candidates[at_store_id]) < amount:
+                    return None
+
+        covering = self._single_provider(request, candidates)
+        if covering is not None:
+            return [(covering, dict(request))]
+
+        return self._split(request, candidates)
+
+    def _single_provider(self, request: dict, candidates: dict) -> Provider:
+        covered = defaultdict(int)  # provider_id - number of items it covers fully
+        cost = defaultdict(int)  # provider_id - price of the whole request
+        for [at_store_id, amount] in request.items():
+            for [provider, available] in candidates[at_store_id]:
+                if available >= amount:
+                    covered[provider.provider_id] += 1
+                    cost[provider.provider_id] += provider.price(at_store_id) * amount
+
+        best_provider_id = min((provider_id for [provider_id, count] in covered.items() if count == len(request)),
+                               key=cost.__getitem__, default=None)
+        return self._providers[best_provider_id] if best_provider_id is not None else None
+
+    def _split(self, request: dict, candidates: dict) -> list:
+        # greedy set cover, one round trip per pick: prefer providers that close whole items,
+        # then the most units per unit of cost
+        remaining = dict(request)
+        left = {at_store_id: {provider.provider_id: available for [provider, available] in providers if available > 0}
+                for [at_store_id, providers] in candidates.items()}
+        plan = []
+
+        while remaining:
+            closed = defaultdict(int)
+            units = defaultdict(int)
+            cost = defaultdict(int)
+            for [at_store_id, amount] in remaining.items():
+                for [provider_id, available] in left[at_store_id].items():
+                    taken = min(amount, available)
+                    closed[provider_id] += taken == amount
+                    units[provider_id] += taken
+                    cost[provider_id] += self._providers[provider_id].price(at_store_id) * taken
+
+            if not units:
+                break
+
+            provider_id = max(units, key=lambda key: (closed[key], units[key] / (ROUND_TRIP_COST + cost[key])))
+            provider_request = dict()
+            for at_store_id in list(remaining):
+                available = left[at_store_id].pop(provider_id, 0)
+                taken = min(remaining[at_store_id], available)
+                if taken > 0:
+                    provider_request[at_store_id] = taken
+                    remaining[at_store_id] -= taken
+                    if remaining[at_store_id] == 0:
+                        del remaining[at_store_id]
+
+            plan.append((self._providers[provider_id], provider_request))
+
+        return plan
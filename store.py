@@ -1,10 +1,30 @@
 from collections import defaultdict
-import time
+from contextlib import nullcontext
+from math import hypot
+import threading
 import uuid
 
+from archive import Retention
+import assembly
+from backlog import Backlog, Stage
+from inventory import Inventory, SkuIndex
 from order import Item, Order, OrderStatus
+from orderbook import OrderBook
+from pool import WorkerPool
+from quote import Load, Quote, REFRESH as QUOTE_REFRESH, SOURCING_TIME
+from replenish import Replenisher
 from provider import Provider
-from worker import Worker, Courier, Storekeeper
+from routing import group_nearby, ROUTE_SIZE, ROUTE_RADIUS
+from sourcing import Sourcing, ATTEMPTS as SOURCING_ATTEMPTS
+from worker import Worker, Courier, Storekeeper, ASSEMBLE_TIME, DELIVERY_CONSTANT, LEAVE_TIME, PASS_TIME
+import clock
+import hooks
+import ids
+import journal
+import metrics
+import log
+
+SKUS = SkuIndex()  # at_store_id positions, shared by the inventories of every store
 
 
 class Store:
@@ -13,39 +33,75 @@ class Store:
                  '_items_unique',
                  '_items_amount',
                  '_providers',
+                 '_sourcing',
                  '_orders',
-                 '_new_orders',
-                 '_assemble_orders',
-                 '_deliver_orders',
-                 '_complete_orders',
+                 '_replenisher',
+                 '_assembly_min_task',
+                 '_assembly_tasks',
+                 '_load',
+                 '_trip_time',
                  '_couriers',
                  '_storekeepers',
+                 '_courier_pool',
+                 '_storekeeper_pool',
+                 '_backlog',
+                 '_dispatcher',
+                 '_registries',
+                 '_woken_stages',
+                 '_providers_updated',
+                 '_short_of',
+                 '_shortages',
+                 '_restocked',
+                 '_waking',
+                 '_route_size',
+                 '_delivery_callbacks',
+                 '_lock',
+                 '_route_radius',
                  '_x',
                  '_y']
 
-    def __init__(self, store_id: uuid, x: int, y: int):
-        self._store_id = store_id
+    def __init__(self, store_id: uuid, x: int, y: int, thread_safe: bool = False):
+        self._store_id = ids.intern(store_id)
         self._x = x
         self._y = y
         self._items_at_store_id = dict()  # item name - at_store_id
         self._items_unique = dict()  # at_store_id - item
-        self._items_amount = defaultdict(int)  # at_store_id - item amount
+        self._items_amount = Inventory(SKUS)  # at_store_id - item amount, kept in one dense vector
 
         self._providers = dict()  # provider_id - provider
+        self._sourcing = Sourcing()  # splits shortfalls across providers
 
-        self._orders = dict()
-        self._new_orders = set()
-        self._assemble_orders = set()
-        self._deliver_orders = set()
-        self._complete_orders = set()
+        self._orders = OrderBook()  # live orders by id and status, finished ones go to its archive
+        self._replenisher = None  # tops stock up ahead of demand when set
+        self._assembly_min_task = assembly.MIN_TASK  # None keeps every order with one storekeeper
+        self._assembly_tasks = dict()  # order_id - picking tasks of a split order still running
+        self._load = None  # last load snapshot quotes were made on
+        self._trip_time = 0.0  # moving average of courier trip times, for quotes
 
         self._couriers = dict()  # worker_id - worker
         self._storekeepers = dict()  # worker_id - worker
-
-        print('store: {0} registered'.format(store_id))
+        self._courier_pool = WorkerPool(self._store_id)  # free couriers first, indexed by work_finish_time
+        self._storekeeper_pool = WorkerPool(self._store_id)
+
+        self._backlog = Backlog()  # stalled orders by the stage that blocked them
+        self._dispatcher = None  # lends workers shared with other stores when set
+        self._registries = []  # registries holding this store, told which clients order here
+        self._woken_stages = set()
+        self._providers_updated = False  # every order stalled on stock is retried on the next drain
+        self._short_of = defaultdict(set)  # at_store_id - ids of orders stalled on stock short of the item
+        self._shortages = dict()  # order_id - at_store_ids it is indexed under in _short_of
+        self._restocked = dict()  # at_store_id - restocked by a provider, else by the store, since the last drain
+        self._waking = False
+
+        self._route_size = ROUTE_SIZE  # stalled orders nearby each other leave with one courier
+        self._route_radius = ROUTE_RADIUS
+        self._delivery_callbacks = defaultdict(list)  # order_id - callbacks fired once the order is handed over
+        self._lock = threading.RLock() if thread_safe else nullcontext()  # guards this store only
+
+        log.info('store', 'store: {0} registered', self._store_id)
 
     @property
-    def store_id(self) -> uuid:
+    def store_id(self) -> int:
         return self._store_id
 
     @property
@@ -57,152 +113,740 @@ class Store:
         return self._y
 
     @property
-    def items_amount(self) -> dict:
+    def items_amount(self) -> Inventory:
         return self._items_amount
 
+    @property
+    def thread_safe(self) -> bool:
+        return not isinstance(self._lock, nullcontext)
+
     @property
     def items_at_store_id(self) -> dict:
         return self._items_at_store_id
 
+    def sells(self, items: dict) -> bool:
+        return all(item_name in self._items_at_store_id for item_name in items)
+
+    def in_stock(self, items: dict) -> bool:
+        return self.sells(items) and self._items_amount.covers(
+            [self._items_at_store_id[item_name] for item_name in items], list(items.values()))
+
+    def set_retention(self, retention: Retention) -> None:
+        self._orders.set_retention(retention)
+
+    def set_replenishment(self, enabled: bool = True, **parameters) -> Replenisher:
+        # parameters go to Replenisher: half_life, lead_time, cover, interval. without a scheduler the checks
+        # run on a thread of their own, next to whoever takes orders, so the store has to be thread safe
+        if enabled and clock.get_scheduler() is None and not self.thread_safe:
+            raise ValueError('store {0} needs thread_safe=True to replenish without a scheduler'.format(
+                self._store_id))
+        with self._lock:
+            if self._replenisher is not None:
+                self._replenisher.stop()
+            self._replenisher = Replenisher(self, **parameters) if enabled else None
+            return self._replenisher
+
+    def replenish(self) -> None:
+        # one batched top-up for every sku at or below its reorder point, plus what stalled orders are short of
+        with self._lock:
+            if self._replenisher is None:
+                return
+            request = self._replenisher.plan(self._items_amount)
+            for order_id in self._backlog.orders(Stage.STOCK):
+                for [at_store_id, amount] in self._shortfall(self._orders[order_id]).items():
+                    request[at_store_id] = max(request.get(at_store_id, 0), amount)
+            if request:
+                log.debug('store', 'store: {0} tops up {1} items', self.store_id, len(request))
+                self._source(request, partial=True)
+
+    def set_parallel_assembly(self, min_task: int = assembly.MIN_TASK) -> None:
+        self._assembly_min_task = min_task
+
+    def set_dispatcher(self, dispatcher) -> None:
+        # workers with shifts here and at other stores of the dispatcher are handed out by it from now on
+        self._dispatcher = dispatcher
+        dispatcher.add_store(self)
+        for worker in [*self._couriers.values(), *self._storekeepers.values()]:
+            dispatcher.add_worker(worker, self)
+
+    def set_route_batching(self, route_size: int, route_radius: float = ROUTE_RADIUS) -> None:
+        self._route_size = max(1, route_size)
+        self._route_radius = route_radius
+
     def add_category(self, item: Item) -> None:
         if item.at_store_id not in self._items_unique:
             self._items_unique[item.at_store_id] = item
             self._items_amount[item.at_store_id] = 0
             self._items_at_store_id[item.name] = item.at_store_id
 
-            print('store: {0} now cells {1}'.format(self.store_id, item.name))
+            log.info('store', 'store: {0} now cells {1}', self.store_id, item.name)
 
     def add_provider(self, provider: Provider) -> None:
         self._providers[provider.provider_id] = provider
-        print('provider: {0} now supports store: {1}'.format(provider.provider_id, self.store_id))
+        self._sourcing.add_provider(provider)
+        provider.add_store(self)
+        log.info('store', 'provider: {0} now supports store: {1}', provider.provider_id, self.store_id)
 
     def update_stocks(self, request: dict) -> None:
-        for [at_store_id, amount] in request.items():
-            self._items_amount[at_store_id] += amount
+        with self._lock:
+            sink = journal.begin()  # no snapshot between the vector update and the last of its records
+            try:
+                self._items_amount.add(list(request.keys()), list(request.values()))
+                for [at_store_id, amount] in request.items():
+                    journal.stock_changed(self._store_id, at_store_id, amount)
+            finally:
+                journal.end(sink)
+
+            if log.enabled('store', log.Level.DEBUG):
+                for at_store_id in request:
+                    log.debug('store', 'store: {0} now has item: {1} amount: {2}',
+                              self.store_id, self._items_unique[at_store_id].name, self._items_amount[at_store_id])
+
+            if self._short_of and any([self._restock(at_store_id, False)
+                                       for [at_store_id, amount] in request.items() if amount > 0]):
+                self.wake(Stage.STOCK)
+
+    def take_stock(self, items: dict) -> bool:
+        with self._lock:
+            needed = [self._items_at_store_id[item_name] for item_name in items]
+            sink = journal.begin()
+            try:
+                if not self._items_amount.take(needed, list(items.values())):
+                    return False
+
+                for [at_store_id, amount] in zip(needed, items.values()):
+                    journal.stock_changed(self._store_id, at_store_id, -amount)
+                return True
+            finally:
+                journal.end(sink)
+
+    def _source(self, request: dict, partial: bool = False) -> bool:
+        # plans on free provider stock, holds every part of the plan and only then commits them, so a provider
+        # shared with other stores cant be drained halfway; a provider that changed since the plan was read
+        # refuses its hold and the request is planned again
+        for _ in range(SOURCING_ATTEMPTS):
+            plan = self._sourcing.plan(request, partial)
+            if plan is None:
+                return False
+
+            holds = []
+            for [provider, provider_request, versions] in plan:
+                hold = provider.reserve(provider_request, versions)
+                if hold is None:
+                    self._sourcing.forget(provider, provider_request)
+                    break
+                holds.append(hold)
+            else:
+                for hold in holds:
+                    log.debug('store', 'request sent from store: {0} to provider: {1}',
+                              self.store_id, hold.provider.provider_id)
+                    sent = hold.provider.commit(hold)
+                    if sent is not None:
+                        self.update_stocks(sent)
+                return True
+
+            for hold in holds:
+                hold.provider.release(hold)
 
-            print('store: {0} now has item: {1} amount: {2}'.format(self.store_id,
-                                                                    self._items_unique[at_store_id].name,
-                                                                    self._items_amount[at_store_id]))
+        log.debug('store', 'store: {0} gave up sourcing after {1} attempts', self.store_id, SOURCING_ATTEMPTS)
+        return False
 
     def send_request(self, provider: Provider, request: dict) -> None:
-        print('request sent from store: {0} to provider: {1}'.format(self.store_id, provider.provider_id))
+        log.debug('store', 'request sent from store: {0} to provider: {1}', self.store_id, provider.provider_id)
 
         provider.process_request(request)
         self.update_stocks(request)
 
-    def take_order(self, client_id: uuid, x: int, y: int, items: dict) -> uuid:
-        order_id = uuid.uuid1()
+    def _create_order(self, client_id: int, x: int, y: int, items: dict) -> Order:
+        order_id = ids.new()  # a uuid is only made if someone asks for it
+        now = clock.now()
 
-        order = Order(_client_id=client_id,
+        order = Order(_client_id=ids.intern(client_id),
                       _order_id=order_id,
                       _order_status=OrderStatus.NEW,
-                      _creation_time=time.time(),
-                      _estimated_delivery_time=time.time(),
+                      _creation_time=now,
+                      _estimated_delivery_time=now,
                       _x=x,
                       _y=y,
                       _items=items,
                       _courier_id='',
                       _storekeeper_id='')
 
-        self._orders[order_id] = order
-        self._new_orders.add(order_id)
+        self._orders.add(order)
+        for registry in self._registries:
+            registry.client_ordered(order.client_id, self)
+        if self._replenisher is not None:
+            for [item_name, amount] in items.items():
+                if item_name in self._items_at_store_id:
+                    self._replenisher.observe(self._items_at_store_id[item_name], amount)
+        journal.order_created(self._store_id, order)
+        metrics.order_created(self._store_id, order)
+        if hooks.order_created is not None:
+            hooks.order_created(self, order)
+
+        return order
+
+    def take_order(self, client_id: int, x: int, y: int, items: dict) -> int:
+        with self._lock:
+            order_id = self._create_order(client_id, x, y, items).order_id
 
-        self.process_order(order_id)
+            self.process_backlog()  # stalled orders go before the new one
+            self.process_order(order_id)
 
         return order_id
 
-    def show_items(self):
-        print('store: {0} items:'.format(self._store_id))
+    def take_orders(self, batch: list) -> list:
+        with self._lock:
+            orders = [self._create_order(client_id, x, y, items) for [client_id, x, y, items] in batch]
+            log.info('store', 'store: {0} took batch of {1} orders', self.store_id, len(orders))
+
+            self.process_backlog()
+            self._drained(self._process_batch, orders)
+
+        return [order.order_id for order in orders]
+
+    def _process_batch(self, orders: list) -> None:
+        demand = defaultdict(int)  # at_store_id - amount needed by the whole batch
+        for order in orders:
+            for [item_name, amount] in order.items.items():
+                demand[self._items_at_store_id[item_name]] += amount
+
+        request = self._items_amount.shortfall(list(demand.keys()), list(demand.values()))
+        if request:
+            self._replenish(request)
+
+        remaining = dict(zip(demand.keys(), self._items_amount.amounts(list(demand.keys()))))
+        for order in orders:
+            needed = [(self._items_at_store_id[item_name], amount) for [item_name, amount] in order.items.items()]
+
+            if all(remaining[at_store_id] >= amount for [at_store_id, amount] in needed):
+                for [at_store_id, amount] in needed:
+                    remaining[at_store_id] -= amount
+                order.order_status = OrderStatus.READY_TO_ASSEMBLE
+                self._process_order(order.order_id)
+            else:
+                log.warning('store', 'order: {0} cant be fully processed by store: {1}: not enough items, need to wait',
+                            order.order_id, self.store_id)
+                self._stall_on_stock(order.order_id)
+
+    def _replenish(self, request: dict) -> None:
+        # one request per provider, whatever the providers together cant cover stays short
+        self._source(request, partial=True)
+
+    def _snapshot_load(self, now: float) -> Load:
+        with self._lock:
+            storekeepers = [max(now, worker.work_finish_time) for worker in self._storekeepers.values()
+                            if worker.shift_finish_time(self._store_id) >= now]
+            couriers = [max(now, worker.work_finish_time) for worker in self._couriers.values()
+                        if worker.shift_finish_time(self._store_id) >= now]
+            queued = sum(sum(self._orders[order_id].items.values())
+                         for order_id in self._backlog.orders(Stage.STOREKEEPER))
+            trips = -(-self._backlog.count(Stage.COURIER) // self._route_size)
+
+            # queued work is spread over everyone, the earliest free worker starts on it first
+            storekeeper_ready = (min(storekeepers) + queued * ASSEMBLE_TIME / len(storekeepers)
+                                 if storekeepers else float('inf'))
+            courier_ready = (min(couriers) + trips * self._trip_time / len(couriers)
+                             if couriers else float('inf'))
+            return Load(now, len(storekeepers), storekeeper_ready, courier_ready)
+
+    def quote(self, items: dict, x: float, y: float) -> Quote:
+        # eta for an order that is not placed, nothing of the store changes; None when the store cant promise one
+        now = clock.now()
+        keys = [self._items_at_store_id.get(item_name) for item_name in items]
+        if None in keys:
+            return None
+
+        sourcing = 0.0
+        if not self._items_amount.covers(keys, list(items.values())):
+            if any(self._items_amount[at_store_id] + self._sourcing.available(at_store_id) < amount
+                   for [at_store_id, amount] in zip(keys, items.values())):
+                return None
+            sourcing = SOURCING_TIME
+
+        load = self._load
+        if load is None or load.taken + QUOTE_REFRESH <= now or load.taken > now:
+            load = self._load = self._snapshot_load(now)
+        if not load.storekeepers or load.courier_ready == float('inf'):
+            return None
+
+        units = sum(items.values())
+        start = max(now + sourcing, load.storekeeper_ready)
+        ready = start + units * ASSEMBLE_TIME / assembly.pickers(units, load.storekeepers, self._assembly_min_task)
+        leave = max(ready, load.courier_ready)
+        road = LEAVE_TIME + hypot(x - self._x, y - self._y) * DELIVERY_CONSTANT + PASS_TIME  # as the courier drives it
+        return Quote(leave + road, sourcing, ready - now - sourcing, leave - ready, road)
+
+    def get_order(self, order_id: int) -> Order:
+        return self._orders.find(ids.find(order_id))
+
+    def query(self, status=None, client_id: int = None, storekeeper_id: int = None, courier_id: int = None,
+              since: float = None, until: float = None) -> list:
+        # see OrderBook.query, an id the store has never seen matches nothing
+        keys = [ids.find(key) if key is not None else None for key in [client_id, storekeeper_id, courier_id]]
+        if any(key is None for [key, given] in zip(keys, [client_id, storekeeper_id, courier_id]) if given is not None):
+            return []
+        with self._lock:
+            return self._orders.query(status, *keys, since, until)
+
+    def orders(self) -> list:
+        return list(self._orders.values())
+
+    def restore_order(self, order: Order) -> None:
+        with self._lock:
+            self._orders.add(order)
+            for registry in self._registries:
+                registry.client_ordered(order.client_id, self)
+
+    def clients(self) -> list:
+        with self._lock:
+            return self._orders.clients()
+
+    def add_registry(self, registry) -> None:
+        if registry not in self._registries:
+            self._registries.append(registry)
+
+    def remove_registry(self, registry) -> None:
+        if registry in self._registries:
+            self._registries.remove(registry)
+
+    def resume(self) -> None:
+        self._drained(self._resume)
+
+    def _resume(self) -> None:
+        # orders read back from a journal lost their timers, they are queued again by how far they got,
+        # orders a courier already took out count as handed over
+        now = clock.now()
+        for order in self._orders.values():
+            if order.order_status == OrderStatus.READY_TO_ASSEMBLE and order.storekeeper_id:
+                # assembly was cut short, its items go back on the shelf and it is assembled again
+                self.update_stocks({self._items_at_store_id[item_name]: amount
+                                    for [item_name, amount] in order.items.items()})
+                order.storekeeper_id = ''
+            if order.order_status in (OrderStatus.NEW, OrderStatus.READY_TO_ASSEMBLE):
+                self._backlog.add(order.order_id, Stage.STOCK, now)
+            elif order.order_status == OrderStatus.ASSEMBLE:
+                order.estimated_delivery_time = min(order.estimated_delivery_time, now)
+                self._backlog.add(order.order_id, Stage.COURIER, now)
+
+        self._providers_updated = True  # retry every stalled order, not only the ones stock covers now
+        self._woken_stages.update((Stage.STOCK, Stage.COURIER))
+
+    def add_delivery_callback(self, order_id: int, callback) -> None:
+        self._delivery_callbacks[ids.find(order_id)].append(callback)
+
+    def show_items(self, level: log.Level = log.Level.INFO):
+        if not log.enabled('store', level):  # skip walking the inventory when nobody reads it
+            return
+
+        log.get_log().write(level, 'store', 'store: {0} items:', (self._store_id,))
         for [at_store_id, amount] in self._items_amount.items():
-            print('{0}: {1}'.format(self._items_unique[at_store_id].name, amount))
+            log.get_log().write(level, 'store', '{0}: {1}', (self._items_unique[at_store_id].name, amount))
+
+    def process_order(self, order_id: int):
+        self._drained(self._process_order, ids.find(order_id))
 
-    def process_order(self, order_id: uuid):
-        if order_id not in self._orders.keys():
-            print('order: {0} processing failed: wrong order id'.format(order_id))
+    def _drained(self, action, *args) -> None:
+        with self._lock:
+            if self._waking:  # nested call - woken stages are drained by the outermost caller
+                action(*args)
+                return
+
+            self._waking = True
+            try:
+                action(*args)
+                self._drain_backlog()
+            finally:
+                self._waking = False
+
+    def _shortfall(self, order: Order) -> dict:
+        return self._items_amount.shortfall([self._items_at_store_id[item_name] for item_name in order.items],
+                                            list(order.items.values()))
+
+    def _stall_on_stock(self, order_id: int) -> None:
+        # indexed by the items it is short of, so a restock wakes only the orders waiting on that item
+        self._backlog.add(order_id, Stage.STOCK, clock.now())
+        metrics.stalled(self._store_id, Stage.STOCK)
+        self._index_shortage(order_id)
+
+    def _index_shortage(self, order_id: int) -> None:
+        self._forget_shortage(order_id)
+        order = self._orders[order_id]
+        shortage = list(self._shortfall(order)) or [self._items_at_store_id[item_name] for item_name in order.items]
+        self._shortages[order_id] = shortage
+        for at_store_id in shortage:
+            self._short_of[at_store_id].add(order_id)
+
+    def _forget_shortage(self, order_id: int) -> None:
+        for at_store_id in self._shortages.pop(order_id, ()):
+            waiting = self._short_of[at_store_id]
+            waiting.discard(order_id)
+            if not waiting:
+                del self._short_of[at_store_id]
+
+    def _restock(self, at_store_id: int, by_provider: bool) -> bool:
+        # returns whether any stalled order waits on the item
+        if at_store_id not in self._short_of:
+            return False
+        self._restocked[at_store_id] = by_provider or self._restocked.get(at_store_id, False)
+        return True
+
+    def _process_order(self, order_id: int):
+        if order_id not in self._orders:
+            log.warning('store', 'order: {0} processing failed: wrong order id', order_id)
             return
-        elif self._orders[order_id].order_status == OrderStatus.NEW:
-            print('store: {0} is starting to process order: {1}'.format(self._store_id, order_id))
-            request = defaultdict()
-
-            for [item_name, item_amount] in self._orders[order_id].items.items():
-                available_amount = self._items_amount[self._items_at_store_id[item_name]]
-                if available_amount < item_amount:
-                    request[self._items_at_store_id[item_name]] = item_amount - available_amount
-
-            stocks_updated = False
-            for [provider_id, provider] in self._providers.items():
-                if provider.is_possible_to_process_request(request):
-                    self.update_stocks(provider.process_request(request))
-                    stocks_updated = True
-                    break
 
-            if not stocks_updated:
-                print(
-                    'order: {0} cant be fully processed by store: {1}: not enough items, need to wait'.format(
-                        order_id,
-                        self.store_id))
+        self._backlog.discard(order_id)
+        self._forget_shortage(order_id)
+
+        if self._orders[order_id].order_status == OrderStatus.NEW:
+            log.info('store', 'store: {0} is starting to process order: {1}', self._store_id, order_id)
+            sourced = self._source(self._shortfall(self._orders[order_id]))
+
+            # a hold that expired before its commit leaves the order short
+            if not sourced or self._shortfall(self._orders[order_id]):
+                log.warning('store', 'order: {0} cant be fully processed by store: {1}: not enough items, need to wait',
+                            order_id, self.store_id)
+                self._stall_on_stock(order_id)
                 return
             else:
                 self._orders[order_id].order_status = OrderStatus.READY_TO_ASSEMBLE
-                print('store: {0} stocks updated, order: {1} ready to assemble'.format(self.store_id, order_id))
+                log.info('store', 'store: {0} stocks updated, order: {1} ready to assemble', self.store_id, order_id)
 
         if self._orders[order_id].order_status == OrderStatus.READY_TO_ASSEMBLE:
-            storekeeper_found = False
-
-            for [storekeeper_id, storekeeper] in self._storekeepers.items():
-                if storekeeper.get_worker_status(self) == Worker.WorkerStatus.FREE:
-                    storekeeper_found = True
-                    self.show_items()
-                    self.set_storekeeper(storekeeper_id, order_id)
-                    self.show_items()
-                    break
+            if self._orders[order_id].storekeeper_id:  # assembly timer is still running
+                log.info('store', 'order: {0} is not assembled - need to wait', order_id)
+                return
 
-            if not storekeeper_found:
-                print(
-                    'order: {0} cant be fully processed by store: {1}: no storekeepers are free - need to wait'.format(
-                        order_id,
-                        self.store_id))
+            storekeeper = self._storekeeper_pool.acquire(clock.now())
+
+            if storekeeper is not None:
+                storekeepers = [storekeeper]
+                wanted = assembly.pickers(sum(self._orders[order_id].items.values()), len(self._storekeepers),
+                                          self._assembly_min_task)
+                while len(storekeepers) < wanted:  # a bulk order takes whoever else is free right now
+                    storekeeper = self._storekeeper_pool.acquire(clock.now())
+                    if storekeeper is None:
+                        break
+                    storekeepers.append(storekeeper)
+
+                self.show_items(log.Level.DEBUG)
+                if len(storekeepers) == 1:
+                    assembling = self.set_storekeeper(storekeepers[0].worker_id, order_id)
+                else:
+                    assembling = self.set_storekeepers([worker.worker_id for worker in storekeepers], order_id)
+                self.show_items(log.Level.DEBUG)
+                if not assembling:
+                    self._process_order(order_id)
+                    return
+            else:
+                log.warning('store',
+                            'order: {0} cant be fully processed by store: {1}: no storekeepers are free - need to wait',
+                            order_id, self.store_id)
+                self._backlog.add(order_id, Stage.STOREKEEPER, clock.now())
+                metrics.stalled(self._store_id, Stage.STOREKEEPER)
                 return
 
         if (self._orders[order_id].order_status == OrderStatus.ASSEMBLE and
-                self._orders[order_id].estimated_delivery_time <= time.time()):
-            courier_found = False
-            for [courier_id, courier] in self._couriers.items():
-                if courier.get_worker_status(self) == Worker.WorkerStatus.FREE:
-                    courier_found = True
-                    self.set_courier(courier_id, order_id)
-                    break
+                self._orders[order_id].estimated_delivery_time <= clock.now()):
+            courier = self._courier_pool.acquire(clock.now())
 
-            if not courier_found:
-                print('order: {0} cant be fully processed by store: {1}: no couriers are free - need to wait'.format(
-                    order_id,
-                    self.store_id))
+            if courier is not None:
+                self.set_courier(courier.worker_id, order_id)
+            else:
+                log.warning('store',
+                            'order: {0} cant be fully processed by store: {1}: no couriers are free - need to wait',
+                            order_id, self.store_id)
+                self._backlog.add(order_id, Stage.COURIER, clock.now())
+                metrics.stalled(self._store_id, Stage.COURIER)
                 return
         elif (self._orders[order_id].order_status == OrderStatus.ASSEMBLE and
-              self._orders[order_id].estimated_delivery_time > time.time()):
-            print('order: {0} is not assembled - need to wait'.format(order_id))
+              self._orders[order_id].estimated_delivery_time > clock.now()):
+            log.info('store', 'order: {0} is not assembled - need to wait', order_id)
+            self._backlog.add(order_id, Stage.ASSEMBLY, self._orders[order_id].estimated_delivery_time)
             return
 
-        print('order: {0} is fully processed by store: {1}:'.format(order_id, self.store_id))
+        log.info('store', 'order: {0} is fully processed by store: {1}:', order_id, self.store_id)
+
+    def wake(self, stage: Stage) -> None:
+        with self._lock:
+            self._woken_stages.add(stage)
+            if self._waking:
+                return
+
+            self._waking = True
+            try:
+                self._drain_backlog()
+            finally:
+                self._waking = False
+
+    def process_backlog(self) -> None:
+        for stage in (Stage.ASSEMBLY, Stage.STOREKEEPER, Stage.COURIER):  # stock is woken by stock updates only
+            self.wake(stage)
+
+    def provider_updated(self, provider: Provider, at_store_id: int) -> None:
+        with self._lock:
+            self._sourcing.add_item(provider, at_store_id)
+            if self._restock(at_store_id, True):
+                self.wake(Stage.STOCK)
+
+    def _drain_backlog(self) -> None:
+        while True:
+            self._drain_stages()
+            if self._dispatcher is None or not self._dispatcher.report(
+                    self, self._backlog.count(Stage.STOREKEEPER), self._backlog.count(Stage.COURIER)):
+                return
+            self._woken_stages.update((Stage.STOREKEEPER, Stage.COURIER))  # shared workers were lent
+
+    def _drain_stages(self) -> None:
+        while self._woken_stages:
+            stage = self._woken_stages.pop()
+
+            if stage == Stage.STOCK:
+                self._drain_stock()
+            elif stage == Stage.STOREKEEPER:
+                while (self._backlog.count(Stage.STOREKEEPER) and
+                       self._storekeeper_pool.next_free_time(clock.now()) <= clock.now()):
+                    self._process_order(self._backlog.pop(Stage.STOREKEEPER))
+            elif stage == Stage.ASSEMBLY:
+                while self._backlog.next_ready_time(Stage.ASSEMBLY) <= clock.now():
+                    self._process_order(self._backlog.pop(Stage.ASSEMBLY))
+            elif stage == Stage.COURIER:
+                self._dispatch_couriers()
+
+    def _drain_stock(self) -> None:
+        # orders short of a restocked item: a provider restock retries sourcing them, a store restock only
+        # moves on those it now covers
+        if self._providers_updated:
+            self._providers_updated = False
+            self._restocked.clear()
+            for order_id in self._backlog.orders(Stage.STOCK):
+                self._process_order(order_id)
+            return
+
+        [restocked, self._restocked] = [self._restocked, dict()]
+        candidates = dict()  # order_id - sourcing is retried
+        for [at_store_id, by_provider] in restocked.items():
+            for order_id in self._short_of.get(at_store_id, ()):
+                candidates[order_id] = by_provider or candidates.get(order_id, False)
+
+        for order_id in sorted(candidates):  # ids are handed out in order, so older orders go first
+            if self._backlog.stage_of(order_id) != Stage.STOCK:  # moved on while an earlier one was processed
+                continue
+            if candidates[order_id] or not self._shortfall(self._orders[order_id]):
+                self._process_order(order_id)
+            else:  # still short, possibly of another item since stock went to other orders meanwhile
+                self._index_shortage(order_id)
+
+    def _dispatch_couriers(self) -> None:
+        # orders that waited for a courier are grouped by proximity, one multi-drop route per free courier
+        waiting = []
+        while self._backlog.count(Stage.COURIER):
+            courier = self._courier_pool.acquire(clock.now())
+            if courier is None:
+                return
+
+            # sorted once, routed orders drop out; a blocking delivery may have routed or queued others meanwhile
+            waiting = [order for order in waiting if self._backlog.stage_of(order.order_id) == Stage.COURIER]
+            if not waiting:
+                waiting = [self._orders[order_id] for order_id in self._backlog.orders(Stage.COURIER)]
+            route = group_nearby(waiting[0], waiting, self._route_size, self._route_radius)
+            for order in route:
+                self._backlog.discard(order.order_id)
+
+            self.set_courier_route(courier.worker_id, [order.order_id for order in route])
 
-    def set_courier(self, courier_id: uuid, order_id: uuid):
-        self._orders[order_id].courier_id = courier_id
-        print('courier: {0} is responsible for delivering order: {1}'.format(courier_id, order_id))
-        work_time = self._couriers[courier_id].get_order(self._orders[order_id], self)
-        if self._couriers[courier_id].able_to_pass(order_id):
-            self._couriers[courier_id].pass_order()
-            self._couriers[courier_id].balance += 300 * work_time
+    def _pool_of(self, worker: Worker) -> WorkerPool:
+        return self._courier_pool if isinstance(worker, Courier) else self._storekeeper_pool
 
-    def set_storekeeper(self, storekeeper_id: uuid, order_id: uuid):
+    def _release(self, worker: Worker) -> None:
+        # shared workers go back to the dispatcher, which picks the store they serve next
+        if self._dispatcher is not None and self._dispatcher.shares(worker.worker_id):
+            self._dispatcher.release(worker, self)
+        else:
+            self._pool_of(worker).release(worker)
+
+    def lend(self, worker: Worker) -> None:
+        # called by the dispatcher while this store drains, the worker is taken back if it is left idle
+        self._pool_of(worker).release(worker)
+
+    def withdraw(self, worker: Worker) -> bool:
+        # takes a worker out of the pool, returns whether it was there, i.e. free and unused
+        with self._lock:
+            pool = self._pool_of(worker)
+            if worker.worker_id not in pool:
+                return False
+            pool.discard(worker.worker_id)
+            return True
+
+    def borrow(self, worker: Worker) -> bool:
+        # a shared worker sent here by the dispatcher, returns whether it got any work
+        with self._lock:
+            self._pool_of(worker).release(worker)
+            self.wake(Stage.COURIER if isinstance(worker, Courier) else Stage.STOREKEEPER)
+            return not self.withdraw(worker)
+
+    def _schedule_wake(self, worker: Worker, stage: Stage, moment: float = None) -> None:
+        # a worker with shifts at several stores sits in all their pools, any of them may be waiting for it
+        scheduler = clock.get_scheduler()
+        if scheduler is not None:
+            moment = worker.work_finish_time if moment is None else moment
+            for store in worker.stores_on_shift(moment) or [self]:
+                scheduler.schedule(moment, clock.EventType.WORKER_FREE, store.wake, stage)
+
+    def set_courier(self, courier_id: int, order_id: int):
+        self.set_courier_route(courier_id, [order_id])
+
+    def set_courier_route(self, courier_id: int, order_ids: list):
+        for order_id in order_ids:
+            self._orders[order_id].courier_id = courier_id
+            log.info('store', 'courier: {0} is responsible for delivering order: {1}', courier_id, order_id)
+        work_time = self._couriers[courier_id].get_orders([self._orders[order_id] for order_id in order_ids], self)
+        metrics.worker_busy(self._store_id, courier_id, work_time)
+        if hooks.worker_assigned is not None:
+            for order_id in order_ids:
+                hooks.worker_assigned(self, self._orders[order_id], courier_id, True)
+        self._trip_time += (work_time - self._trip_time) * (0.1 if self._trip_time else 1.0)
+        self._release(self._couriers[courier_id])
+        self._schedule_wake(self._couriers[courier_id], Stage.COURIER)
+
+        scheduler = clock.get_scheduler()
+        route = self._couriers[courier_id].route
+        for order in route:
+            work_share = work_time if order is route[-1] else 0  # whole trip is paid on the last drop-off
+            if scheduler is not None:
+                scheduler.schedule(order.estimated_delivery_time, clock.EventType.COURIER_ARRIVED,
+                                   self.finish_delivery, courier_id, order.order_id, work_share)
+            else:
+                self.finish_delivery(courier_id, order.order_id, work_share)
+
+    def finish_delivery(self, courier_id: int, order_id: int, work_time: float):
+        with self._lock:
+            if self._couriers[courier_id].able_to_pass(order_id):
+                order = self._couriers[courier_id].pass_order(order_id)  # the order leaves the live table here
+                if work_time:
+                    self._couriers[courier_id].balance += 300 * work_time
+
+                for callback in self._delivery_callbacks.pop(order_id, ()):
+                    callback(order)
+
+                if self._couriers[courier_id].order is None:
+                    self.wake(Stage.COURIER)
+                    if self._couriers[courier_id].work_finish_time <= clock.now():  # its free event already fired
+                        self._schedule_wake(self._couriers[courier_id], Stage.COURIER, clock.now())
+
+    def set_storekeeper(self, storekeeper_id: int, order_id: int) -> bool:
         self._orders[order_id].storekeeper_id = storekeeper_id
-        print('storekeeper: {0} is responsible for assembling order: {1}'.format(storekeeper_id, order_id))
+        log.info('store', 'storekeeper: {0} is responsible for assembling order: {1}', storekeeper_id, order_id)
         work_time = self._storekeepers[storekeeper_id].get_order(self._orders[order_id], self)
-        self._storekeepers[storekeeper_id].finish_assembly()
+
+        if self._storekeepers[storekeeper_id].order is not self._orders[order_id]:
+            # items went to another order since this one was sourced - source it again
+            self._orders[order_id].storekeeper_id = ''
+            self._orders[order_id].order_status = OrderStatus.NEW
+            self._release(self._storekeepers[storekeeper_id])
+            return False
+
         self._storekeepers[storekeeper_id].balance += 300 * work_time
+        metrics.worker_busy(self._store_id, storekeeper_id, work_time)
+        if hooks.worker_assigned is not None:
+            hooks.worker_assigned(self, self._orders[order_id], storekeeper_id, False)
+
+        scheduler = clock.get_scheduler()
+        if scheduler is not None:
+            scheduler.schedule(self._storekeepers[storekeeper_id].work_finish_time, clock.EventType.ASSEMBLY_FINISHED,
+                               self.finish_assembly, storekeeper_id, order_id)
+        else:
+            self._storekeepers[storekeeper_id].finish_assembly()
+        self._release(self._storekeepers[storekeeper_id])
+        self._schedule_wake(self._storekeepers[storekeeper_id], Stage.STOREKEEPER)
+        self.wake(Stage.STOREKEEPER)  # storekeeper may already be free again
+        return True
+
+    def set_storekeepers(self, storekeeper_ids: list, order_id: int) -> bool:
+        # the order is split into picking tasks, one per storekeeper, and is assembled when the last one is done
+        order = self._orders[order_id]
+        if not self.take_stock(order.items):  # items went to another order since this one was sourced
+            order.order_status = OrderStatus.NEW
+            for storekeeper_id in storekeeper_ids:
+                self._release(self._storekeepers[storekeeper_id])
+            return False
+
+        tasks = assembly.split(order.items, len(storekeeper_ids))
+        for storekeeper_id in storekeeper_ids[len(tasks):]:
+            self._release(self._storekeepers[storekeeper_id])
+        storekeeper_ids = storekeeper_ids[:len(tasks)]
+
+        order.storekeeper_id = storekeeper_ids[0]  # the order keeps one storekeeper, the first picker leads
+        self._assembly_tasks[order_id] = len(tasks)
+        makespan = 0
+        scheduler = clock.get_scheduler()
+        for [storekeeper_id, task] in zip(storekeeper_ids, tasks):
+            storekeeper = self._storekeepers[storekeeper_id]
+            work_time = storekeeper.get_task(order, task)
+            makespan = max(makespan, work_time)
+            storekeeper.balance += 300 * work_time
+            metrics.worker_busy(self._store_id, storekeeper_id, work_time)
+            if hooks.worker_assigned is not None:
+                hooks.worker_assigned(self, order, storekeeper_id, False)
+            if scheduler is not None:
+                scheduler.schedule(storekeeper.work_finish_time, clock.EventType.ASSEMBLY_FINISHED,
+                                   self.finish_task, storekeeper_id, order_id)
+            self._release(storekeeper)
+            self._schedule_wake(storekeeper, Stage.STOREKEEPER)
+
+        order.estimated_delivery_time += makespan
+        log.info('store', 'order: {0} split between {1} storekeepers, assembled in: {2}',
+                 order_id, len(tasks), makespan)
+
+        if scheduler is None:  # workers blocked on the clock, the order goes on to a courier from here
+            for storekeeper_id in storekeeper_ids:
+                self._storekeepers[storekeeper_id].finish_task()
+            del self._assembly_tasks[order_id]
+            order.order_status = OrderStatus.ASSEMBLE
+        self.wake(Stage.STOREKEEPER)
+        return True
+
+    def finish_task(self, storekeeper_id: int, order_id: int):
+        with self._lock:
+            self._storekeepers[storekeeper_id].finish_task()
+            self._assembly_tasks[order_id] -= 1
+            if not self._assembly_tasks[order_id]:
+                del self._assembly_tasks[order_id]
+                self._orders[order_id].order_status = OrderStatus.ASSEMBLE
+                log.info('store', 'order: {0} assembled by store: {1}', order_id, self.store_id)
+                self.process_order(order_id)
+            self.wake(Stage.STOREKEEPER)
+
+    def finish_assembly(self, storekeeper_id: int, order_id: int):
+        with self._lock:
+            self._storekeepers[storekeeper_id].finish_assembly()
+            self.process_order(order_id)  # assembled order goes straight to a courier
+            self.wake(Stage.STOREKEEPER)  # in case the worker free event fired before this one
+
+    def check_worker(self, worker: Worker) -> None:
+        # without a dispatcher a shared worker sits in the pool of each of its stores, and two stores on
+        # different threads could both take it for the same moment
+        if self._dispatcher is not None:
+            return
+        others = [store for store in worker.stores_on_shift(clock.now()) if store is not self]
+        if others and (self.thread_safe or any(store.thread_safe for store in others)):
+            raise ValueError('worker {0} is on shift at store {1}, thread safe stores share workers only through '
+                             'a dispatcher'.format(worker.worker_id, others[0].store_id))
 
     def add_worker(self, worker: Worker):
-        if isinstance(worker, Courier):
-            self._couriers[worker.worker_id] = worker
-        else:
-            self._storekeepers[worker.worker_id] = worker
-        print('worker: {0} now works for store: {1}'.format(worker.worker_id, self.store_id))
+        shared = self._dispatcher is not None and self._dispatcher.add_worker(worker, self)
+        with self._lock:
+            if isinstance(worker, Courier):
+                self._couriers[worker.worker_id] = worker
+                if not shared:
+                    self._courier_pool.add(worker)
+                metrics.worker_added(self._store_id, worker.worker_id, 'courier')
+            else:
+                self._storekeepers[worker.worker_id] = worker
+                if not shared:
+                    self._storekeeper_pool.add(worker)
+                metrics.worker_added(self._store_id, worker.worker_id, 'storekeeper')
+        log.info('store', 'worker: {0} now works for store: {1}', worker.worker_id, self.store_id)
+
+        self.wake(Stage.COURIER if isinstance(worker, Courier) else Stage.STOREKEEPER)
@@ -0,0 +1,54 @@
+import uuid
+
+import journal
+import log
+import recovery
+from order import Item
+from store import Store
+
+log.set_level(log.Level.ERROR)
+
+
+def _store(store_id: uuid.UUID, at_store_ids: list) -> [Store, list]:
+    store = Store(store_id, 0, 0)
+    items = [Item(_name=name, _price=5, _at_store_id=at_store_id, _at_provider_id=uuid.uuid1(), _provider_id=None)
+             for [name, at_store_id] in zip('abc', at_store_ids)]
+    for item in items:
+        store.add_category(item)
+    return [store, items]
+
+
+def test_stocks_survive_snapshot_inside_an_update(tmp_path):
+    # one record per batch and a snapshot every two, so the snapshot falls between the records of one update
+    path = str(tmp_path / 'store.wal')
+    store_id = uuid.uuid1()
+    at_store_ids = [uuid.uuid1() for _ in range(3)]
+
+    [store, items] = _store(store_id, at_store_ids)
+    journal.configure(path, [store], batch_size=1, snapshot_every=2)
+    try:
+        store.update_stocks({item.at_store_id: 5 for item in items})
+    finally:
+        journal.close()
+
+    [recovered, items] = _store(store_id, at_store_ids)
+    recovery.recover(path, [recovered])
+    assert [recovered.items_amount[item.at_store_id] for item in items] == [5, 5, 5]
+
+
+def test_stocks_survive_snapshot_inside_a_take(tmp_path):
+    path = str(tmp_path / 'store.wal')
+    store_id = uuid.uuid1()
+    at_store_ids = [uuid.uuid1() for _ in range(3)]
+
+    [store, items] = _store(store_id, at_store_ids)
+    store.update_stocks({item.at_store_id: 5 for item in items})
+    journal.configure(path, [store], batch_size=1, snapshot_every=2)
+    try:
+        assert store.take_stock({'a': 1, 'b': 2, 'c': 3})
+    finally:
+        journal.close()
+
+    [recovered, items] = _store(store_id, at_store_ids)
+    recovery.recover(path, [recovered])
+    assert [recovered.items_amount[item.at_store_id] for item in items] == [4, 3, 2]
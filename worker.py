@@ -3,10 +3,14 @@ from math import hypot
 from abc import abstractmethod, ABC
 
 import enum
-import time
 import uuid
 
 from order import Order, OrderStatus
+from routing import plan_route
+import clock
+import ids
+import journal
+import log
 
 ASSEMBLE_TIME = 0.05  # set to 45
 LEAVE_TIME = 0.04  # set to 60
@@ -23,15 +27,17 @@ class Worker(ABC):
     __slots__ = ['_worker_id',
                  '_worker_status',
                  '_work_finish_time',
-                 '_shift_finish_time'
+                 '_shift_finish_time',
+                 '_stores',
                  '_order',
                  '_balance']
 
     def __init__(self, worker_id: uuid) -> None:
-        self._worker_id = worker_id
+        self._worker_id = ids.intern(worker_id)
         self._worker_status = Worker.WorkerStatus.FREE
-        self._work_finish_time = time.time() - 1
+        self._work_finish_time = clock.now() - 1
         self._shift_finish_time = defaultdict(float)  # worker may be registered at more than one store
+        self._stores = dict()  # store_id - store it got a shift at
         self._order = None
         self._balance = 0  # worker is paid on a piecework basis
 
@@ -40,20 +46,32 @@ class Worker(ABC):
         pass
 
     def get_shift(self, shift: float, store) -> None:
-        self._shift_finish_time[store.store_id] = time.time() + shift
+        store.check_worker(self)  # before anything is recorded, a store may turn the worker down
+        self._shift_finish_time[store.store_id] = clock.now() + shift
+        self._stores[store.store_id] = store
         store.add_worker(self)
 
-        print('worker: {0} got shift: {1} at store: {2}'.format(self._worker_id, shift, store.store_id))
+        scheduler = clock.get_scheduler()
+        if scheduler is not None:
+            scheduler.schedule(self._shift_finish_time[store.store_id], clock.EventType.SHIFT_ENDED,
+                               self.finish_shift, store)
+
+        log.info('worker', 'worker: {0} got shift: {1} at store: {2}', self._worker_id, shift, store.store_id)
+
+    def finish_shift(self, store) -> None:
+        if clock.now() >= self._shift_finish_time[store.store_id]:  # shift may have been extended since
+            log.info('worker', 'worker: {0} finished shift at store: {1}', self._worker_id, store.store_id)
 
     @property
-    def worker_id(self) -> uuid.UUID:
+    def worker_id(self) -> int:
         return self._worker_id
 
     def get_worker_status(self, store) -> WorkerStatus:
-        if time.time() > self._shift_finish_time[store.store_id]:
+        now = clock.now()
+        if now > self._shift_finish_time[store.store_id]:
             self._worker_status = Worker.WorkerStatus.NOT_AVAILABLE
             return Worker.WorkerStatus.NOT_AVAILABLE
-        elif time.time() > self._work_finish_time:
+        elif now > self._work_finish_time:
             self._worker_status = Worker.WorkerStatus.FREE
             return Worker.WorkerStatus.FREE
         else:
@@ -63,6 +81,16 @@ class Worker(ABC):
     def set_worker_status(self, status: WorkerStatus) -> None:
         self._worker_status = status
 
+    @property
+    def order(self) -> Order:
+        return self._order
+
+    def shift_finish_time(self, store_id: int) -> float:
+        return self._shift_finish_time.get(store_id, 0.0)
+
+    def stores_on_shift(self, moment: float) -> list:
+        return [store for [store_id, store] in self._stores.items() if self._shift_finish_time[store_id] >= moment]
+
     @property
     def work_finish_time(self) -> float:
         return self._work_finish_time
@@ -76,79 +104,119 @@ class Worker(ABC):
         return self._balance
 
     @balance.setter
-    def balance(self, value: int):
-        self._balance += value
-        print('worker: {0} balance updated: {1}'.format(self.worker_id, self._balance))
+    def balance(self, value: float):
+        self._balance = value
+        journal.balance_changed(self._worker_id, value)
+        log.debug('worker', 'worker: {0} balance updated: {1}', self.worker_id, self._balance)
 
 
 class Courier(Worker):
     def __init__(self, worker_id: uuid) -> None:
         super().__init__(worker_id)
-        print('courier: {0} registered'.format(worker_id))
+        self._route = dict()  # order_id - order, drop-offs left in route order
+        log.info('worker', 'courier: {0} registered', self.worker_id)
+
+    @property
+    def route(self) -> list:
+        return list(self._route.values())
 
     def get_order(self, order: Order, store) -> float:
-        if order.order_status == OrderStatus.ASSEMBLE:
-            print('courier: {0} got order: {1}'.format(self.worker_id, order.order_id))
-            self._worker_status = Worker.WorkerStatus.BUSY
+        return self.get_orders([order], store)
+
+    def get_orders(self, orders: list, store) -> float:
+        for order in orders:
+            if order.order_status != OrderStatus.ASSEMBLE:
+                log.warning('worker', 'courier: {0} didnt get order: {1}', self.worker_id, order.order_id)
+        orders = [order for order in orders if order.order_status == OrderStatus.ASSEMBLE]
+        if not orders:
+            return 0
+
+        self._worker_status = Worker.WorkerStatus.BUSY
+        now = clock.now()
+        delivery_time = LEAVE_TIME
+        [x, y] = [store.x, store.y]
+
+        for order in plan_route(store.x, store.y, orders):
+            log.info('worker', 'courier: {0} got order: {1}', self.worker_id, order.order_id)
             order.order_status = OrderStatus.DELIVER
             order.courier_id = self.worker_id
-            self._order = order
 
-            road_time = hypot((order.x - store.x), (order.y - store.y)) * DELIVERY_CONSTANT
-            delivery_time = LEAVE_TIME + road_time + PASS_TIME
-            order._estimated_delivery_time = delivery_time
-            self._work_finish_time = time.time() + delivery_time + road_time
-            print('waiting for delivery...\n')
-            time.sleep(delivery_time)
-            return delivery_time + road_time
-        else:
-            print('courier: {0} didnt get order: {1}'.format(self.worker_id, order.order_id))
-            return 0
-
-    def able_to_pass(self, order_id: uuid) -> bool:
-        if self._order and self._order.order_id == order_id and self._order.check_time():
-            print('courier: {0} can pass order: {1}'.format(self.worker_id, order_id))
+            delivery_time += hypot((order.x - x), (order.y - y)) * DELIVERY_CONSTANT + PASS_TIME
+            order.estimated_delivery_time = now + delivery_time  # every stop gets its own eta
+            self._route[order.order_id] = order
+            [x, y] = [order.x, order.y]
+
+        road_time = hypot((store.x - x), (store.y - y)) * DELIVERY_CONSTANT  # way back to the store
+        self._order = next(iter(self._route.values()))
+        self._work_finish_time = now + delivery_time + road_time
+        if clock.get_scheduler() is None:  # otherwise the store schedules the courier arrivals
+            log.info('worker', 'waiting for delivery...')
+            clock.sleep(delivery_time)
+        return delivery_time + road_time
+
+    def able_to_pass(self, order_id: int) -> bool:
+        order_id = ids.find(order_id)
+        if order_id in self._route and self._route[order_id].check_time():
+            log.debug('worker', 'courier: {0} can pass order: {1}', self.worker_id, order_id)
             return True
         else:
-            print('courier: {0} cant pass order: {1}'.format(self.worker_id, order_id))
+            log.debug('worker', 'courier: {0} cant pass order: {1}', self.worker_id, order_id)
             return False
 
-    def pass_order(self) -> Order:
-        order = self._order
-        order.order_status = OrderStatus.DELIVER
-        self._order = None
-        self._worker_status = Worker.WorkerStatus.FREE
-        print('courier: {0} passed order: {1}'.format(self.worker_id, order.order_id))
+    def pass_order(self, order_id: int = None) -> Order:
+        order = self._route.pop(ids.find(order_id) if order_id is not None else self._order.order_id)
+        order.order_status = OrderStatus.COMPLETE
+        self._order = next(iter(self._route.values()), None)
+        if self._order is None:
+            self._worker_status = Worker.WorkerStatus.FREE
+        log.info('worker', 'courier: {0} passed order: {1}', self.worker_id, order.order_id)
         return order
 
 
 class Storekeeper(Worker):
     def __init__(self, worker_id: uuid) -> None:
         super().__init__(worker_id)
-        print('storekeeper: {0} registered'.format(worker_id))
+        log.info('worker', 'storekeeper: {0} registered', self.worker_id)
 
     def get_order(self, order: Order, store) -> float:
         if order.order_status == OrderStatus.READY_TO_ASSEMBLE:
+            if not store.take_stock(order.items):  # another order got the items first
+                log.warning('worker', 'storekeeper: {0} didnt get order: {1}: not enough items',
+                            self.worker_id, order.order_id)
+                return 0
+
             self._order = order
 
             estimated_assemble_time = 0
-            for [item_name, amount] in order.items.items():
-                store.items_amount[store.items_at_store_id[item_name]] -= amount
+            for amount in order.items.values():
                 estimated_assemble_time += amount * ASSEMBLE_TIME
 
-            self._work_finish_time = time.time() + estimated_assemble_time
+            self._work_finish_time = clock.now() + estimated_assemble_time
             order.storekeeper_id = self.worker_id
             order.estimated_delivery_time += estimated_assemble_time
-            print('storekeeper: {0} got order: {1}'.format(self.worker_id, order.order_id))
+            log.info('worker', 'storekeeper: {0} got order: {1}', self.worker_id, order.order_id)
             return estimated_assemble_time
         else:
-            print('storekeeper: {0} didnt get order: {1}: wrong status'.format(self.worker_id, order.order_id))
+            log.warning('worker', 'storekeeper: {0} didnt get order: {1}: wrong status', self.worker_id, order.order_id)
             return 0
 
-    def finish_assembly(self):
+    def get_task(self, order: Order, items: dict) -> float:
+        # one picking task of an order split between storekeepers, the store takes the stock and moves the order on
+        self._order = order
+        assemble_time = sum(items.values()) * ASSEMBLE_TIME
+        self._work_finish_time = clock.now() + assemble_time
+        log.info('worker', 'storekeeper: {0} got {1} items of order: {2}', self.worker_id, sum(items.values()),
+                 order.order_id)
+        return assemble_time
+
+    def finish_task(self) -> Order:
         order = self._order
         self._order = None
-        self._work_finish_time = time.time()
+        self._work_finish_time = clock.now()
+        return order
+
+    def finish_assembly(self):
+        order = self.finish_task()
         order.order_status = OrderStatus.ASSEMBLE
-        print('storekeeper: {0} assemble order: {1}'.format(self.worker_id, order.order_id))
+        log.info('worker', 'storekeeper: {0} assemble order: {1}', self.worker_id, order.order_id)
         return order